@@ -6,18 +6,22 @@ from django.contrib.admin import SimpleListFilter, helpers
 from django.contrib.admin.util import model_ngettext
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Count
+from django.http import StreamingHttpResponse
 from django.contrib.sites.models import RequestSite, Site
-from django.core.mail import send_mass_mail
-from django.template import Context
-from django.template.loader import render_to_string
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_unicode
-from django.utils.timezone import now as tz_aware_now
+from django.utils.timezone import now as tz_aware_now, localtime
 from django.utils.translation import ugettext as _, ugettext_lazy
 from kurs.models import ApplicationPermit, UserProfile, Event, Course, \
-    UserComment, Application, ApplicationChoices
+    UserComment, Application, ApplicationChoices, OutgoingEmail, AuditBatch
+from kurs.notifications import queue_approval_emails
+from kurs.cache import bump_user_versions, bump_event_versions
+from kurs.log import log_event
+from kurs.db import write_transaction
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -28,39 +32,221 @@ logger = logging.getLogger(__name__)
 # We want to modify this behaviour so all add/change/delete operations
 # via the admin interface gets logged into a seperate log file
 class LoggingModelAdmin(admin.ModelAdmin):
+    def log_object_event(self, request, action, object, object_repr, **fields):
+        log_event(logger, action, u"%s %s via admin interface" % (object._meta.verbose_name, action),
+                  request, model="%s.%s" % (object._meta.app_label, object._meta.model_name),
+                  object_id=object.pk, object=object_repr, **fields)
+
     def log_addition(self, request, object):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("%s added via admin interface: user = %s , object_id = %s , object = %s" %
-                         (ContentType.objects.get_for_model(object),
-                          request.user, object.pk, force_unicode(object)))
+        self.log_object_event(request, 'added', object, force_unicode(object))
         # FIXME: Remove this to disable logging into DB
         admin.ModelAdmin.log_addition(self, request, object)
 
     def log_change(self, request, object, message):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("%s changed via admin interface: user = %s , object_id = %s , object = %s , change_message = %s" %
-                         (ContentType.objects.get_for_model(object),
-                          request.user, object.pk, force_unicode(object), message))
+        self.log_object_event(request, 'changed', object, force_unicode(object),
+                              change_message=message)
         # FIXME: Remove this to disable logging into DB
         admin.ModelAdmin.log_change(self, request, object, message)
 
     def log_deletion(self, request, object, object_repr):
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("%s deleted via admin interface: user = %s , object_id = %s , object = %s" %
-                         (ContentType.objects.get_for_model(object),
-                          request.user, object.pk, object_repr))
+        self.log_object_event(request, 'deleted', object, object_repr)
         # FIXME: Remove this to disable logging into DB
         admin.ModelAdmin.log_deletion(self, request, object, object_repr)
 
+# Changelist columns computed from related objects or aggregates.
+#
+# related_column shows a value reached through relations, ie.
+# "application__person__username". annotated_column shows an aggregate
+# such as Count('course__application'). AnnotatedColumnsMixin collects the
+# columns in list_display and makes the changelist queryset join the
+# relations with select_related and add the aggregates with annotate(), so a
+# page renders in a constant number of queries. Both kinds of columns are
+# sortable.
+def related_column(path, short_description, boolean=False, order_field=None):
+    names = path.split('__')
+
+    def column(self, obj):
+        value = obj
+        for name in names:
+            try:
+                value = getattr(value, name)
+            except ObjectDoesNotExist:
+                value = None
+            if value is None:
+                break
+        if boolean:
+            return value is not None
+        return value
+    column.related_path = path
+    column.short_description = short_description
+    column.boolean = boolean
+    column.admin_order_field = order_field or path
+    return column
+
+def annotated_column(name, aggregate, short_description, boolean=False):
+    def column(self, obj):
+        return getattr(obj, name)
+    column.annotation = (name, aggregate)
+    column.short_description = short_description
+    column.boolean = boolean
+    column.admin_order_field = name
+    return column
+
+class AnnotatedColumnsMixin(object):
+    # Relations to follow besides the ones used by related columns, ie. the
+    # relations used by __unicode__ of foreign keys in list_display
+    list_select_related = ()
+
+    def __init__(self, *args, **kwargs):
+        super(AnnotatedColumnsMixin, self).__init__(*args, **kwargs)
+        related = list(self.list_select_related)
+        for column in self.get_list_columns():
+            path = getattr(column, 'related_path', None)
+            if path:
+                relation = self.relation_path(path)
+                if relation and relation not in related:
+                    related.append(relation)
+        # ChangeList applies it, an explicit list also keeps the changelist
+        # from following every non-null foreign key
+        self.list_select_related = tuple(related)
+
+    def get_list_columns(self):
+        for name in self.list_display:
+            yield getattr(self, name, None) if isinstance(name, basestring) else name
+
+    # The part of the lookup path that goes through relations
+    def relation_path(self, path):
+        opts = self.model._meta
+        relations = []
+        for name in path.split('__'):
+            field, model, direct, m2m = opts.get_field_by_name(name)
+            if direct:
+                related_model = field.rel.to if field.rel else None
+            else:
+                related_model = field.model
+            if related_model is None or m2m:
+                break
+            relations.append(name)
+            opts = related_model._meta
+        return '__'.join(relations)
+
+    def get_queryset(self, request):
+        queryset = super(AnnotatedColumnsMixin, self).get_queryset(request)
+        annotations = dict(column.annotation for column in self.get_list_columns()
+                           if hasattr(column, 'annotation'))
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return queryset
+
+# Returns the site name to display in mail subjects
+def get_site_name(request):
+    if Site._meta.installed:
+        return Site.objects.get_current().name
+    return RequestSite(request).name
+
+# Archive member name parts must not contain path separators
+def _archive_name(name):
+    return name.replace("/", "_").replace("\\", "_")
+
+def _file_chunks(storage, name):
+    f = storage.open(name)
+    try:
+        for chunk in f.chunks():
+            yield chunk
+    finally:
+        f.close()
+
+# Streams a ZIP archive of the permit files, one directory per event and
+# course, files are named after the applicants. The archive is generated
+# while it is being sent, whatever its size only one chunk of one file is
+# in memory. Permit rows are read up front so that no database cursor stays
+# open during the download.
+def permit_archive_response(permits, filename):
+    # The export code is only imported by the admin actions that use it
+    from kurs.zipstream import stream_zip
+    rows = list(permits.order_by('application__event', 'application__course',
+                                 'application__person__username')
+                .values_list('file', 'upload_date', 'application__person__username',
+                             'application__course__display_name',
+                             'application__event__display_name'))
+    storage = ApplicationPermit._meta.get_field('file').storage
+
+    def entries():
+        for name, upload_date, username, course, event in rows:
+            if not storage.exists(name):
+                log_event(logger, 'permit_missing', u"İzin yazısı bulunamadı",
+                          level=logging.WARNING, file=name)
+                continue
+            arcname = u"/".join(_archive_name(part) for part in (event, course, username))
+            yield (arcname + os.path.splitext(name)[1].lower(), _file_chunks(storage, name),
+                   localtime(upload_date).timetuple())
+
+    response = StreamingHttpResponse(stream_zip(entries()), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+# Streams the attendee list of the applications, see kurs/export.py
+def export_response(applications, format):
+    from kurs.export import export_applications
+    chunks, content_type = export_applications(applications, format)
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="applications.%s"' % format
+    return response
+
 # Admin page for events
-class EventAdmin(LoggingModelAdmin):
-    list_display = ('display_name', 'venue', 'allowed_choice_num')
+class EventAdmin(AnnotatedColumnsMixin, LoggingModelAdmin):
+    list_display = ('display_name', 'venue', 'allowed_choice_num', 'application_count')
     search_fields = ['display_name', 'venue']
+    actions = ['allocate_seats', 'download_permits', 'export_csv', 'export_xlsx']
+
+    application_count = annotated_column('application_count', Count('course__application'),
+                                         ugettext_lazy('applications'))
+
+    # Admin action to place the applicants that are not approved yet into
+    # the course they applied or one of their choices, according to course
+    # capacities. Placed applications are approved and their owners notified.
+    def allocate_seats(self, request, queryset):
+        from kurs.allocation import allocate_event
+        site_name = get_site_name(request)
+        for event in queryset:
+            allocation = allocate_event(event, request.user)
+
+            placed = Application.objects.filter(event=event,
+                                                approve_date=allocation.approve_date)
+            queue_approval_emails(placed, _("approved"), site_name)
+
+            batch = AuditBatch.objects.record(request.user, 'allocate', placed,
+                                              "placed=%d moved=%d" % (allocation.placed,
+                                                                      allocation.moved))
+            log_event(logger, 'allocate', u"Yerleştirme yapıldı", request, event=event,
+                      batch=batch, placed=allocation.placed, moved=allocation.moved,
+                      unplaced=allocation.unplaced)
+
+            self.message_user(request, _("%(event)s: %(placed)d applications placed, %(moved)d of them moved to one of their choices, %(unplaced)d could not be placed.") % {
+                "event": event, "placed": allocation.placed,
+                "moved": allocation.moved, "unplaced": allocation.unplaced})
+    allocate_seats.short_description = ugettext_lazy("Allocate seats of the selected events using application choices")
+
+    def download_permits(self, request, queryset):
+        log_event(logger, 'permit_download', u"İzin yazıları indirildi", request,
+                  events=list(queryset.values_list('id', flat=True)))
+        return permit_archive_response(
+            ApplicationPermit.objects.filter(application__event__in=queryset),
+            "permits.zip")
+    download_permits.short_description = ugettext_lazy("Download permit files of the selected events")
+
+    def export_csv(self, request, queryset):
+        return export_response(Application.objects.filter(event__in=queryset), 'csv')
+    export_csv.short_description = ugettext_lazy("Export applications of the selected events as CSV")
+
+    def export_xlsx(self, request, queryset):
+        return export_response(Application.objects.filter(event__in=queryset), 'xlsx')
+    export_xlsx.short_description = ugettext_lazy("Export applications of the selected events as XLSX")
 
 # Admin page for courses
 class CourseAdmin(LoggingModelAdmin):
     list_display = ('event', 'display_name', 'is_open', 'change_allowed_date',
-                    'start_date', 'end_date')
+                    'start_date', 'end_date', 'capacity', 'seats_taken')
     search_fields = ['display_name']
     list_filter = ['event']
     date_hierarchy = 'start_date'
@@ -77,8 +263,22 @@ class CourseAdmin(LoggingModelAdmin):
         if request.POST.get('post'):
             n = queryset.count()
             if n:
-                queryset.update(is_open = True if request.POST['status'] == 'True' else False)
-                # TODO: Log the change
+                is_open = request.POST['status'] == 'True'
+                # The changelist filters of queryset may not match the
+                # changed courses, they are picked by id before the update
+                with write_transaction():
+                    rows = list(queryset.values_list('pk', 'event_id'))
+                    courses = Course.objects.filter(pk__in=[pk for pk, event_id in rows])
+                    event_ids = set(event_id for pk, event_id in rows)
+                    batch = AuditBatch.objects.record(request.user, 'open' if is_open else 'close',
+                                                      courses, "is_open=%s" % is_open)
+                    courses.update(is_open = is_open, last_modified = tz_aware_now())
+                    Event.objects.touch(event_ids)
+                # update() does not send signals, invalidate the catalog here
+                bump_event_versions(event_ids)
+                log_event(logger, batch.action,
+                          u"Kurs başvuruya açıldı" if is_open else u"Kurs başvuruya kapatıldı",
+                          request, batch=batch, courses=n)
                 self.message_user(request, _("Successfully changed %(count)d %(items)s.") % {
                     "count": n, "items": model_ngettext(self.opts, n)
                 })
@@ -146,22 +346,31 @@ class HasApplicationPermitFilter(SimpleListFilter):
             return queryset
 
 # Admin page for applications
-class ApplicationAdmin(LoggingModelAdmin):
+class ApplicationAdmin(AnnotatedColumnsMixin, LoggingModelAdmin):
     list_display = ('person', 'course', 'application_date', 'has_applicationpermit',
                     'approved', 'approved_by', 'approve_date')
+    list_select_related = ('person', 'course__event', 'approved_by')
     search_fields = ['person__username', 'course__display_name', 'approved_by__username']
-    list_filter = ['course__event', 'approved', 'application_date', HasApplicationPermitFilter]
+    list_filter = ['event', 'approved', 'application_date', HasApplicationPermitFilter]
     date_hierarchy = 'application_date'
     ordering = ['person__id', '-application_date']
     inlines = [ApplicationPermitInline]
-    actions = ['change_application_approved']
+    actions = ['change_application_approved', 'download_permits', 'export_csv', 'export_xlsx']
+
+    # Applications added or moved to another course from the admin page do not
+    # go through seat reservation, so recount the seats of the courses involved
+    def save_model(self, request, obj, form, change):
+        LoggingModelAdmin.save_model(self, request, obj, form, change)
+        if 'course' in form.changed_data:
+            course_ids = [obj.course_id]
+            if change and form.initial.get('course'):
+                course_ids.append(form.initial['course'])
+            Course.objects.recount_seats(course_ids)
 
     # We want to see if user has uploaded an applicationpermit when
     # listing all applications
-    def has_applicationpermit(self, obj):
-        return True if obj.applicationpermit else False
-    has_applicationpermit.boolean = True
-    has_applicationpermit.short_description = ugettext_lazy('permit')
+    has_applicationpermit = related_column('applicationpermit', ugettext_lazy('permit'),
+                                           boolean=True, order_field='applicationpermit__id')
 
     # admin action to approve/reject a group of application
     # used in list applications page (admin/kurs/application)
@@ -173,40 +382,31 @@ class ApplicationAdmin(LoggingModelAdmin):
         if request.POST.get('post'):
             n = queryset.count()
             if n:
-                if request.POST['status'] == 'True':
-                    queryset.update(approved = True, approved_by=request.user, approve_date=tz_aware_now())
-                    status_string = _("approved")
-                else:
-                    queryset.update(approved = False, approved_by=None, approve_date=None)
-                    status_string = _("rejected")
-
-                # Log the change and send email to user
-                msg = []
-                for application in queryset.all():
-
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Başvuru %s: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                     (status_string, application, request.user,
-                                      request.META["REMOTE_ADDR"]))
-
-                    # Get the site name to display in mail subject
-                    if Site._meta.installed:
-                        site = Site.objects.get_current()
+                approved = request.POST['status'] == 'True'
+                # The changelist filters of queryset may not match the
+                # changed applications, they are picked by id before the update
+                with write_transaction():
+                    rows = list(queryset.values_list('pk', 'person_id'))
+                    ids = [pk for pk, person_id in rows]
+                    applications = Application.objects.filter(pk__in=ids)
+                    batch = AuditBatch.objects.record(request.user, 'approve' if approved else 'reject',
+                                                      applications, "approved=%s" % approved)
+                    if approved:
+                        applications.update(approved = True, approved_by=request.user, approve_date=tz_aware_now())
+                        status_string = _("approved")
                     else:
-                        site = RequestSite(request)
+                        applications.update(approved = False, approved_by=None, approve_date=None)
+                        status_string = _("rejected")
 
-                    # Prepeare email subject and body
-                    context = Context({'application': application.course,
-                                       'approval_date': application.approve_date,
-                                       'site': site.name,
-                                       'status_string': status_string})
-                    subject = render_to_string("admin/approval_email_subject.txt", context)
-                    body = render_to_string("admin/approval_email.txt", context)
+                # update() does not send signals, invalidate cached pages here
+                bump_user_versions(person_id for pk, person_id in rows)
 
-                    msg.append((subject, body, settings.DEFAULT_FROM_EMAIL, [application.person.email,]))
+                log_event(logger, batch.action, u"Başvuru %s" % status_string, request,
+                          batch=batch, applications=n)
 
-                # Send mail for all changed applications in bulk
-                send_mass_mail(tuple(msg))
+                # Mails are sent by the send_outbox command, do not
+                # block the admin request with SMTP
+                queue_approval_emails(applications, status_string, get_site_name(request))
 
                 # Display a notification in admin page
                 self.message_user(request, _("Successfully changed %(count)d %(items)s.") % {
@@ -243,16 +443,32 @@ class ApplicationAdmin(LoggingModelAdmin):
         context, current_app=self.admin_site.name)
     change_application_approved.short_description = ugettext_lazy("Change approval status of the selected applications")
 
+    def download_permits(self, request, queryset):
+        log_event(logger, 'permit_download', u"İzin yazıları indirildi", request,
+                  applications=list(queryset.values_list('id', flat=True)))
+        return permit_archive_response(
+            ApplicationPermit.objects.filter(application__in=queryset), "permits.zip")
+    download_permits.short_description = ugettext_lazy("Download permit files of the selected applications")
+
+    def export_csv(self, request, queryset):
+        return export_response(queryset, 'csv')
+    export_csv.short_description = ugettext_lazy("Export the selected applications as CSV")
+
+    def export_xlsx(self, request, queryset):
+        return export_response(queryset, 'xlsx')
+    export_xlsx.short_description = ugettext_lazy("Export the selected applications as XLSX")
+
 # Admin page for other application choices in this event
 class ApplicationChoicesAdmin(LoggingModelAdmin):
     list_display = ('person', 'event', 'choice_number', 'choice', 'last_update')
+    list_select_related = ('person', 'event', 'choice__event')
     search_fields = ['person__username', 'event__display_name', 'choice__display_name']
     list_filter = ['event', 'last_update']
     date_hierarchy = 'last_update'
     ordering = ['person__id', '-event__id', 'choice']
 
 # Admin page for applicationpermits
-class ApplicationPermitAdmin(LoggingModelAdmin):
+class ApplicationPermitAdmin(AnnotatedColumnsMixin, LoggingModelAdmin):
     list_display = ('get_application_person', 'get_application_event',
                     'get_application_course', 'upload_date', 'file')
     search_fields = ['file']
@@ -262,19 +478,44 @@ class ApplicationPermitAdmin(LoggingModelAdmin):
 
     # Model for applicationpermit only uses an applicationobject as 1-to-1 reference
     # Since we do not have the user/event/course information that this applicationpermit
-    # is used by, we need external functions to gather that information to present in
-    # admin list view
-    def get_application_person(self, obj):
-        return ("%s" % (obj.application.person.username))
-    get_application_person.short_description = ugettext_lazy('user')
-
-    def get_application_event(self, obj):
-        return ("%s" % (obj.application.course.event.display_name))
-    get_application_event.short_description = ugettext_lazy('event')
-
-    def get_application_course(self, obj):
-        return ("%s" % (obj.application.course.display_name))
-    get_application_course.short_description = ugettext_lazy('course')
+    # is used by, we need to follow the relations to present them in admin list view
+    get_application_person = related_column('application__person__username',
+                                            ugettext_lazy('user'))
+    get_application_event = related_column('application__event__display_name',
+                                           ugettext_lazy('event'))
+    get_application_course = related_column('application__course__display_name',
+                                            ugettext_lazy('course'))
+
+# Admin page to follow the e-mails queued for the send_outbox command
+class OutgoingEmailAdmin(admin.ModelAdmin):
+    list_display = ('to', 'subject', 'created', 'attempts', 'next_attempt', 'sent_date')
+    search_fields = ['to', 'subject']
+    list_filter = ['sent_date', 'created']
+    date_hierarchy = 'created'
+    ordering = ['-created']
+    readonly_fields = ('subject', 'body', 'from_email', 'to', 'created', 'next_attempt',
+                       'attempts', 'sent_date', 'last_error')
+
+# Admin page to browse the audit trail of bulk admin actions
+class AuditBatchAdmin(AnnotatedColumnsMixin, admin.ModelAdmin):
+    list_display = ('action_time', 'user', 'action', 'content_type', 'object_count',
+                    'change_message')
+    list_filter = ['action', 'content_type']
+    date_hierarchy = 'action_time'
+    ordering = ['-action_time']
+    readonly_fields = ('user', 'action', 'content_type', 'action_time', 'change_message',
+                       'object_ids')
+    list_select_related = ('user', 'content_type')
+
+    object_count = annotated_column('object_count', Count('entries'), ugettext_lazy('objects'))
+
+    def object_ids(self, obj):
+        return ", ".join(str(object_id) for object_id in
+                         obj.entries.order_by('object_id').values_list('object_id', flat=True))
+    object_ids.short_description = ugettext_lazy('object ids')
+
+    def has_add_permission(self, request):
+        return False
 
 # We like to edit user profile data inline from user detail page
 class UserProfileInline(admin.StackedInline):
@@ -292,7 +533,7 @@ class UserCommentInline(admin.StackedInline):
     extra=0
 
 # Define a new admin page for editing user details in order to use the inlines
-class UserAdmin(UserAdmin, LoggingModelAdmin):
+class UserAdmin(AnnotatedColumnsMixin, UserAdmin, LoggingModelAdmin):
     inlines = (UserProfileInline, UserCommentInline)
     list_display = ('username', 'email', 'first_name', 'last_name', 'is_active',
                     'is_staff', 'get_userprofile_company')
@@ -300,9 +541,7 @@ class UserAdmin(UserAdmin, LoggingModelAdmin):
 
     # We do not have the company information in standart user model,
     # we need to get that information from the related UserProfile model
-    def get_userprofile_company(self, obj):
-        return ("%s" % (obj.my_profile.company))
-    get_userprofile_company.short_description = ugettext_lazy('company')
+    get_userprofile_company = related_column('my_profile__company', ugettext_lazy('company'))
 
 # Re-register UserAdmin
 admin.site.unregister(User)
@@ -314,3 +553,5 @@ admin.site.register(Course, CourseAdmin)
 admin.site.register(Application, ApplicationAdmin)
 admin.site.register(ApplicationChoices, ApplicationChoicesAdmin)
 admin.site.register(ApplicationPermit, ApplicationPermitAdmin)
+admin.site.register(OutgoingEmail, OutgoingEmailAdmin)
+admin.site.register(AuditBatch, AuditBatchAdmin)
@@ -0,0 +1,179 @@
+# coding=utf-8
+
+# Admission control for the registration views.
+#
+# When a popular course opens every waiting user applies at the same
+# moment. Views decorated with admission_control let requests in at a
+# limited rate instead: a global token bucket (KURS_ADMISSION_RATE requests
+# per second, up to KURS_ADMISSION_BURST at once) and a bucket per user
+# (KURS_ADMISSION_USER_RATE, KURS_ADMISSION_USER_BURST).
+#
+# Requests that do not get in wait in a FIFO waiting room: they are answered
+# with a 503 page showing their position, with Retry-After and Refresh
+# headers so the browser comes back by itself. Users get in in the order they
+# arrived, newcomers do not pass users that are waiting, and users that stop
+# coming back lose their place. A user that gets in receives a ticket, a
+# signed cookie valid for KURS_ADMISSION_TICKET_SECONDS, and goes through the
+# rest of the registration (choices, permit) without waiting again. Users
+# going over their own rate get a 429 page.
+#
+# The state is kept in the process, every process admits its own share of
+# the traffic. KURS_ADMISSION_RATE = None turns admission control off.
+
+from functools import wraps
+import collections
+import threading
+import time
+
+from django.conf import settings
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+
+TICKET_COOKIE = 'kurs_admission'
+TICKET_SALT = 'kurs.admission'
+
+ADMITTED, QUEUED, THROTTLED = 'admitted', 'queued', 'throttled'
+
+# Waiting users that did not come back for this many seconds lose their place
+STALE_SECONDS = 30
+# Bounds of the Retry-After given to waiting users
+MIN_RETRY, MAX_RETRY = 1, 10
+# Number of per user buckets kept, the least recently used ones go first
+MAX_USER_BUCKETS = 10000
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes a token if there is one
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    # Seconds until the next token
+    def wait(self, now):
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class WaitingRoom(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.bucket = None
+        self.user_buckets = collections.OrderedDict()
+        # key -> [arrival number, last seen], in arrival order
+        self.queue = collections.OrderedDict()
+        self.arrivals = 0
+
+    def _bucket(self, now):
+        rate, burst = settings.KURS_ADMISSION_RATE, getattr(settings, 'KURS_ADMISSION_BURST', 1)
+        if self.bucket is None or (self.bucket.rate, self.bucket.burst) != (rate, burst):
+            self.bucket = TokenBucket(rate, burst, now)
+        return self.bucket
+
+    def _user_bucket(self, key, now):
+        bucket = self.user_buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(getattr(settings, 'KURS_ADMISSION_USER_RATE', 1),
+                                 getattr(settings, 'KURS_ADMISSION_USER_BURST', 5), now)
+            if len(self.user_buckets) >= MAX_USER_BUCKETS:
+                self.user_buckets.popitem(last=False)
+        self.user_buckets[key] = bucket
+        return bucket
+
+    # Position of the waiting key, 1 at the head of the queue. Users that
+    # left without being removed are counted until they reach the head.
+    def _position(self, key):
+        head = next(self.queue.itervalues())[0]
+        return self.queue[key][0] - head + 1
+
+    # Decides about a request of the client key at time now. ticket is True
+    # if the client holds a valid ticket. Returns (ADMITTED, None, None),
+    # (QUEUED, position, retry after) or (THROTTLED, None, retry after).
+    def admit(self, key, ticket, now):
+        with self.lock:
+            user_bucket = self._user_bucket(key, now)
+            if ticket:
+                if user_bucket.take(now):
+                    return ADMITTED, None, None
+                return THROTTLED, None, user_bucket.wait(now)
+
+            while self.queue and next(self.queue.itervalues())[1] < now - STALE_SECONDS:
+                self.queue.popitem(last=False)
+            if key not in self.queue:
+                self.arrivals += 1
+                self.queue[key] = [self.arrivals, now]
+            self.queue[key][1] = now
+
+            # The first waiting users get the free tokens
+            bucket = self._bucket(now)
+            position = self._position(key)
+            bucket.refill(now)
+            if position <= bucket.tokens:
+                if not user_bucket.take(now):
+                    return THROTTLED, None, user_bucket.wait(now)
+                bucket.take(now)
+                del self.queue[key]
+                return ADMITTED, None, None
+            retry_after = (position - bucket.tokens) / bucket.rate
+            return QUEUED, position, min(MAX_RETRY, max(MIN_RETRY, retry_after))
+
+    # Number of waiting clients
+    def waiting(self):
+        with self.lock:
+            return len(self.queue)
+
+waiting_room = WaitingRoom()
+
+def _client_key(request):
+    if request.user.is_authenticated():
+        return 'user:%d' % request.user.id
+    return 'ip:%s' % request.META.get('REMOTE_ADDR')
+
+def _has_ticket(request, key):
+    ticket = request.get_signed_cookie(TICKET_COOKIE, default=None, salt=TICKET_SALT,
+                                       max_age=settings.KURS_ADMISSION_TICKET_SECONDS)
+    return ticket == key
+
+def _wait_response(request, template, status, retry_after, position=None):
+    response = render_to_response(template, {'position': position,
+                                             'retry_after': int(retry_after + 0.999)},
+                                  context_instance=RequestContext(request))
+    response.status_code = status
+    response['Retry-After'] = str(int(retry_after + 0.999))
+    response['Refresh'] = response['Retry-After']
+    return response
+
+# Let requests to the view in through the waiting room
+def admission_control(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if getattr(settings, 'KURS_ADMISSION_RATE', None) is None:
+            return view(request, *args, **kwargs)
+        key = _client_key(request)
+        ticket = _has_ticket(request, key)
+        decision, position, retry_after = waiting_room.admit(key, ticket, time.time())
+        if decision == QUEUED:
+            return _wait_response(request, 'kurs/bekleme.html', 503, retry_after, position)
+        if decision == THROTTLED:
+            return _wait_response(request, 'kurs/bekleme.html', 429, retry_after)
+        response = view(request, *args, **kwargs)
+        # Failed requests do not get a ticket
+        if not ticket and response.status_code < 400:
+            response.set_signed_cookie(TICKET_COOKIE, key, salt=TICKET_SALT,
+                                       max_age=settings.KURS_ADMISSION_TICKET_SECONDS,
+                                       httponly=True)
+        return response
+    return wrapper
@@ -0,0 +1,176 @@
+# coding=utf-8
+
+# Seat allocation for an event using the ranked ApplicationChoices of the
+# applicants.
+#
+# Approved applications keep their seats. The remaining applicants are served
+# in order of application date (first come, first served) and every one of
+# them gets the first course in their list - the course they applied to,
+# followed by their choices - that still has a free seat. Because every course
+# ranks applicants the same way, this serial dictatorship gives the unique
+# stable matching for the event.
+#
+# Everything is loaded with three queries into flat arrays indexed by
+# position, the matching runs in O(applicants * choices) and the result is
+# written back with one UPDATE per target course (per chunk of ids).
+
+from array import array
+import sys
+import time
+
+from kurs.db import write_transaction
+from django.utils.timezone import now as tz_aware_now
+from kurs.models import Course, Application, ApplicationChoices
+from kurs.cache import bump_user_versions
+
+# Keep the number of parameters of a single statement below SQLite's limit
+UPDATE_CHUNK_SIZE = 500
+
+class EventAllocation(object):
+    def __init__(self, event):
+        self.event = event
+        self.timings = {}
+
+    # Read courses, applications and choices of the event into arrays. With
+    # lock the courses are locked until the transaction ends, no seat can be
+    # reserved before the result is saved (SQLite locks the whole database
+    # with write_transaction instead).
+    def load(self, lock=False):
+        started = time.time()
+
+        self.course_ids = array('i')
+        self.remaining = array('l')
+        course_index = {}
+        courses = Course.objects.filter(event=self.event)
+        if lock:
+            courses = courses.select_for_update()
+        for course_id, capacity in courses.order_by('id').values_list('id', 'capacity'):
+            course_index[course_id] = len(self.course_ids)
+            self.course_ids.append(course_id)
+            # A capacity of 0 means the course is not limited
+            self.remaining.append(capacity or sys.maxint)
+
+        # Applicants in priority order
+        self.application_ids = array('i')
+        self.applied_course = array('i')
+        self.approved = array('b')
+        persons = []
+        for application_id, person_id, course_id, approved in Application.objects \
+                .filter(event=self.event) \
+                .order_by('application_date', 'id') \
+                .values_list('id', 'person_id', 'course_id', 'approved'):
+            self.application_ids.append(application_id)
+            self.applied_course.append(course_index[course_id])
+            self.approved.append(1 if approved else 0)
+            persons.append(person_id)
+
+        # Ranked choices of every person, stored back to back in one array.
+        # choice_range maps a person to the (start, end) slice of its choices
+        self.choices = array('i')
+        self.choice_range = {}
+        current, start = None, 0
+        for person_id, choice_id in ApplicationChoices.objects.filter(event=self.event) \
+                .order_by('person', 'choice_number').values_list('person_id', 'choice_id'):
+            if person_id != current:
+                if current is not None:
+                    self.choice_range[current] = (start, len(self.choices))
+                current, start = person_id, len(self.choices)
+            if choice_id in course_index:
+                self.choices.append(course_index[choice_id])
+        if current is not None:
+            self.choice_range[current] = (start, len(self.choices))
+        self.persons = array('i', persons)
+
+        self.timings['load'] = time.time() - started
+
+    def solve(self):
+        started = time.time()
+        remaining = self.remaining
+        applied_course = self.applied_course
+        choices = self.choices
+        choice_range = self.choice_range
+
+        # Seats of approved applications are not up for allocation
+        for i, approved in enumerate(self.approved):
+            if approved:
+                remaining[applied_course[i]] -= 1
+
+        # Index of the course every applicant is placed in, -1 if none
+        self.assignment = assignment = array('i', [-1]) * len(self.application_ids)
+        for i, approved in enumerate(self.approved):
+            if approved:
+                assignment[i] = applied_course[i]
+                continue
+            course = applied_course[i]
+            if remaining[course] > 0:
+                remaining[course] -= 1
+                assignment[i] = course
+                continue
+            start, end = choice_range.get(self.persons[i], (0, 0))
+            for j in xrange(start, end):
+                course = choices[j]
+                if remaining[course] > 0:
+                    remaining[course] -= 1
+                    assignment[i] = course
+                    break
+
+        self.timings['solve'] = time.time() - started
+
+    # Newly placed applications grouped by the course they are placed in
+    def placements(self):
+        result = {}
+        for i, course in enumerate(self.assignment):
+            if course >= 0 and not self.approved[i]:
+                result.setdefault(self.course_ids[course], []).append(self.application_ids[i])
+        return result
+
+    @property
+    def placed(self):
+        return sum(1 for i, course in enumerate(self.assignment)
+                   if course >= 0 and not self.approved[i])
+
+    @property
+    def moved(self):
+        return sum(1 for i, course in enumerate(self.assignment)
+                   if course >= 0 and course != self.applied_course[i])
+
+    @property
+    def unplaced(self):
+        return sum(1 for course in self.assignment if course < 0)
+
+    # Move and approve the placed applications. Must run in the write
+    # transaction the allocation was loaded in, see allocate_event.
+    def save(self, approver):
+        started = time.time()
+        # All placed applications share the same approve_date, it can be
+        # used to find them afterwards
+        self.approve_date = now = tz_aware_now()
+        for course_id, application_ids in self.placements().items():
+            for i in range(0, len(application_ids), UPDATE_CHUNK_SIZE):
+                Application.objects.filter(id__in=application_ids[i:i + UPDATE_CHUNK_SIZE]) \
+                    .update(course=course_id, approved=True,
+                            approved_by=approver, approve_date=now)
+        Course.objects.recount_seats(self.course_ids)
+        self.timings['save'] = time.time() - started
+
+    # Invalidate the cached data of the placed applicants, after the commit
+    def invalidate(self):
+        bump_user_versions(self.persons[i] for i, course in enumerate(self.assignment)
+                           if course >= 0 and not self.approved[i])
+
+# Load, solve and save the allocation of an event in one go. The allocation
+# is loaded and saved in one write transaction: applications and seat
+# reservations committed in between would be counted by recount_seats without
+# having been allocated, and overbook the courses.
+def allocate_event(event, approver, dry_run=False):
+    allocation = EventAllocation(event)
+    if dry_run:
+        allocation.load()
+        allocation.solve()
+        return allocation
+    with write_transaction():
+        allocation.load(lock=True)
+        allocation.solve()
+        allocation.save(approver)
+    allocation.invalidate()
+    return allocation
@@ -0,0 +1,61 @@
+# coding=utf-8
+
+# SQLite backend tuned for concurrent writers.
+#
+# Every connection switches the database to WAL journaling, so readers do
+# not block the writer and the writer does not block readers, and waits up
+# to 'timeout' seconds for a lock instead of failing with "database is
+# locked". Transactions opened by kurs.db.write_transaction start with
+# BEGIN IMMEDIATE: the write lock is taken up front, a transaction that
+# reads before writing can not fail while upgrading its lock.
+#
+#     DATABASES = {'default': {'ENGINE': 'kurs.backends.sqlite3',
+#                              'NAME': ...,
+#                              'OPTIONS': {'timeout': 20,
+#                                          'pragmas': {'synchronous': 'FULL'}}}}
+#
+# 'pragmas' override or extend PRAGMAS.
+
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.db.backends.sqlite3.base import *
+
+# Applied in order to every new connection. synchronous=NORMAL is safe with
+# WAL, a power loss may only lose the last transactions. cache_size is in
+# KiB when negative.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+)
+
+DEFAULT_TIMEOUT = 20
+
+# Applies the pragmas to a sqlite3 connection, pragmas is a dict overriding
+# or extending PRAGMAS
+def configure_connection(connection, pragmas=None):
+    pragmas = dict(pragmas or {})
+    cursor = connection.cursor()
+    for name, value in PRAGMAS:
+        cursor.execute("PRAGMA %s = %s" % (name, pragmas.pop(name, value)))
+    for name, value in sorted(pragmas.items()):
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+    cursor.close()
+
+class DatabaseWrapper(SQLiteDatabaseWrapper):
+    # Set by kurs.db.write_transaction for the transaction being started
+    begin_immediate = False
+
+    def get_connection_params(self):
+        kwargs = super(DatabaseWrapper, self).get_connection_params()
+        self.pragmas = kwargs.pop('pragmas', None)
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        return kwargs
+
+    def init_connection_state(self):
+        super(DatabaseWrapper, self).init_connection_state()
+        configure_connection(self.connection, self.pragmas)
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE" if self.begin_immediate else "BEGIN")
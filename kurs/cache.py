@@ -0,0 +1,87 @@
+# coding=utf-8
+
+# Cache keys for data that belongs to a user.
+#
+# Every user has a version token stored in the cache, keys of the user's
+# cached data contain that token. Changing the token (bump_user_versions)
+# makes all of them unreachable at once, so nothing has to be deleted.
+# The tokens are random instead of counters, a token evicted from the cache
+# and created again can never bring back old entries.
+#
+# Keys also contain the catalog version, which changes whenever an event or
+# a course changes, since the pages of a user show course data too.
+#
+# Catalog data (events and courses) is versioned per event the same way,
+# see kurs/catalog.py.
+
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import translation
+
+USER_VERSION_KEY = "kurs:user:%s:version"
+CATALOG_VERSION_KEY = "kurs:catalog:version"
+EVENT_VERSION_KEY = "kurs:event:%s:version"
+# Event of every course, needed to find the version of a course before
+# reading it. It is kept up to date by the Course signals.
+COURSE_EVENT_KEY = "kurs:course:%s:event"
+
+# How long rendered user pages stay in the cache at most, in seconds
+USER_CACHE_TIMEOUT = getattr(settings, 'KURS_USER_CACHE_TIMEOUT', 600)
+
+def _new_version():
+    return uuid.uuid4().hex[:12]
+
+# Returns the current tokens for the given keys, creating missing ones
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            version = _new_version()
+            # Someone else may have created it in the meantime
+            if not cache.add(key, version, None):
+                version = cache.get(key, version)
+            versions[key] = version
+    return versions
+
+def bump_user_versions(user_ids):
+    cache.set_many(dict((USER_VERSION_KEY % user_id, _new_version())
+                        for user_id in set(user_ids)), None)
+
+# Invalidate the cached data of the events and the catalog as a whole
+def bump_event_versions(event_ids):
+    versions = dict((EVENT_VERSION_KEY % event_id, _new_version())
+                    for event_id in set(event_ids) if event_id is not None)
+    versions[CATALOG_VERSION_KEY] = _new_version()
+    cache.set_many(versions, None)
+
+def get_user_version(user_id):
+    key = USER_VERSION_KEY % user_id
+    return _get_versions([key])[key]
+
+def get_catalog_version():
+    return _get_versions([CATALOG_VERSION_KEY])[CATALOG_VERSION_KEY]
+
+def get_event_version(event_id):
+    key = EVENT_VERSION_KEY % event_id
+    return _get_versions([key])[key]
+
+def get_course_event(course_id):
+    return cache.get(COURSE_EVENT_KEY % course_id)
+
+def set_course_event(course_id, event_id):
+    if event_id is None:
+        cache.delete(COURSE_EVENT_KEY % course_id)
+    else:
+        cache.set(COURSE_EVENT_KEY % course_id, event_id, None)
+
+# Key for a piece of data of the user, it changes whenever the user's
+# applications, permits or choices or the catalog change. The active
+# language is part of the key since rendered fragments are translated.
+def user_cache_key(user_id, name):
+    user_key = USER_VERSION_KEY % user_id
+    versions = _get_versions([user_key, CATALOG_VERSION_KEY])
+    return "kurs:user:%s:%s:%s:%s:%s" % (user_id, name, versions[user_key],
+                                         versions[CATALOG_VERSION_KEY],
+                                         translation.get_language())
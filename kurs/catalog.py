@@ -0,0 +1,75 @@
+# coding=utf-8
+
+# Cached read access to the public catalog: events and their courses.
+#
+# Objects are cached under keys containing the version of their event (or the
+# catalog version for the event list), which is changed by the save/delete
+# signals of Event and Course and by admin actions that use update().
+# Anonymous catalog pages are served from here without touching the database,
+# except for the seats of the course detail page.
+#
+# Objects are read from the primary database: the version in the key was
+# changed there, a replica that lags behind would put the old rows under the
+# new key.
+#
+# seats_taken of the cached courses is not kept up to date, it changes with
+# every application. Read it from the database for display (see
+# kurs.views.course_is_full), reserve_seat is the authority.
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from kurs.cache import get_catalog_version, get_event_version, get_course_event, \
+    set_course_event
+from kurs.models import Event, Course
+
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'KURS_CATALOG_CACHE_TIMEOUT', 3600)
+
+# Marks ids which do not exist, so that they do not hit the database either
+MISSING = "missing"
+
+def get_event_list():
+    key = "kurs:catalog:events:%s" % get_catalog_version()
+    events = cache.get(key)
+    if events is None:
+        events = list(Event.objects.using(DEFAULT_DB_ALIAS).order_by('-id'))
+        cache.set(key, events, CATALOG_CACHE_TIMEOUT)
+    return events
+
+# Raises Event.DoesNotExist
+def get_event(event_id):
+    key = "kurs:event:%s:%s" % (event_id, get_event_version(event_id))
+    event = cache.get(key)
+    if event is None:
+        try:
+            event = Event.objects.using(DEFAULT_DB_ALIAS).get(pk=event_id)
+        except Event.DoesNotExist:
+            event = MISSING
+        cache.set(key, event, CATALOG_CACHE_TIMEOUT)
+    if event == MISSING:
+        raise Event.DoesNotExist
+    return event
+
+def get_courses(event_id):
+    key = "kurs:event:%s:%s:courses" % (event_id, get_event_version(event_id))
+    courses = cache.get(key)
+    if courses is None:
+        courses = list(Course.objects.using(DEFAULT_DB_ALIAS).filter(event=event_id)
+                       .select_related('event'))
+        cache.set(key, courses, CATALOG_CACHE_TIMEOUT)
+    return courses
+
+# Raises Course.DoesNotExist
+def get_course(course_id):
+    course_id = int(course_id)
+    event_id = get_course_event(course_id)
+    if event_id is not None:
+        course = cache.get("kurs:course:%s:%s" % (course_id, get_event_version(event_id)))
+        if course is not None:
+            return course
+
+    course = Course.objects.using(DEFAULT_DB_ALIAS).select_related('event').get(pk=course_id)
+    set_course_event(course_id, course.event_id)
+    cache.set("kurs:course:%s:%s" % (course_id, get_event_version(course.event_id)),
+              course, CATALOG_CACHE_TIMEOUT)
+    return course
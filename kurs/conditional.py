@@ -0,0 +1,37 @@
+# coding=utf-8
+
+# Conditional GET (ETag / Last-Modified) support for the public pages.
+#
+# Every page contains the sidebar of base.html, which depends on the user,
+# the language and the CSRF cookie, and the pending messages of the user.
+# The validators built here take those into account, views add the parts
+# describing their own content. Views compute the parts from the cache
+# only, so that refreshing an unchanged page is answered with a 304 without
+# rendering anything.
+
+import hashlib
+
+from django.conf import settings
+from django.contrib import messages
+from django.utils import translation
+
+# Pages showing pending messages consume them, they must always be rendered
+def _has_pending_messages(request):
+    return len(messages.get_messages(request)) > 0
+
+# Returns None if the page can not be validated
+def page_etag(request, *parts):
+    if _has_pending_messages(request):
+        return None
+    user = request.user
+    parts = [user.id, user.username, user.is_staff, translation.get_language(),
+             request.COOKIES.get(settings.CSRF_COOKIE_NAME)] + list(parts)
+    return hashlib.md5(u":".join(unicode(part) for part in parts).encode('utf-8')).hexdigest()
+
+# Last-Modified is only sent to anonymous users. Pages of authenticated
+# users depend on their own data as well, they are validated by ETag alone.
+def page_last_modified(request, *timestamps):
+    if request.user.is_authenticated() or _has_pending_messages(request):
+        return None
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
@@ -0,0 +1,20 @@
+# coding=utf-8
+
+from contextlib import contextmanager
+
+from django.db import transaction
+
+# transaction.atomic for transactions that write. On kurs.backends.sqlite3
+# the transaction takes the write lock when it starts (BEGIN IMMEDIATE), see
+# kurs/backends/sqlite3/base.py. Nested in another transaction it is a
+# savepoint like atomic, and other backends do not look at begin_immediate.
+@contextmanager
+def write_transaction(using=None):
+    connection = transaction.get_connection(using)
+    connection.begin_immediate = True
+    try:
+        with transaction.atomic(using):
+            connection.begin_immediate = False
+            yield
+    finally:
+        connection.begin_immediate = False
@@ -0,0 +1,42 @@
+# coding=utf-8
+
+# Per user index of applications: event id -> (course id, approved).
+#
+# A user applies to at most one course of an event, so the index answers
+# whether the user applied to an event or to a course without a query. It
+# is cached under the version token of the user (see kurs/cache.py), which
+# the Application signals and the bulk updates of applications change, and
+# kept on the request once read. It is read from the primary database, the
+# version was changed there.
+#
+# Use it for display and early checks only, Application.objects.apply is
+# the authority.
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from kurs.cache import get_user_version, USER_CACHE_TIMEOUT
+from kurs.models import Application
+
+def get_user_enrollments(user_id):
+    key = "kurs:user:%s:enrollments:%s" % (user_id, get_user_version(user_id))
+    enrollments = cache.get(key)
+    if enrollments is None:
+        enrollments = dict((event_id, (course_id, approved)) for event_id, course_id, approved in
+                           Application.objects.using(DEFAULT_DB_ALIAS).filter(person=user_id)
+                           .values_list('event_id', 'course_id', 'approved'))
+        cache.set(key, enrollments, USER_CACHE_TIMEOUT)
+    return enrollments
+
+# Enrollments of the user of the request, empty for anonymous users
+def get_enrollments(request):
+    if not hasattr(request, '_enrollments'):
+        if request.user.is_authenticated():
+            request._enrollments = get_user_enrollments(request.user.id)
+        else:
+            request._enrollments = {}
+    return request._enrollments
+
+# Course id the user applied to in the event, None if there is none
+def applied_course(request, event_id):
+    enrollment = get_enrollments(request).get(int(event_id))
+    return enrollment[0] if enrollment else None
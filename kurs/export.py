@@ -0,0 +1,187 @@
+# coding=utf-8
+
+# Attendee lists: applications with their course, event, applicant profile
+# and ranked choices, written as CSV or XLSX while they are being read.
+#
+# Applications are read in batches ordered by (course, id) using keyset
+# pagination, with two joined queries per batch: one for the applications
+# and their profiles and one for the choices of the batch. Memory use depends
+# on the batch size only, and no cursor stays open between batches, so a
+# long download does not keep the database locked.
+
+import codecs
+import csv
+import re
+from xml.sax.saxutils import escape
+
+from django.db.models import Max, Q
+from django.utils.timezone import localtime
+from django.utils.translation import ugettext as _
+from kurs.models import ApplicationChoices
+from kurs.zipstream import stream_zip
+from kurs.routers import replica_alias
+
+BATCH_SIZE = 2000
+
+APPLICATION_FIELDS = ('id', 'course_id', 'event_id',
+                      'event__display_name', 'course__display_name',
+                      'person_id', 'person__username', 'person__first_name',
+                      'person__last_name', 'person__email', 'person__my_profile__company',
+                      'person__my_profile__mobile', 'person__my_profile__phone',
+                      'application_date', 'approved', 'approve_date', 'applicationpermit__id')
+
+def _header(choice_count):
+    return [_("event"), _("course"), _("username"), _("first name"), _("last name"),
+            _("e-mail"), _("company"), _("mobile"), _("phone"), _("application date"),
+            _("approved"), _("approve date"), _("permit")] + \
+           [_("choice %d") % (number + 1) for number in range(choice_count)]
+
+# Yields the header followed by one row (a list of values) per application
+# of the queryset
+def application_rows(applications, batch_size=BATCH_SIZE):
+    choice_count = applications.aggregate(count=Max('event__allowed_choice_num'))['count'] or 0
+    yield _header(choice_count)
+
+    last = None
+    while True:
+        batch = applications.order_by('course', 'id')
+        if last is not None:
+            batch = batch.filter(Q(course__gt=last[0]) | Q(course=last[0], id__gt=last[1]))
+        batch = list(batch.values_list(*APPLICATION_FIELDS)[:batch_size])
+        if not batch:
+            return
+        last = (batch[-1][1], batch[-1][0])
+
+        # Ranked choices of the applicants of this batch, keyed by (event, person)
+        choices = {}
+        for event_id, person_id, course in ApplicationChoices.objects.using(applications.db) \
+                .filter(person__in=set(row[5] for row in batch),
+                        event__in=set(row[2] for row in batch)) \
+                .order_by('choice_number') \
+                .values_list('event_id', 'person_id', 'choice__display_name'):
+            choices.setdefault((event_id, person_id), []).append(course)
+
+        for (id, course_id, event_id, event, course, person_id, username, first_name,
+             last_name, email, company, mobile, phone, application_date, approved,
+             approve_date, permit_id) in batch:
+            ranked = choices.get((event_id, person_id), [])[:choice_count]
+            yield [event, course, username, first_name, last_name, email, company, mobile,
+                   phone, application_date and localtime(application_date),
+                   approved, approve_date and localtime(approve_date),
+                   permit_id is not None] + ranked + [None] * (choice_count - len(ranked))
+
+def _text(value):
+    if value is None:
+        return u""
+    if value is True or value is False:
+        return _("yes") if value else _("no")
+    if hasattr(value, 'strftime'):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    return unicode(value)
+
+# Joins small pieces into chunks of about chunk_size bytes, a response made
+# of a line per row would be written to the client one line at a time
+def _buffered(pieces, chunk_size=64 * 1024):
+    buffer, size = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+# csv.writer only writes to file-like objects, this one hands the line back
+class _Line(object):
+    def write(self, value):
+        return value
+
+# Yields the rows as UTF-8 CSV lines, starting with a byte order mark so that
+# spreadsheet programs detect the encoding
+def stream_csv(rows):
+    writer = csv.writer(_Line())
+    yield codecs.BOM_UTF8
+    for chunk in _buffered(writer.writerow([_text(value).encode('utf-8') for value in row])
+                           for row in rows):
+        yield chunk
+
+# Characters that are not allowed in XML documents
+_invalid_xml_re = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _column_name(index):
+    name = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+def _cell(reference, value):
+    if value is True or value is False:
+        return '<c r="%s" t="b"><v>%d</v></c>' % (reference, value)
+    if isinstance(value, (int, long)):
+        return '<c r="%s"><v>%d</v></c>' % (reference, value)
+    if isinstance(value, float):
+        return '<c r="%s"><v>%r</v></c>' % (reference, value)
+    text = escape(_invalid_xml_re.sub(u"", _text(value))).encode('utf-8')
+    return '<c r="%s" t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (reference, text)
+
+def _sheet(rows):
+    yield ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+           '<sheetData>')
+    for number, row in enumerate(rows):
+        yield '<row r="%d">%s</row>' % (number + 1, "".join(
+            _cell("%s%d" % (_column_name(column), number + 1), value)
+            for column, value in enumerate(row) if value is not None and value != ""))
+    yield '</sheetData></worksheet>'
+
+_XLSX_PARTS = (
+    ("[Content_Types].xml",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ("_rels/.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ("xl/workbook.xml",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+     'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+     '<sheets><sheet name="Applications" sheetId="1" r:id="rId1"/></sheets>'
+     '</workbook>'),
+    ("xl/_rels/workbook.xml.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+     '</Relationships>'),
+)
+
+# Yields the rows as an XLSX workbook with a single sheet. The sheet is
+# written with inline strings, there is no shared string table to build up
+# in memory.
+def stream_xlsx(rows):
+    entries = [(name, iter([content]), None) for name, content in _XLSX_PARTS]
+    entries.append(("xl/worksheets/sheet1.xml", _buffered(_sheet(rows)), None))
+    return stream_zip(entries)
+
+FORMATS = {
+    'csv': (stream_csv, 'text/csv; charset=utf-8'),
+    'xlsx': (stream_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+# Returns the chunks of the export of the applications in the format and
+# its content type. Applications are read from the replica database if there
+# is one, see kurs/routers.py.
+def export_applications(applications, format):
+    writer, content_type = FORMATS[format]
+    if replica_alias() is not None:
+        applications = applications.using(replica_alias())
+    return writer(application_rows(applications)), content_type
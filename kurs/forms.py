@@ -1,6 +1,8 @@
 # coding=utf-8
 
 from django import forms
+from django.forms.formsets import BaseFormSet, formset_factory
+from django.utils.functional import curry
 from kurs.models import ApplicationPermit, UserProfile, User
 from userena.forms import SignupForm
 from localflavor.tr.forms import TRPhoneNumberField
@@ -14,6 +16,34 @@ class ApplicationChoiceForm(forms.Form):
         super(ApplicationChoiceForm, self).__init__(*args, **kwargs)
         self.fields["choice"] = forms.ChoiceField(choices = choices)
 
+# A course can be chosen only once, the database would reject it anyway
+class BaseApplicationChoiceFormSet(BaseFormSet):
+    def clean(self):
+        if any(self.errors):
+            return
+        courses = [form.cleaned_data['choice'] for form in self.forms if form.cleaned_data]
+        if len(set(courses)) != len(courses):
+            raise forms.ValidationError(_("Each course can be chosen only once."))
+
+# Formset classes are built once for every list of course choices and
+# reused by later requests
+_choice_formsets = {}
+MAX_CHOICE_FORMSETS = 1000
+
+# Formset with max_num choice drop-downs, the previous choices of the user
+# are passed as initial data
+def get_choice_formset(max_num, choices):
+    key = (max_num, tuple(choices))
+    formset = _choice_formsets.get(key)
+    if formset is None:
+        if len(_choice_formsets) >= MAX_CHOICE_FORMSETS:
+            _choice_formsets.clear()
+        formset = formset_factory(ApplicationChoiceForm, formset=BaseApplicationChoiceFormSet,
+                                  max_num=max_num, extra=max_num)
+        formset.form = staticmethod(curry(ApplicationChoiceForm, choices=choices))
+        _choice_formsets[key] = formset
+    return formset
+
 # We want to only display a file field for applicationpermit upload form
 class ApplicationPermitForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,124 @@
+# coding=utf-8
+
+# Import time profile of the WSGI application: how long importing
+# lkd.wsgi and serving the first request take, and which modules the time
+# goes to.
+#
+#     python -m kurs.importtime --path /kurs/etkinlik/ --limit 20
+#
+# Imports are timed by replacing __import__, so this must run in a fresh
+# interpreter: modules imported before are not seen. The profile_startup
+# command runs it in child processes.
+
+from optparse import OptionParser
+from wsgiref.util import setup_testing_defaults
+import __builtin__
+import json
+import os
+import sys
+import time
+
+class ImportProfiler(object):
+    def __init__(self):
+        # module -> [cumulative seconds, own seconds]
+        self.times = {}
+        # Seconds spent in nested imports of the imports being timed
+        self._nested = []
+        self._import = None
+
+    def install(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def uninstall(self):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        module = sys.modules.get(name)
+        if module is not None and (not fromlist or
+                                   all(hasattr(module, item) for item in fromlist if item != '*')):
+            return self._import(name, globals, locals, fromlist, level)
+
+        self._nested.append(0.0)
+        started = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - started
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+            if not name:
+                # from . import x
+                name = (globals or {}).get('__package__') or (globals or {}).get('__name__', '?')
+            times = self.times.setdefault(name, [0.0, 0.0])
+            times[0] += elapsed
+            times[1] += elapsed - nested
+
+    # [(module, cumulative, own)] sorted by own time
+    def report(self, limit=None):
+        rows = sorted(((name, times[0], times[1]) for name, times in self.times.items()),
+                      key=lambda row: -row[2])
+        return rows[:limit] if limit else rows
+
+def _start_response(status, headers, exc_info=None):
+    _start_response.status = status
+
+# Imports the WSGI application and serves a GET request for path through it
+def profile(path):
+    profiler = ImportProfiler()
+    modules = len(sys.modules)
+    started = time.time()
+    profiler.install()
+    try:
+        from lkd.wsgi import application
+        imported = time.time()
+        wsgi_modules = len(sys.modules)
+
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET'}
+        setup_testing_defaults(environ)
+        response = application(environ, _start_response)
+        try:
+            for chunk in response:
+                pass
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        served = time.time()
+    finally:
+        profiler.uninstall()
+
+    return {'import_seconds': imported - started,
+            'first_request_seconds': served - imported,
+            'status': _start_response.status,
+            'modules_at_import': wsgi_modules - modules,
+            'modules_at_first_request': len(sys.modules) - wsgi_modules,
+            'modules': profiler.report()}
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--path', default='/kurs/etkinlik/',
+                      help='Path of the first request')
+    parser.add_option('--limit', type='int', default=25,
+                      help='Number of modules to list')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='Write the results as JSON')
+    options, args = parser.parse_args(argv)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lkd.settings")
+
+    results = profile(options.path)
+    if options.json:
+        results['modules'] = results['modules'][:options.limit]
+        json.dump(results, sys.stdout)
+        return
+    print "import lkd.wsgi: %.0f ms, %d modules" % (results['import_seconds'] * 1000,
+                                                   results['modules_at_import'])
+    print "first request (%s): %.0f ms, %d modules, %s" % (
+        options.path, results['first_request_seconds'] * 1000,
+        results['modules_at_first_request'], results['status'])
+    print "%10s %10s  %s" % ("own ms", "total ms", "module")
+    for name, cumulative, own in results['modules'][:options.limit]:
+        print "%10.1f %10.1f  %s" % (own * 1000, cumulative * 1000, name)
+
+if __name__ == '__main__':
+    main()
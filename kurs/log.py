@@ -0,0 +1,167 @@
+# coding=utf-8
+
+# Logging that does not block requests.
+#
+# QueueHandler puts records on a queue and returns, a background thread
+# formats and writes them with the wrapped handler. Formatting is lazy:
+# messages and their arguments are only formatted by the writer thread.
+# State changes are logged with log_event as structured events (action,
+# user, IP address and object ids) which JSONFormatter writes as one JSON
+# object per line.
+#
+# LogStatsMiddleware reports the time request threads spend in logging in
+# the X-Log-Records and X-Log-Time response headers.
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import Queue
+import threading
+import time
+
+from django.conf import settings
+
+_stats = threading.local()
+_queue_handlers = []
+
+class QueueHandler(logging.Handler):
+    # handler is the handler records are written with. When queue_size
+    # records are waiting, new records are dropped instead of blocking the
+    # caller, their number is kept in dropped.
+    def __init__(self, handler, queue_size=10000):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+        _queue_handlers.append(self)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.handler.setFormatter(fmt)
+
+    # The writer thread is started on first use, and again in processes
+    # forked after that, threads do not survive a fork
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.queue_size)
+            self._thread = threading.Thread(target=self._write, name="kurs-log-writer")
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        started = time.time()
+        if self._pid != os.getpid():
+            self._start()
+        # Tracebacks are formatted here, the frames may change afterwards
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        _stats.records = getattr(_stats, 'records', 0) + 1
+        _stats.time = getattr(_stats, 'time', 0) + time.time() - started
+
+    def _write(self):
+        queue = self.queue
+        while True:
+            record = queue.get()
+            try:
+                if record is None:
+                    return
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+            finally:
+                queue.task_done()
+
+    # Wait until the queued records are written
+    def flush(self):
+        if self._pid == os.getpid():
+            self.queue.join()
+        self.handler.flush()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(5)
+            self._pid = None
+        self.handler.close()
+        logging.Handler.close(self)
+
+# Write the remaining records before the process exits
+@atexit.register
+def _flush_queue_handlers():
+    for handler in _queue_handlers:
+        try:
+            handler.flush()
+        except Exception:
+            pass
+
+# RotatingFileHandler behind a queue, to be used in the LOGGING setting
+class QueueRotatingFileHandler(QueueHandler):
+    def __init__(self, filename, maxBytes=0, backupCount=0, queue_size=10000):
+        QueueHandler.__init__(self, logging.handlers.RotatingFileHandler(
+            filename, maxBytes=maxBytes, backupCount=backupCount, encoding='utf-8'),
+            queue_size)
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        message = record.getMessage()
+        if isinstance(message, str):
+            message = message.decode('utf-8', 'replace')
+        data = {'time': "%s.%03d" % (self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), record.msecs),
+                'level': record.levelname,
+                'logger': record.name,
+                'message': message}
+        data.update(getattr(record, 'event', {}))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=unicode, ensure_ascii=False, sort_keys=True)
+
+# Log a state change as a structured event. message is a fixed text, the
+# details go to fields. Model instances in fields are replaced by their
+# primary keys, other values are written as they are (or as text if they
+# can not be written as JSON).
+def log_event(logger, action, message, request=None, level=logging.INFO, **fields):
+    if not logger.isEnabledFor(level):
+        return
+    event = {'action': action}
+    if request is not None:
+        event['user'] = request.user.username if request.user.is_authenticated() else None
+        event['ip'] = request.META.get('REMOTE_ADDR')
+    for name, value in fields.items():
+        event[name] = getattr(value, 'pk', value)
+    logger.log(level, message, extra={'event': event})
+
+# Records logged and seconds spent in QueueHandler.emit by the current thread
+def log_stats():
+    return getattr(_stats, 'records', 0), getattr(_stats, 'time', 0)
+
+def reset_log_stats():
+    _stats.records = _stats.time = 0
+
+class LogStatsMiddleware(object):
+    def enabled(self):
+        return getattr(settings, 'KURS_LOG_STATS', settings.DEBUG)
+
+    def process_request(self, request):
+        reset_log_stats()
+
+    def process_response(self, request, response):
+        if self.enabled():
+            records, seconds = log_stats()
+            response['X-Log-Records'] = str(records)
+            response['X-Log-Time'] = "%.3f" % (seconds * 1000)
+        return response
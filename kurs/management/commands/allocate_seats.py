@@ -0,0 +1,52 @@
+# coding=utf-8
+
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+from kurs.allocation import allocate_event
+from kurs.models import Event, Application
+from kurs.notifications import queue_approval_emails
+
+# Same as the "allocate seats" admin action on events
+class Command(BaseCommand):
+    args = "<event_id event_id ...>"
+    help = "Place applicants into courses of the event according to their choices"
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only report the result, do not change any application'),
+        make_option('--approver', default=None,
+                    help='Username recorded as the approver of placed applications'),
+        make_option('--no-email', action='store_true', default=False,
+                    help='Do not queue approval e-mails'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError("Give at least one event id")
+
+        approver = None
+        if options['approver']:
+            try:
+                approver = User.objects.get(username=options['approver'])
+            except User.DoesNotExist:
+                raise CommandError("No such user: %s" % options['approver'])
+
+        for event_id in args:
+            try:
+                event = Event.objects.get(pk=event_id)
+            except (Event.DoesNotExist, ValueError):
+                raise CommandError("No such event: %s" % event_id)
+
+            allocation = allocate_event(event, approver, dry_run=options['dry_run'])
+
+            if not options['dry_run'] and not options['no_email']:
+                placed = Application.objects.filter(event=event,
+                                                    approve_date=allocation.approve_date)
+                queue_approval_emails(placed, _("approved"), Site.objects.get_current().name)
+
+            self.stdout.write("%s: placed=%d moved=%d unplaced=%d (%s)" % (
+                event, allocation.placed, allocation.moved, allocation.unplaced,
+                ", ".join("%s %.3fs" % item for item in sorted(allocation.timings.items()))))
@@ -0,0 +1,34 @@
+# coding=utf-8
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from kurs.models import Application, Course
+
+# Copies the event of the course into applications created before
+# Application had its own event column, in a single UPDATE. Users with more
+# than one application in an event are listed, they have to be resolved
+# before the unique (person, event) index can be created. See README.md.
+class Command(BaseCommand):
+    help = "Fill the event of existing applications from their courses"
+
+    def handle(self, *args, **options):
+        qn = connection.ops.quote_name
+        application_table = qn(Application._meta.db_table)
+        course_table = qn(Course._meta.db_table)
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE %(application)s SET event_id = "
+                "(SELECT event_id FROM %(course)s WHERE %(course)s.id = %(application)s.course_id) "
+                "WHERE event_id IS NULL OR event_id <> "
+                "(SELECT event_id FROM %(course)s WHERE %(course)s.id = %(application)s.course_id)" % {
+                    'application': application_table, 'course': course_table})
+            self.stdout.write("%d application(s) updated" % cursor.rowcount)
+
+        duplicates = Application.objects.values('person', 'event').annotate(n=Count('id')) \
+            .filter(n__gt=1).order_by('event', 'person')
+        for duplicate in duplicates:
+            self.stdout.write("user %(person)d has %(n)d applications in event %(event)d" % duplicate)
+        if duplicates:
+            raise CommandError("Remove the duplicate applications before creating the unique index")
@@ -0,0 +1,92 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import bisect
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now as tz_aware_now
+from kurs.allocation import allocate_event
+from kurs.models import Event, Course, Application, ApplicationChoices
+
+class Rollback(Exception):
+    pass
+
+# Generates an event with many applicants and ranked choices, runs the seat
+# allocation on it and reports the time spent loading, solving and saving.
+# Everything runs in a transaction which is rolled back at the end, the
+# database is left untouched.
+class Command(BaseCommand):
+    help = "Benchmark the seat allocation of an event"
+    option_list = BaseCommand.option_list + (
+        make_option('--applicants', type='int', default=50000),
+        make_option('--courses', type='int', default=40),
+        make_option('--choices', type='int', default=3,
+                    help='Number of ranked choices of every applicant'),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        rnd = random.Random(options['seed'])
+        prefix = "bench_allocation_%d_" % int(time.time())
+        n, course_num = options['applicants'], options['courses']
+
+        started = time.time()
+        event = Event.objects.create(display_name=prefix, venue="bench",
+                                     allowed_choice_num=options['choices'])
+        now = tz_aware_now()
+        # Total capacity is a bit less than the number of applicants
+        capacity = max(1, int(n * 0.9 / course_num))
+        Course.objects.bulk_create([Course(event=event, display_name="%s%d" % (prefix, i),
+                                           description="", agreement="", is_open=True,
+                                           change_allowed_date=now + timedelta(days=1),
+                                           start_date=now.date(), end_date=now.date(),
+                                           capacity=capacity)
+                                    for i in range(course_num)])
+        course_ids = list(Course.objects.filter(event=event).values_list('id', flat=True))
+
+        User.objects.bulk_create([User(username="%s%d" % (prefix, i), password="!")
+                                  for i in range(n)])
+        user_ids = list(User.objects.filter(username__startswith=prefix).values_list('id', flat=True))
+
+        # Popular courses get most of the first applications
+        cumulative, total = [], 0.0
+        for i in range(course_num):
+            total += 1.0 / (i + 1)
+            cumulative.append(total)
+        applications, choices = [], []
+        for i, user_id in enumerate(user_ids):
+            ranked = []
+            while len(ranked) < options['choices'] + 1:
+                course_id = course_ids[min(bisect.bisect(cumulative, rnd.random() * total), course_num - 1)]
+                if course_id not in ranked:
+                    ranked.append(course_id)
+            applications.append(Application(person_id=user_id, course_id=ranked[0], event=event,
+                                            application_date=now + timedelta(seconds=i)))
+            for number, course_id in enumerate(ranked[1:]):
+                choices.append(ApplicationChoices(person_id=user_id, event=event,
+                                                  choice_number=number + 1, choice_id=course_id))
+        Application.objects.bulk_create(applications)
+        ApplicationChoices.objects.bulk_create(choices)
+        self.stdout.write("generated %d applicants, %d courses, %d choices in %.2fs" %
+                          (n, course_num, len(choices), time.time() - started))
+
+        started = time.time()
+        allocation = allocate_event(event, None)
+        self.stdout.write("allocation: %.2fs total, %s" % (
+            time.time() - started,
+            ", ".join("%s %.3fs" % item for item in sorted(allocation.timings.items()))))
+        self.stdout.write("placed=%d moved=%d unplaced=%d" %
+                          (allocation.placed, allocation.moved, allocation.unplaced))
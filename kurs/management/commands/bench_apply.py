@@ -0,0 +1,137 @@
+# coding=utf-8
+
+from optparse import make_option
+import random
+import threading
+import time
+import Queue
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+from django.db.models import Count
+from django.utils.timezone import now as tz_aware_now
+from datetime import timedelta
+from kurs.models import Event, Course, Application, CourseFull, AlreadyApplied
+
+# Simulates the opening of a popular event: many users hitting
+# Application.objects.apply at the same time from parallel workers against
+# the configured database.
+# Every user sends one application for each course of the event in random
+# order, so all but one of them must be rejected as duplicates and no course
+# may accept more applications than its capacity.
+class Command(BaseCommand):
+    help = "Benchmark concurrent course applications against the local database"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=16,
+                    help='Number of parallel worker threads'),
+        make_option('--users', type='int', default=2000,
+                    help='Number of applicants'),
+        make_option('--courses', type='int', default=2,
+                    help='Number of courses in the benchmark event'),
+        make_option('--capacity', type='int', default=500,
+                    help='Capacity of each course'),
+        make_option('--seed', type='int', default=0),
+        make_option('--keep', action='store_true', default=False,
+                    help='Do not delete the generated event, courses and users'),
+    )
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        prefix = "bench_apply_%d_" % int(time.time())
+
+        event = Event.objects.create(display_name=prefix, venue="bench",
+                                     allowed_choice_num=options['courses'])
+        now = tz_aware_now()
+        courses = [Course.objects.create(event=event, display_name="%s%d" % (prefix, i),
+                                         description="", agreement="", is_open=True,
+                                         change_allowed_date=now + timedelta(days=1),
+                                         start_date=now.date(), end_date=now.date(),
+                                         capacity=options['capacity'])
+                   for i in range(options['courses'])]
+
+        User.objects.bulk_create([User(username="%s%d" % (prefix, i), password="!")
+                                  for i in range(options['users'])])
+        users = list(User.objects.filter(username__startswith=prefix))
+
+        jobs = [(user, course) for user in users for course in courses]
+        rnd.shuffle(jobs)
+        queue = Queue.Queue()
+        for job in jobs:
+            queue.put(job)
+
+        results = {'ok': 0, 'full': 0, 'duplicate': 0, 'error': 0}
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    try:
+                        user, course = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    started = time.time()
+                    try:
+                        Application.objects.apply(user, course)
+                        outcome = 'ok'
+                    except CourseFull:
+                        outcome = 'full'
+                    except AlreadyApplied:
+                        outcome = 'duplicate'
+                    except DatabaseError:
+                        outcome = 'error'
+                    elapsed = time.time() - started
+                    with lock:
+                        results[outcome] += 1
+                        latencies.append(elapsed)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for i in range(options['workers'])]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+
+        latencies.sort()
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+        self.stdout.write("workers=%d users=%d courses=%d capacity=%d" %
+                          (options['workers'], options['users'], options['courses'],
+                           options['capacity']))
+        self.stdout.write("requests=%d in %.2fs, %.1f applies/s" %
+                          (len(jobs), elapsed, len(jobs) / elapsed))
+        self.stdout.write("accepted=%(ok)d full=%(full)d duplicate=%(duplicate)d error=%(error)d" % results)
+        self.stdout.write("latency ms p50=%.1f p95=%.1f p99=%.1f max=%.1f" %
+                          (percentile(0.50), percentile(0.95), percentile(0.99),
+                           latencies[-1] * 1000))
+
+        # Check the invariants the reservation engine must hold
+        problems = []
+        counts = dict(Application.objects.filter(event=event)
+                      .values_list('course').annotate(Count('id')))
+        for course in Course.objects.filter(event=event):
+            taken = counts.get(course.id, 0)
+            if taken != course.seats_taken:
+                problems.append("%s: seats_taken=%d but %d applications" %
+                                (course.display_name, course.seats_taken, taken))
+            if taken > course.capacity:
+                problems.append("%s: %d applications over capacity %d" %
+                                (course.display_name, taken, course.capacity))
+        duplicates = Application.objects.filter(event=event).values('person') \
+            .annotate(n=Count('id')).filter(n__gt=1).count()
+        if duplicates:
+            problems.append("%d users applied to more than one course" % duplicates)
+
+        for problem in problems:
+            self.stderr.write(problem)
+        if not problems:
+            self.stdout.write("invariants hold: no overbooking, no duplicate applications")
+
+        if not options['keep']:
+            event.delete()
+            User.objects.filter(username__startswith=prefix).delete()
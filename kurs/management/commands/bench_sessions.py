@@ -0,0 +1,125 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import re
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils.timezone import now as tz_aware_now
+from kurs.models import Event, Course, Application
+from kurs.querystats import fingerprint
+from kurs.storage import permit_storage
+
+PASSWORD = "bench"
+
+ENGINES = ('django.contrib.sessions.backends.db', 'kurs.sessions')
+
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+_statement_re = re.compile(r'^\W*(\w+)')
+_table_re = re.compile(r'(?:FROM|INTO|UPDATE)\s+"(\w+)"', re.IGNORECASE)
+
+# One applicant: logs in, applies to a course, saves ranked choices,
+# uploads a permit, checks the application list, cancels the application
+# and logs out. Every step that changes something adds a message.
+def apply_flow(client, username, event, courses):
+    client.login(username=username, password=PASSWORD)
+    client.get("/kurs/kurs/%d/basvur/" % courses[0].id, follow=True)
+    client.post("/kurs/etkinlik/%d/tercihler/edit/" % event.id,
+                {'form-TOTAL_FORMS': 1, 'form-INITIAL_FORMS': 0,
+                 'form-MAX_NUM_FORMS': event.allowed_choice_num,
+                 'form-0-choice': courses[1].id}, follow=True)
+    application_id = Application.objects.filter(person__username=username, event=event) \
+        .values_list('id', flat=True).first()
+    client.post("/kurs/basvurular/%d/izin/" % application_id,
+                {'file': SimpleUploadedFile("permit.pdf", "%PDF-1.4\n%%EOF\n")}, follow=True)
+    client.get("/kurs/basvurular/")
+    client.post("/kurs/basvurular/%d/iptal/" % application_id, follow=True)
+    client.logout()
+
+# Counts the statements of the queries by kind, for the session table and
+# for the rest
+def classify(queries):
+    counts = {}
+    for query in queries:
+        sql = fingerprint(query['sql'])
+        statement = _statement_re.match(sql).group(1).upper()
+        if statement in TRANSACTION_STATEMENTS:
+            continue
+        table = _table_re.search(sql)
+        target = 'session' if table and table.group(1) == 'django_session' else 'other'
+        key = (target, 'read' if statement == 'SELECT' else 'write')
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# Runs the apply flow of --users applicants with every session engine and
+# reports the database reads and writes per flow, of the session table and
+# of everything else. Messages use the MESSAGE_STORAGE setting, session
+# writes they cause are counted with the session.
+class Command(BaseCommand):
+    help = "Count the database writes of the apply flow per session engine"
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=50,
+                    help='Number of applicants per session engine'),
+        make_option('--engine', action='append', dest='engines',
+                    help='Session engine to measure, can be repeated'),
+    )
+
+    def handle(self, *args, **options):
+        with override_settings(PASSWORD_HASHERS=('django.contrib.auth.hashers.MD5PasswordHasher',)):
+            storage_location = permit_storage.location
+            permit_storage.location = tempfile.mkdtemp()
+            try:
+                self.run(options)
+            finally:
+                shutil.rmtree(permit_storage.location)
+                permit_storage.location = storage_location
+
+    def run(self, options):
+        prefix = "bench_sessions_%d_" % int(time.time())
+        now = tz_aware_now()
+        event = Event.objects.create(display_name=prefix, venue="bench", allowed_choice_num=2)
+        courses = [Course.objects.create(event=event, display_name="%s%d" % (prefix, i),
+                                         description="", agreement="", is_open=True,
+                                         change_allowed_date=now + timedelta(days=1),
+                                         start_date=now.date(), end_date=now.date(),
+                                         capacity=options['users'])
+                   for i in range(2)]
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([User(username="%s%d" % (prefix, i), password=password)
+                                  for i in range(options['users'])])
+
+        self.stdout.write("%-40s %9s %9s %9s %9s %8s" % ("engine (per flow)", "sess rd", "sess wr",
+                                                          "other rd", "other wr", "ms"))
+        try:
+            for engine in options['engines'] or ENGINES:
+                cache.clear()
+                counts = {}
+                started = time.time()
+                with override_settings(SESSION_ENGINE=engine):
+                    for i in range(options['users']):
+                        client = Client()
+                        with CaptureQueriesContext(connection) as queries:
+                            apply_flow(client, "%s%d" % (prefix, i), event, courses)
+                        for key, count in classify(queries.captured_queries).items():
+                            counts[key] = counts.get(key, 0) + count
+                elapsed = time.time() - started
+                users = float(options['users'])
+                self.stdout.write("%-40s %9.1f %9.1f %9.1f %9.1f %8.1f" % (
+                    engine, counts.get(('session', 'read'), 0) / users,
+                    counts.get(('session', 'write'), 0) / users,
+                    counts.get(('other', 'read'), 0) / users,
+                    counts.get(('other', 'write'), 0) / users, elapsed * 1000 / users))
+        finally:
+            event.delete()
+            User.objects.filter(username__startswith=prefix).delete()
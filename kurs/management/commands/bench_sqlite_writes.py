@@ -0,0 +1,96 @@
+# coding=utf-8
+
+from optparse import make_option
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from kurs.backends.sqlite3.base import configure_connection, DEFAULT_TIMEOUT
+
+# Stock sqlite3 backend: rollback journal, 5 second busy timeout, BEGIN
+# DEFERRED. Tuned: kurs.backends.sqlite3 with BEGIN IMMEDIATE.
+MODES = (
+    ('default', {'timeout': 5, 'pragmas': None, 'begin': "BEGIN"}),
+    ('tuned', {'timeout': DEFAULT_TIMEOUT, 'pragmas': {}, 'begin': "BEGIN IMMEDIATE"}),
+)
+
+# Concurrent writers on a scratch SQLite database, with the settings of the
+# stock backend and with those of kurs.backends.sqlite3. Every transaction
+# looks like an application: it reads the course, reserves a seat and
+# inserts a row. Reports committed transactions per second and the number of
+# transactions that failed with "database is locked".
+class Command(BaseCommand):
+    help = "Benchmark concurrent SQLite writers before and after tuning"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=16),
+        make_option('--seconds', type='float', default=5.0,
+                    help='Duration of each run'),
+    )
+
+    def handle(self, *args, **options):
+        for name, mode in MODES:
+            directory = tempfile.mkdtemp()
+            try:
+                committed, locked, elapsed = self.run(os.path.join(directory, "bench.db"),
+                                                      mode, options)
+            finally:
+                shutil.rmtree(directory)
+            self.stdout.write("%-8s workers=%d %.1f writes/s, %d committed, %d locked" %
+                              (name, options['workers'], committed / elapsed, committed, locked))
+
+    def connect(self, path, mode):
+        connection = sqlite3.connect(path, timeout=mode['timeout'], isolation_level=None,
+                                     check_same_thread=False)
+        if mode['pragmas'] is not None:
+            configure_connection(connection, mode['pragmas'])
+        return connection
+
+    def run(self, path, mode, options):
+        connection = self.connect(path, mode)
+        connection.executescript(
+            "CREATE TABLE course (id integer PRIMARY KEY, seats_taken integer NOT NULL);"
+            "CREATE TABLE application (id integer PRIMARY KEY, person_id integer NOT NULL,"
+            " course_id integer NOT NULL, application_date text NOT NULL);"
+            "INSERT INTO course (id, seats_taken) VALUES (1, 0);")
+        connection.close()
+
+        counts = {'committed': 0, 'locked': 0}
+        lock = threading.Lock()
+        deadline = time.time() + options['seconds']
+
+        def worker(number):
+            connection = self.connect(path, mode)
+            cursor = connection.cursor()
+            person = number * 1000000
+            while time.time() < deadline:
+                person += 1
+                try:
+                    cursor.execute(mode['begin'])
+                    cursor.execute("SELECT seats_taken FROM course WHERE id = 1").fetchone()
+                    cursor.execute("UPDATE course SET seats_taken = seats_taken + 1 WHERE id = 1")
+                    cursor.execute("INSERT INTO application (person_id, course_id, application_date)"
+                                   " VALUES (?, 1, datetime('now'))", (person,))
+                    cursor.execute("COMMIT")
+                    outcome = 'committed'
+                except sqlite3.OperationalError:
+                    try:
+                        cursor.execute("ROLLBACK")
+                    except sqlite3.OperationalError:
+                        pass
+                    outcome = 'locked'
+                with lock:
+                    counts[outcome] += 1
+            connection.close()
+
+        threads = [threading.Thread(target=worker, args=(number,))
+                   for number in range(options['workers'])]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts['committed'], counts['locked'], time.time() - started
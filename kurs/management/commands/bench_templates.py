@@ -0,0 +1,87 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.template import RequestContext
+from django.template.loader import get_template
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.timezone import now as tz_aware_now
+from kurs.cache import bump_event_versions
+from kurs.models import Event, Course, Application
+
+DISK_LOADERS = ('django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader')
+CACHED_LOADERS = (('django.template.loaders.cached.Loader', DISK_LOADERS),)
+
+# (name, template loaders, whether fragments stay in the cache)
+MODES = (('disk', DISK_LOADERS, False),
+         ('cached loader', CACHED_LOADERS, False),
+         ('cached + fragments', CACHED_LOADERS, True))
+
+# Template and context of every page, with rows of unsaved objects: the
+# database is not touched
+def pages(rows):
+    now = tz_aware_now()
+    events = [Event(id=1000000 + i, display_name=u"Etkinlik %d" % i, venue=u"Ankara")
+              for i in range(rows)]
+    event = events[0]
+    courses = [Course(id=1000000 + i, event=event, display_name=u"Kurs %d" % i,
+                      description=u"Açıklama\n" * 5, agreement=u"Önkoşul", is_open=True,
+                      change_allowed_date=now + timedelta(days=i % 3 - 1),
+                      start_date=now.date(), end_date=now.date(), capacity=30)
+               for i in range(rows)]
+    applications = []
+    for i, course in enumerate(courses):
+        application = Application(id=1000000 + i, course=course, event=event,
+                                  application_date=now, approved=i % 2 == 0)
+        application.can_change = not application.approved and course.can_be_applied_at(now)
+        # No permit, as select_related leaves it
+        application._applicationpermit_cache = None
+        applications.append(application)
+    return [('kurs/event_list.html', {'event_list': events}),
+            ('kurs/list_courses.html', {'event': event.display_name, 'event_id': event.id,
+                                        'course_list': courses}),
+            ('kurs/course_detail.html', {'course': courses[0], 'object': courses[0]}),
+            ('kurs/application_table.html', {'application_list': applications})]
+
+# Renders the kurs pages with large lists through the template loaders from
+# disk and with the cached loader, with fragments rendered every time and
+# kept in the cache, and reports the mean render time per page. Catalog
+# versions of the generated event ids are changed to render fragments
+# again, the cache is not cleared.
+class Command(BaseCommand):
+    help = "Benchmark template rendering of the kurs pages"
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000,
+                    help='Number of events, courses and applications in the lists'),
+        make_option('--repeat', type='int', default=20,
+                    help='Number of renders of every page in every mode'),
+    )
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        event_ids = [1000000]
+
+        self.stdout.write("%-30s %s" % ("template (ms)", " ".join("%18s" % name for name, _, _ in MODES)))
+        results = dict((name, []) for name, _ in pages(1))
+        for mode, loaders, warm in MODES:
+            with override_settings(TEMPLATE_LOADERS=loaders, TEMPLATE_DEBUG=False):
+                for name, context in pages(options['rows']):
+                    # The first render fills the loader and fragment caches
+                    get_template(name).render(RequestContext(request, context))
+                    elapsed = 0
+                    for i in range(options['repeat']):
+                        if not warm:
+                            bump_event_versions(event_ids)
+                        started = time.time()
+                        get_template(name).render(RequestContext(request, context))
+                        elapsed += time.time() - started
+                    results[name].append(elapsed * 1000 / options['repeat'])
+        for name, _ in pages(1):
+            self.stdout.write("%-30s %s" % (name, " ".join("%18.2f" % ms for ms in results[name])))
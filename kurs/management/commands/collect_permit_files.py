@@ -0,0 +1,75 @@
+# coding=utf-8
+
+from optparse import make_option
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from kurs.models import ApplicationPermit
+
+# Deletes permit files no permit refers to and reports permits whose files
+# are missing. Files are not deleted with their permits, run it from cron.
+#
+# Permits uploaded before files were stored by content can be moved to the
+# content-addressed names with --migrate, duplicates of the same content are
+# then stored once.
+class Command(BaseCommand):
+    help = "Delete unreferenced permit files"
+    option_list = BaseCommand.option_list + (
+        make_option('--migrate', action='store_true', default=False,
+                    help='Move files of older permits to content-addressed names'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only report what would be done'),
+        make_option('--min-age', type='int', default=3600,
+                    help='Leave files younger than this many seconds alone, they may belong to uploads in progress'),
+    )
+
+    def handle(self, *args, **options):
+        self.storage = ApplicationPermit._meta.get_field('file').storage
+        if options['migrate']:
+            self.migrate(options)
+        self.collect(options)
+
+    def migrate(self, options):
+        moved = 0
+        for name in ApplicationPermit.objects.values_list('file', flat=True).distinct():
+            if not name or not self.storage.exists(name):
+                continue
+            with self.storage.open(name) as content:
+                address = self.storage.address(self.storage.content_hash(content), name)
+                if address == name:
+                    continue
+                if not options['dry_run']:
+                    self.storage.save(name, content)
+            # update() does not send signals, the old file is deleted below
+            if not options['dry_run']:
+                ApplicationPermit.objects.filter(file=name).update(file=address)
+            moved += 1
+        self.stdout.write("%d file(s) moved to content-addressed names" % moved)
+
+    def collect(self, options):
+        referenced = set(ApplicationPermit.objects.values_list('file', flat=True))
+        root = self.storage.path(self.storage.prefix)
+        now = time.time()
+        deleted = size = 0
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, self.storage.location).replace(os.sep, '/')
+                if name in referenced or now - os.path.getmtime(path) < options['min_age']:
+                    continue
+                # An identical upload may have reused the file since the
+                # references were read
+                if ApplicationPermit.objects.filter(file=name).exists():
+                    continue
+                size += os.path.getsize(path)
+                deleted += 1
+                if int(options['verbosity']) > 1:
+                    self.stdout.write("deleting %s" % name)
+                if not options['dry_run']:
+                    self.storage.delete(name)
+        self.stdout.write("%d unreferenced file(s), %d bytes deleted" % (deleted, size))
+
+        for name in sorted(referenced):
+            if name and not self.storage.exists(name):
+                self.stdout.write("missing: %s" % name)
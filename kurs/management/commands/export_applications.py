@@ -0,0 +1,48 @@
+# coding=utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from kurs.models import Application
+from kurs.export import export_applications, FORMATS
+
+# Writes the attendee list of events: applications with course, applicant
+# profile and ranked choices.
+#
+#     python manage.py export_applications --event 3 --format xlsx --output event3.xlsx
+class Command(BaseCommand):
+    help = "Export applications with profiles and choices as CSV or XLSX"
+    option_list = BaseCommand.option_list + (
+        make_option('--event', action='append', type='int', dest='events', default=[],
+                    help='Only export applications of this event, can be repeated'),
+        make_option('--approved', action='store_true', default=False,
+                    help='Only export approved applications'),
+        make_option('--format', default='csv', choices=sorted(FORMATS.keys()),
+                    help='csv or xlsx'),
+        make_option('--output', default=None,
+                    help='Output file, standard output by default'),
+    )
+
+    def handle(self, *args, **options):
+        applications = Application.objects.all()
+        if options['events']:
+            applications = applications.filter(event__in=options['events'])
+        if options['approved']:
+            applications = applications.filter(approved=True)
+
+        chunks, content_type = export_applications(applications, options['format'])
+        if options['output']:
+            try:
+                output = open(options['output'], 'wb')
+            except IOError as e:
+                raise CommandError(e)
+        else:
+            # Chunks are not lines, no line endings must be added
+            output = self.stdout
+            output.ending = None
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is not self.stdout:
+                output.close()
@@ -0,0 +1,214 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import bisect
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.timezone import now as tz_aware_now
+from kurs.cache import bump_event_versions
+from kurs.models import Event, Course, Application, ApplicationChoices, ApplicationPermit, \
+    UserProfile, UserComment
+from kurs.storage import permit_storage
+
+COMPANIES = [u"Acme", u"Pardus", u"Linux Kullanıcıları Derneği", u"ODTÜ", u"Boğaziçi Üniversitesi",
+             u"İTÜ", u"Hacettepe Üniversitesi", u"Serbest"]
+FIRST_NAMES = [u"Ahmet", u"Ayşe", u"Mehmet", u"Fatma", u"Mustafa", u"Zeynep", u"Ali", u"Elif",
+               u"Hüseyin", u"Emine", u"Can", u"Şule", u"Oğuz", u"Gül"]
+LAST_NAMES = [u"Yılmaz", u"Kaya", u"Demir", u"Şahin", u"Çelik", u"Yıldız", u"Öztürk", u"Aydın",
+              u"Arslan", u"Doğan", u"Koç", u"Kurt"]
+
+# Zipf-like weights, the first items are chosen most often
+def cumulative_weights(count, skew):
+    weights, total = [], 0.0
+    for i in range(count):
+        total += 1.0 / (i + 1) ** skew
+        weights.append(total)
+    return weights
+
+def pick(rnd, items, weights):
+    return items[min(bisect.bisect(weights, rnd.random() * weights[-1]), len(items) - 1)]
+
+# Inserts rows, tuples of values of the named fields, with a single
+# executemany. Building model instances for bulk_create takes most of the
+# time at this scale.
+def insert_rows(model, names, rows):
+    if not rows:
+        return
+    qn = connection.ops.quote_name
+    columns = [qn(model._meta.get_field(name).column) for name in names]
+    connection.cursor().executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table), ", ".join(columns), ", ".join(["%s"] * len(columns))), rows)
+
+# Fills the database with users, profiles, comments, events, courses,
+# applications, ranked choices and permits for benchmarking. The same seed
+# always generates the same data.
+#
+# Rows are written with bulk inserts, one transaction per batch of users.
+# Users are created directly, without the userena signup (no activation
+# keys, no per-object permissions) and all share one password hash. Permits
+# all refer to a single stored file. Use a scratch database, generated data
+# is not removed.
+class Command(BaseCommand):
+    help = "Generate a large synthetic dataset for benchmarks"
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', default=100000),
+        make_option('--events', type='int', default=10),
+        make_option('--courses', type='int', default=30,
+                    help='Number of courses of every event'),
+        make_option('--choices', type='int', default=3,
+                    help='Number of ranked choices allowed in every event'),
+        make_option('--applications', type='float', default=1.5,
+                    help='Average number of events a user applies to'),
+        make_option('--permits', type='float', default=0.6,
+                    help='Share of applications with a permit'),
+        make_option('--comments', type='float', default=0.05,
+                    help='Share of users with an admin comment'),
+        make_option('--skew', type='float', default=1.0,
+                    help='Exponent of the popularity distribution of events and courses'),
+        make_option('--batch-size', type='int', default=5000,
+                    help='Number of users written in one transaction'),
+        make_option('--password', default=None,
+                    help='Password of the generated users, unusable by default'),
+        make_option('--prefix', default="dataset"),
+        make_option('--seed', type='int', default=0),
+    )
+
+    def handle(self, *args, **options):
+        self.rnd = random.Random(options['seed'])
+        self.options = options
+        self.prefix = options['prefix']
+        if User.objects.filter(username__startswith=self.prefix + "_").exists():
+            raise CommandError("Users named %s_* exist already, use another --prefix" % self.prefix)
+        self.now = tz_aware_now()
+        self.counts = dict.fromkeys(('users', 'applications', 'choices', 'permits', 'comments'), 0)
+
+        started = time.time()
+        self.create_catalog()
+        self.permit_file = permit_storage.save(
+            "permit.pdf", ContentFile("%PDF-1.4\n" + "0" * 20000 + "\n%%EOF\n"))
+        if options['password'] is None:
+            self.password = make_password(None)
+        else:
+            self.password = make_password(options['password'])
+
+        size = options['batch_size']
+        for first in range(0, options['users'], size):
+            with transaction.atomic():
+                self.create_users(first, min(first + size, options['users']))
+            if int(options['verbosity']) > 1:
+                self.stdout.write("%d users, %.1fs" % (self.counts['users'], time.time() - started))
+
+        Course.objects.recount_seats(self.course_ids)
+        bump_event_versions(self.event_ids)
+        self.stdout.write("%(users)d users, %(applications)d applications, %(choices)d choices, "
+                          "%(permits)d permits, %(comments)d comments" % self.counts)
+        self.stdout.write("%d events, %d courses in %.1fs" % (len(self.event_ids), len(self.course_ids),
+                                                             time.time() - started))
+
+    # Half of the events are over, their applications are approved. Popular
+    # courses fill up, later applicants go to one of their other choices.
+    def create_catalog(self):
+        options = self.options
+        expected = options['users'] * options['applications'] / max(options['events'], 1)
+        self.events = []
+        self.free_seats = {}
+        for number in range(options['events']):
+            past = number % 2 == 1
+            event = Event.objects.create(display_name="%s event %d" % (self.prefix, number),
+                                         venue="venue %d" % (number % 5),
+                                         allowed_choice_num=options['choices'])
+            start = (self.now - timedelta(days=30 * (number + 1))) if past else \
+                    (self.now + timedelta(days=7 * (number + 1)))
+            weights = cumulative_weights(options['courses'], options['skew'])
+            courses = []
+            for i in range(options['courses']):
+                share = (weights[i] - (weights[i - 1] if i else 0)) / weights[-1]
+                courses.append(Course(event=event, display_name="%s course %d-%d" % (self.prefix, number, i),
+                                      description="", agreement="", is_open=not past,
+                                      change_allowed_date=start - timedelta(days=3),
+                                      start_date=start.date(), end_date=(start + timedelta(days=5)).date(),
+                                      capacity=max(5, int(expected * share * 0.7))))
+            Course.objects.bulk_create(courses)
+            course_ids = []
+            for course_id, capacity in Course.objects.filter(event=event).order_by('id') \
+                    .values_list('id', 'capacity'):
+                course_ids.append(course_id)
+                self.free_seats[course_id] = capacity
+            self.events.append((event, past, start, course_ids, weights))
+        self.event_ids = [event.id for event, _, _, _, _ in self.events]
+        self.course_ids = [course_id for _, _, _, course_ids, _ in self.events for course_id in course_ids]
+        self.event_weights = cumulative_weights(len(self.events), self.options['skew'])
+
+    def create_users(self, first, last):
+        rnd, options, now = self.rnd, self.options, self.now
+        users = []
+        for number in range(first, last):
+            joined = now - timedelta(minutes=rnd.randint(0, 525600))
+            users.append(("%s_%07d" % (self.prefix, number), self.password, rnd.choice(FIRST_NAMES),
+                          rnd.choice(LAST_NAMES), "%s_%07d@example.com" % (self.prefix, number),
+                          False, True, False, joined, joined))
+        insert_rows(User, ('username', 'password', 'first_name', 'last_name', 'email', 'is_staff',
+                           'is_active', 'is_superuser', 'date_joined', 'last_login'), users)
+        # Usernames are numbered with leading zeros, they sort like numbers
+        user_ids = list(User.objects.filter(username__gte=users[0][0], username__lte=users[-1][0])
+                        .order_by('username').values_list('id', flat=True))
+
+        profiles, comments, applications, choices = [], [], [], []
+        for user_id in user_ids:
+            profiles.append((user_id, "", 'closed', rnd.choice(COMPANIES), "",
+                             "5%09d" % rnd.randint(0, 10 ** 9 - 1), ""))
+            if rnd.random() < options['comments']:
+                comments.append((user_id, "generated comment", now))
+
+            # Number of events the user applies to, geometric around the average
+            applied = set()
+            while rnd.random() < options['applications'] / (options['applications'] + 1) and \
+                    len(applied) < len(self.events):
+                applied.add(pick(rnd, range(len(self.events)), self.event_weights))
+            for index in applied:
+                event, past, start, course_ids, weights = self.events[index]
+                ranked = []
+                while len(ranked) < min(options['choices'] + 1, len(course_ids)):
+                    course_id = pick(rnd, course_ids, weights)
+                    if course_id not in ranked:
+                        ranked.append(course_id)
+                # The application goes to the first choice with a free seat
+                open_courses = [course_id for course_id in ranked if self.free_seats[course_id]]
+                if not open_courses:
+                    continue
+                self.free_seats[open_courses[0]] -= 1
+                ranked.remove(open_courses[0])
+                ranked.insert(0, open_courses[0])
+                # Most applications come right after the registration opens
+                date = start - timedelta(days=30, seconds=-int(rnd.expovariate(1.0 / 86400)))
+                applications.append((user_id, ranked[0], event.id, date, past,
+                                     start - timedelta(days=2) if past else None))
+                for number, course_id in enumerate(ranked[1:]):
+                    choices.append((user_id, event.id, number + 1, course_id, now))
+
+        insert_rows(UserProfile, ('user', 'mugshot', 'privacy', 'company', 'contact_address',
+                                  'mobile', 'phone'), profiles)
+        insert_rows(UserComment, ('user', 'comment', 'date'), comments)
+        insert_rows(Application, ('person', 'course', 'event', 'application_date', 'approved',
+                                  'approve_date'), applications)
+        insert_rows(ApplicationChoices, ('person', 'event', 'choice_number', 'choice',
+                                         'last_update'), choices)
+
+        application_ids = Application.objects.filter(person__gte=user_ids[0], person__lte=user_ids[-1]) \
+            .order_by('id').values_list('id', flat=True)
+        permits = [(application_id, self.permit_file, now) for application_id in application_ids
+                   if rnd.random() < options['permits']]
+        insert_rows(ApplicationPermit, ('application', 'file', 'upload_date'), permits)
+
+        self.counts['users'] += len(users)
+        self.counts['applications'] += len(applications)
+        self.counts['choices'] += len(choices)
+        self.counts['permits'] += len(permits)
+        self.counts['comments'] += len(comments)
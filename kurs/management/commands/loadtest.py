@@ -0,0 +1,313 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import json
+import multiprocessing
+import random
+import shutil
+import tempfile
+import threading
+import time
+import Queue
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils.timezone import now as tz_aware_now
+from kurs.models import Event, Course, Application, ApplicationChoices
+from kurs.storage import permit_storage
+
+ENDPOINTS = ('event_list', 'course_list', 'course_detail', 'apply', 'choices_form',
+             'choices_save', 'upload_permit', 'application_list')
+
+PASSWORD = "loadtest"
+
+# Answers of the waiting room, they are not errors
+WAITING_STATUSES = (429, 503)
+
+# One visitor on registration day: browses the events and courses of the
+# event, applies to a course, picks ranked choices, uploads a permit and
+# checks the application list. Returns (endpoint, status, seconds, queries,
+# error) samples.
+#
+# Visitors sent to the waiting room (503 or 429 with Retry-After, see
+# kurs/admission.py) come back after the given time, as the browser does,
+# for at most patience seconds. Every attempt is a sample.
+def visit(client, username, event_id, course_ids, allowed_choice_num, rnd, patience=120):
+    samples = []
+
+    def request(endpoint, path, data=None, **extra):
+        given_up = time.time() + patience
+        while True:
+            started = time.time()
+            error = None
+            status = queries = retry_after = None
+            try:
+                if data is None:
+                    response = client.get(path, **extra)
+                else:
+                    response = client.post(path, data, **extra)
+                status = response.status_code
+                queries = int(response['X-Query-Count']) if response.has_header('X-Query-Count') else None
+                if status in WAITING_STATUSES and response.has_header('Retry-After'):
+                    retry_after = int(response['Retry-After'])
+                elif status >= 500:
+                    error = "HTTP %d" % status
+            except Exception as e:
+                error = "%s: %s" % (e.__class__.__name__, e)
+            samples.append((endpoint, status, time.time() - started, queries, error))
+            if retry_after is None or time.time() + retry_after > given_up:
+                return status
+            time.sleep(retry_after)
+
+    client.login(username=username, password=PASSWORD)
+    request('event_list', "/kurs/etkinlik/")
+    request('course_list', "/kurs/etkinlik/%d/" % event_id)
+
+    # Popular courses get most of the visits, as on opening day
+    ranked = sorted(course_ids, key=lambda course_id: rnd.random() * (course_ids.index(course_id) + 1))
+    request('course_detail', "/kurs/kurs/%d/" % ranked[0])
+    if request('apply', "/kurs/kurs/%d/basvur/" % ranked[0]) != 302:
+        # Rejected: course full or applied already, nothing more to do
+        return samples
+
+    path = "/kurs/etkinlik/%d/tercihler/edit/" % event_id
+    request('choices_form', path)
+    choices = ranked[1:allowed_choice_num + 1]
+    data = {'form-TOTAL_FORMS': len(choices), 'form-INITIAL_FORMS': 0,
+            'form-MAX_NUM_FORMS': allowed_choice_num}
+    for number, course_id in enumerate(choices):
+        data['form-%d-choice' % number] = course_id
+    request('choices_save', path, data)
+
+    application_id = Application.objects.filter(person__username=username, event=event_id) \
+        .values_list('id', flat=True).first()
+    if application_id is not None:
+        content = "%%PDF-1.4\n%% %s\n%s\n%%%%EOF\n" % (username, "0" * rnd.randint(1000, 50000))
+        request('upload_permit', "/kurs/basvurular/%d/izin/" % application_id,
+                {'file': SimpleUploadedFile("permit.pdf", content)})
+    request('application_list', "/kurs/basvurular/")
+    return samples
+
+# Runs the visits of usernames with the given number of threads, in the
+# current process
+def run_visits(args):
+    usernames, workers, event_id, course_ids, allowed_choice_num, seed, patience = args
+    queue = Queue.Queue()
+    for username in usernames:
+        queue.put(username)
+    samples = []
+    lock = threading.Lock()
+
+    def worker(number):
+        rnd = random.Random("%s-%d" % (seed, number))
+        client = Client()
+        try:
+            while True:
+                try:
+                    username = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                result = visit(client, username, event_id, course_ids, allowed_choice_num, rnd,
+                               patience)
+                client.logout()
+                with lock:
+                    samples.extend(result)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def summarize(samples, elapsed):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        selected = [sample for sample in samples if sample[0] == endpoint]
+        if not selected:
+            continue
+        latencies = sorted(seconds * 1000 for _, _, seconds, _, _ in selected)
+        queries = [count for _, _, _, count, _ in selected if count is not None]
+        statuses = {}
+        for _, status, _, _, _ in selected:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = [error for _, _, _, _, error in selected if error]
+        endpoints[endpoint] = {
+            'requests': len(selected),
+            'throughput': len(selected) / elapsed,
+            'latency_ms': {'mean': sum(latencies) / len(latencies),
+                           'p50': percentile(latencies, 0.50),
+                           'p90': percentile(latencies, 0.90),
+                           'p95': percentile(latencies, 0.95),
+                           'p99': percentile(latencies, 0.99),
+                           'max': latencies[-1]},
+            'queries': {'mean': float(sum(queries)) / len(queries) if queries else None,
+                        'max': max(queries) if queries else None},
+            'statuses': statuses,
+            'errors': len(errors),
+            'error_rate': float(len(errors)) / len(selected),
+            'error_samples': sorted(set(errors))[:5],
+        }
+    return endpoints
+
+# Drives the registration scenario of visit() against the configured
+# database with concurrent clients going through the full middleware and
+# view stack (the Django test client, without a web server in between), and
+# reports latency percentiles, throughput, query counts and error rates per
+# endpoint. Afterwards the data is checked for duplicate applications and
+# choices and for overbooked courses. --output writes the results as JSON
+# for comparing runs.
+#
+# Generated users, events, courses and permits are deleted at the end
+# unless --keep is given. Permit files go to a temporary directory.
+class Command(BaseCommand):
+    help = "Load test the registration pages with concurrent clients"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=8,
+                    help='Number of client threads in every process'),
+        make_option('--processes', type='int', default=1,
+                    help='Number of processes running client threads'),
+        make_option('--users', type='int', default=500,
+                    help='Number of visitors, each visits once'),
+        make_option('--courses', type='int', default=10,
+                    help='Number of courses in the generated event'),
+        make_option('--capacity', type='int', default=30,
+                    help='Capacity of each course'),
+        make_option('--choices', type='int', default=3,
+                    help='Number of ranked choices allowed in the event'),
+        make_option('--patience', type='int', default=120,
+                    help='Seconds a visitor keeps coming back to the waiting room'),
+        make_option('--seed', type='int', default=0),
+        make_option('--output', help='Write the results to this JSON file'),
+        make_option('--keep', action='store_true', default=False,
+                    help='Do not delete the generated data'),
+    )
+
+    def handle(self, *args, **options):
+        # Logins are not measured, hash the generated passwords cheaply
+        with override_settings(KURS_QUERY_STATS=True,
+                               PASSWORD_HASHERS=('django.contrib.auth.hashers.MD5PasswordHasher',)):
+            storage_location = permit_storage.location
+            permit_storage.location = tempfile.mkdtemp()
+            try:
+                self.run(options)
+            finally:
+                shutil.rmtree(permit_storage.location)
+                permit_storage.location = storage_location
+
+    def run(self, options):
+        prefix = "loadtest_%d_" % int(time.time())
+        event = Event.objects.create(display_name=prefix, venue="loadtest",
+                                     allowed_choice_num=options['choices'])
+        now = tz_aware_now()
+        Course.objects.bulk_create([Course(event=event, display_name="%s%d" % (prefix, i),
+                                           description="", agreement="", is_open=True,
+                                           change_allowed_date=now + timedelta(days=1),
+                                           start_date=now.date(), end_date=now.date(),
+                                           capacity=options['capacity'])
+                                    for i in range(options['courses'])])
+        course_ids = list(Course.objects.filter(event=event).order_by('id').values_list('id', flat=True))
+        password = make_password(PASSWORD)
+        usernames = ["%s%d" % (prefix, i) for i in range(options['users'])]
+        User.objects.bulk_create([User(username=username, password=password)
+                                  for username in usernames])
+
+        try:
+            samples, elapsed = self.drive(usernames, event, course_ids, options)
+            results = {
+                'started': now.isoformat(),
+                'options': dict((name, options[name]) for name in
+                                ('workers', 'processes', 'users', 'courses', 'capacity',
+                                 'choices', 'patience', 'seed')),
+                'admission_rate': getattr(settings, 'KURS_ADMISSION_RATE', None),
+                'database': settings.DATABASES['default']['ENGINE'],
+                'elapsed': elapsed,
+                'requests': len(samples),
+                'throughput': len(samples) / elapsed,
+                'waiting_room': dict((str(status), sum(1 for sample in samples if sample[1] == status))
+                                     for status in WAITING_STATUSES),
+                'endpoints': summarize(samples, elapsed),
+                'invariants': self.check(event),
+            }
+            self.report(results)
+            if options['output']:
+                with open(options['output'], 'w') as output:
+                    json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            if not options['keep']:
+                event.delete()
+                User.objects.filter(username__startswith=prefix).delete()
+
+    def drive(self, usernames, event, course_ids, options):
+        processes = max(1, options['processes'])
+        jobs = [(usernames[number::processes], options['workers'], event.id, course_ids,
+                 event.allowed_choice_num, "%d-%d" % (options['seed'], number),
+                 options['patience'])
+                for number in range(processes)]
+        started = time.time()
+        if processes == 1:
+            samples = run_visits(jobs[0])
+        else:
+            # Forked processes must not share the database connection
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                samples = sum(pool.map(run_visits, jobs), [])
+            finally:
+                pool.close()
+                pool.join()
+        return samples, time.time() - started
+
+    # Invariants the registration must hold whatever the load
+    def check(self, event):
+        counts = dict(Application.objects.filter(event=event)
+                      .values_list('course').annotate(Count('id')))
+        overbooked = [course.id for course in Course.objects.filter(event=event)
+                      if counts.get(course.id, 0) > course.capacity or
+                      counts.get(course.id, 0) != course.seats_taken]
+        applicants = Application.objects.filter(event=event).values('person') \
+            .distinct().count()
+        duplicate_applications = Application.objects.filter(event=event) \
+            .values('person').annotate(n=Count('id')).filter(n__gt=1).count()
+        duplicate_choices = ApplicationChoices.objects.filter(event=event) \
+            .values('person', 'choice').annotate(n=Count('id')).filter(n__gt=1).count()
+        return {'applicants': applicants,
+                'overbooked_courses': len(overbooked),
+                'duplicate_applications': duplicate_applications,
+                'duplicate_application_rate': float(duplicate_applications) / applicants if applicants else 0.0,
+                'duplicate_choices': duplicate_choices}
+
+    def report(self, results):
+        self.stdout.write("%(requests)d requests in %(elapsed).2fs, %(throughput).1f requests/s" % results)
+        self.stdout.write("waiting room: %(503)d queued, %(429)d throttled" % results['waiting_room'])
+        self.stdout.write("%-17s %7s %8s %8s %8s %8s %8s %7s %7s" %
+                          ("endpoint", "count", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms",
+                           "queries", "errors"))
+        for endpoint in ENDPOINTS:
+            stats = results['endpoints'].get(endpoint)
+            if stats is None:
+                continue
+            latency = stats['latency_ms']
+            self.stdout.write("%-17s %7d %8.1f %8.1f %8.1f %8.1f %8.1f %7s %7d" % (
+                endpoint, stats['requests'], stats['throughput'], latency['p50'],
+                latency['p95'], latency['p99'], latency['max'],
+                "%.1f" % stats['queries']['mean'] if stats['queries']['mean'] is not None else "-",
+                stats['errors']))
+            for error in stats['error_samples']:
+                self.stderr.write("  %s: %s" % (endpoint, error))
+        self.stdout.write("applicants=%(applicants)d overbooked courses=%(overbooked_courses)d "
+                          "duplicate applications=%(duplicate_applications)d "
+                          "duplicate choices=%(duplicate_choices)d" % results['invariants'])
@@ -0,0 +1,50 @@
+# coding=utf-8
+
+from optparse import make_option
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+# Starts fresh interpreters that import lkd.wsgi and serve one request (see
+# kurs/importtime.py) and reports the median import and first request times
+# and the modules taking the most time in the last run. Run it with
+# KURS_WARM_UP on and off to see what the warm up moves before the fork.
+class Command(BaseCommand):
+    help = "Profile the import time of the WSGI application"
+    option_list = BaseCommand.option_list + (
+        make_option('--path', default='/kurs/etkinlik/',
+                    help='Path of the first request'),
+        make_option('--repeat', type='int', default=5,
+                    help='Number of interpreters started'),
+        make_option('--limit', type='int', default=20,
+                    help='Number of modules to list'),
+    )
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'lkd.settings')
+        # The interpreters import the project from wherever the command runs
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+        runs = []
+        for i in range(options['repeat']):
+            output = subprocess.check_output([sys.executable, '-m', 'kurs.importtime', '--json',
+                                              '--path', options['path'],
+                                              '--limit', str(options['limit'])], env=env)
+            runs.append(json.loads(output))
+
+        last = runs[-1]
+        self.stdout.write("import lkd.wsgi: %.0f ms, %d modules" % (
+            median(run['import_seconds'] for run in runs) * 1000, last['modules_at_import']))
+        self.stdout.write("first request (%s): %.0f ms, %d modules, %s" % (
+            options['path'], median(run['first_request_seconds'] for run in runs) * 1000,
+            last['modules_at_first_request'], last['status']))
+        self.stdout.write("%10s %10s  %s" % ("own ms", "total ms", "module"))
+        for name, cumulative, own in last['modules']:
+            self.stdout.write("%10.1f %10.1f  %s" % (own * 1000, cumulative * 1000, name))
@@ -0,0 +1,100 @@
+# coding=utf-8
+
+from optparse import make_option
+from datetime import timedelta
+import logging
+import time
+
+from django.core.mail import EmailMessage, get_connection
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now as tz_aware_now
+from kurs.models import OutgoingEmail
+from kurs.log import log_event
+
+logger = logging.getLogger(__name__)
+
+# Sends the e-mails queued in OutgoingEmail.
+# Messages are sent in batches over a single SMTP connection. A message that
+# can not be sent is retried later with exponential backoff until
+# --max-attempts is reached. Every batch is claimed for --lease seconds
+# before it is sent, runs that overlap send different messages. Messages of
+# a run that died are sent again once their lease is over.
+#
+# To test locally, start the debugging SMTP server that settings.py points to
+#     python -m smtpd -n -c DebuggingServer localhost:1025
+# and run
+#     python manage.py send_outbox --loop
+class Command(BaseCommand):
+    help = "Send queued e-mails from the outbox"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100,
+                    help='Number of messages sent over one SMTP connection'),
+        make_option('--max-attempts', type='int', default=5,
+                    help='Give up on a message after this many failures'),
+        make_option('--backoff', type='int', default=60,
+                    help='Seconds to wait before the first retry, doubled on every failure'),
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep running and poll the outbox'),
+        make_option('--sleep', type='float', default=5,
+                    help='Seconds to wait between polls when the outbox is empty'),
+        make_option('--lease', type='int', default=600,
+                    help='Seconds a batch is kept from other runs while it is being sent'),
+    )
+
+    def handle(self, *args, **options):
+        while True:
+            self.sent = self.failed = 0
+            while self.send_batch(options) == options['batch_size']:
+                pass
+            if self.sent or self.failed:
+                self.stdout.write("%d message(s) sent, %d failed" % (self.sent, self.failed))
+            if not options['loop']:
+                return
+            time.sleep(options['sleep'])
+
+    # Send one batch of due messages, returns the number of messages handled
+    def send_batch(self, options):
+        batch = OutgoingEmail.objects.claim(options['max_attempts'], options['batch_size'],
+                                            options['lease'])
+        if not batch:
+            return 0
+
+        sent_ids = []
+        connection = get_connection()
+        try:
+            connection.open()
+            for message in batch:
+                try:
+                    EmailMessage(message.subject, message.body, message.from_email,
+                                 [message.to], connection=connection).send()
+                    sent_ids.append(message.id)
+                except Exception as e:
+                    self.retry_later(message, e, options)
+        except Exception as e:
+            # The connection could not be opened or it is broken,
+            # retry every message we did not manage to send
+            for message in batch:
+                if message.id not in sent_ids:
+                    self.retry_later(message, e, options)
+        finally:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+        if sent_ids:
+            OutgoingEmail.objects.filter(id__in=sent_ids).update(sent_date=tz_aware_now())
+        self.sent += len(sent_ids)
+        self.failed += len(batch) - len(sent_ids)
+        return len(batch)
+
+    def retry_later(self, message, error, options):
+        attempts = message.attempts + 1
+        delay = options['backoff'] * 2 ** (attempts - 1)
+        OutgoingEmail.objects.filter(id=message.id).update(
+            attempts=attempts,
+            next_attempt=tz_aware_now() + timedelta(seconds=delay),
+            last_error=repr(error))
+
+        log_event(logger, 'email_failed', u"E-posta gönderilemedi", level=logging.WARNING,
+                  email=message, attempts=attempts, error=repr(error))
@@ -0,0 +1,58 @@
+# coding=utf-8
+
+from optparse import make_option
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from kurs.routers import replica_alias
+
+# Stands in for replication when the primary and the replica are SQLite
+# files on the same machine, for trying kurs.routers locally. The primary
+# is copied with VACUUM INTO, which reads a consistent snapshot while
+# writers go on, and the copy replaces the replica file in one rename.
+# Connections to the replica must not use WAL journaling, the -wal file of
+# the replaced replica would be applied to the new one:
+#
+#     'replica': {'ENGINE': 'kurs.backends.sqlite3', 'NAME': ...,
+#                 'OPTIONS': {'pragmas': {'journal_mode': 'DELETE', 'query_only': 1}}}
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database to the replica"
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', default=False,
+                    help='Keep copying'),
+        make_option('--interval', type='float', default=1.0,
+                    help='Seconds between copies with --loop'),
+    )
+
+    def handle(self, *args, **options):
+        alias = replica_alias()
+        if alias is None:
+            raise CommandError("There is no replica database in DATABASES")
+        if sqlite3.sqlite_version_info < (3, 27, 0):
+            raise CommandError("VACUUM INTO needs SQLite 3.27 or later")
+        source = settings.DATABASES[DEFAULT_DB_ALIAS]['NAME']
+        target = settings.DATABASES[alias]['NAME']
+
+        while True:
+            started = time.time()
+            self.copy(source, target)
+            if int(options['verbosity']) > 1:
+                self.stdout.write("%s copied in %.3fs" % (target, time.time() - started))
+            if not options['loop']:
+                break
+            time.sleep(max(0, options['interval'] - (time.time() - started)))
+
+    def copy(self, source, target):
+        partial = target + ".sync"
+        if os.path.exists(partial):
+            os.remove(partial)
+        connection = sqlite3.connect(source, timeout=20)
+        try:
+            connection.execute("VACUUM INTO ?", (partial,))
+        finally:
+            connection.close()
+        os.rename(partial, target)
@@ -1,35 +1,101 @@
 # coding=utf-8
 
-from django.db import models
+from django.db import models, connection, IntegrityError
+from django.db.models import F, Q
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.dispatch import receiver
-from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_delete, post_delete, pre_save, post_save
 from django.utils.timezone import now as tz_aware_now
+from datetime import timedelta
 from django import forms
 from django.template.defaultfilters import filesizeformat
 from userena.models import UserenaBaseProfile
 from userena.signals import signup_complete
-import magic
+from kurs.uploadhandlers import sniff_content_type
+from kurs.storage import permit_storage
+from kurs.db import write_transaction
+from kurs.cache import bump_user_versions, bump_event_versions, set_course_event
+
+class EventManager(models.Manager):
+    # Mark the events as modified. Used when one of their courses changes,
+    # the pages of an event show its courses too.
+    def touch(self, event_ids):
+        event_ids = [event_id for event_id in set(event_ids) if event_id is not None]
+        if event_ids:
+            self.filter(pk__in=event_ids).update(last_modified=tz_aware_now())
 
 class Event(models.Model):
     class Meta:
         verbose_name = _('event')
         verbose_name_plural = _('events')
 
+    objects = EventManager()
+
     display_name = models.CharField(verbose_name=_('display name'), max_length=200)
     allowed_choice_num = models.IntegerField(verbose_name=_('number of allowed user choices for this event'),
                                              default=2)
     venue = models.CharField(verbose_name=_('venue'), max_length=200)
+    # Bulk updates (queryset.update) must set this field explicitly
+    last_modified = models.DateTimeField(verbose_name=_('last modified'), auto_now=True)
 
     def __unicode__(self):
         return self.display_name
 
+# Raised when a seat can not be reserved because the course is full
+# or it is not open for application anymore
+class CourseFull(Exception):
+    pass
+
+# Raised when the user already has an application in the same event
+class AlreadyApplied(Exception):
+    pass
+
+class CourseManager(models.Manager):
+    # Reserve one seat of the course. The capacity check and the increment
+    # are done in a single conditional UPDATE, so any number of concurrent
+    # applicants can never push seats_taken over capacity and the course row
+    # is locked only for the duration of that one statement.
+    # Returns False if the course is full or not open for application.
+    def reserve_seat(self, course_id):
+        updated = self.filter(Q(capacity=0) | Q(seats_taken__lt=F('capacity')),
+                              pk=course_id, is_open=True,
+                              change_allowed_date__gte=tz_aware_now()) \
+                      .update(seats_taken=F('seats_taken') + 1)
+        return updated == 1
+
+    # Give back a seat taken by a deleted application
+    def release_seat(self, course_id):
+        self.filter(pk=course_id, seats_taken__gt=0).update(seats_taken=F('seats_taken') - 1)
+
+    # Recalculate seats_taken from the applications in a single statement.
+    # Used after operations which move applications between courses
+    # without going through reserve_seat/release_seat.
+    def recount_seats(self, course_ids=None):
+        course_table = self.model._meta.db_table
+        application_table = Application._meta.db_table
+        qn = connection.ops.quote_name
+        sql = ("UPDATE %(course)s SET seats_taken = "
+               "(SELECT COUNT(*) FROM %(application)s "
+               "WHERE %(application)s.course_id = %(course)s.id)") % {
+            'course': qn(course_table), 'application': qn(application_table)}
+        params = []
+        if course_ids is not None:
+            course_ids = list(course_ids)
+            if not course_ids:
+                return
+            sql += " WHERE id IN (%s)" % ", ".join(["%s"] * len(course_ids))
+            params = course_ids
+        connection.cursor().execute(sql, params)
+
 class Course(models.Model):
     class Meta:
         verbose_name = _("course")
         verbose_name_plural = _("courses")
 
+    objects = CourseManager()
+
     event = models.ForeignKey(Event, verbose_name=_('event'))
     display_name = models.CharField(verbose_name=_('display name'), max_length=200)
     description = models.TextField(verbose_name=_('description'))
@@ -38,6 +104,15 @@ class Course(models.Model):
     agreement = models.TextField(verbose_name=_('prerequisites'))
     start_date = models.DateField(verbose_name=_('start date'))
     end_date = models.DateField(verbose_name=_('end date'))
+    # 0 means there is no limit on the number of applications
+    capacity = models.PositiveIntegerField(verbose_name=_('capacity'), default=0,
+                                           help_text=_('0 means unlimited'))
+    # Maintained by CourseManager.reserve_seat/release_seat, never edit by hand
+    seats_taken = models.PositiveIntegerField(verbose_name=_('seats taken'), default=0,
+                                              editable=False)
+    # Bulk updates (queryset.update) must set this field explicitly.
+    # seats_taken changes do not count as modifications.
+    last_modified = models.DateTimeField(verbose_name=_('last modified'), auto_now=True)
 
     # We define this logic here in order to use it in user
     # course detail page, we filter messages and links according
@@ -46,27 +121,61 @@ class Course(models.Model):
     def can_be_applied(self):
         # We have to use timezone-aware date-time objects because we
         # set USE_TZ=True in settings.py
-        if self.is_open and self.change_allowed_date >= tz_aware_now():
-            return True
-        return False
+        return self.can_be_applied_at(tz_aware_now())
+
+    # Pages checking many courses get the time once
+    def can_be_applied_at(self, now):
+        return self.is_open and self.change_allowed_date >= now
+
+    @property
+    def is_full(self):
+        return self.capacity > 0 and self.seats_taken >= self.capacity
 
     def __unicode__(self):
         return "%s (%s)" % (self.display_name, self.event.display_name)
 
+class ApplicationManager(models.Manager):
+    # Apply the user to the course, reserving a seat on the way.
+    # Everything happens in one transaction: if the user turns out to have
+    # another application in the same event, the reserved seat is given back
+    # by the rollback.
+    # Raises CourseFull or AlreadyApplied.
+    def apply(self, person, course):
+        try:
+            with write_transaction():
+                if not Course.objects.reserve_seat(course.pk):
+                    raise CourseFull
+
+                # The unique (person, event) constraint rejects a second
+                # application in the event, concurrent requests included
+                return self.create(person=person, course=course,
+                                   application_date=tz_aware_now())
+        except IntegrityError:
+            raise AlreadyApplied
+
 class Application(models.Model):
     class Meta:
         verbose_name = _("application")
         verbose_name_plural = _("applications")
-        unique_together = (("person", "course"),)
+        unique_together = (("person", "course"), ("person", "event"))
 
     person = models.ForeignKey(User, related_name='application_users', verbose_name=_('user'))
     course = models.ForeignKey(Course, verbose_name=_('course'))
+    # Copied from the course on save, a user can apply to one course of an
+    # event only
+    event = models.ForeignKey(Event, verbose_name=_('event'), editable=False)
     application_date = models.DateTimeField(verbose_name=_('date of application'))
     approved = models.BooleanField(default=False, verbose_name=_('approved'))
     approved_by = models.ForeignKey(User, related_name='application_approver',
                                     blank=True, null=True, verbose_name=_('approver'))
     approve_date = models.DateTimeField(blank=True, null=True, verbose_name=_('date of approval'))
 
+    objects = ApplicationManager()
+
+    def save(self, *args, **kwargs):
+        self.event_id = self.course.event_id
+        super(Application, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return "%s -> %s" % (self.person.username, self.course)
 
@@ -75,8 +184,13 @@ class Application(models.Model):
 @receiver(pre_delete, sender=Application, dispatch_uid="unique_identifier")
 def delete_application_choices(sender, **kwargs):
     instance = kwargs['instance']
-    ApplicationChoices.objects.filter(person = instance.person,
-                                      event = instance.course.event).delete()
+    ApplicationChoices.objects.filter(person = instance.person_id,
+                                      event = instance.event_id).delete()
+
+# Free the seat of the course whenever an application gets deleted
+@receiver(post_delete, sender=Application, dispatch_uid="release_course_seat")
+def release_course_seat(sender, **kwargs):
+    Course.objects.release_seat(kwargs['instance'].course_id)
 
 # Validate the permit file accoring to mime-type
 # got from
@@ -109,20 +223,31 @@ class ValidatedFileField(models.FileField):
         if self.content_types:
             content_type_headers = getattr(file, 'content_type', '')
 
-            mg = magic.Magic(mime = True)
-            content_type_magic = mg.from_buffer(file.read(1024))
-            file.seek(0)
+            # Files received through PermitUploadHandler are sniffed already
+            content_type_magic = getattr(file, 'content_type_magic', None)
+            if content_type_magic is None:
+                content_type_magic = sniff_content_type(file.read(1024))
+                file.seek(0)
+
+            self.validate_content_type(content_type_headers, content_type_magic)
+
+        self.validate_size(file._size)
+
+        return data
 
+    # The checks below are also used by PermitUploadHandler while the file
+    # is being uploaded
+    def validate_content_type(self, content_type_headers, content_type_magic):
+        if self.content_types:
             if not content_type_headers in self.content_types or not content_type_magic in self.content_types:
                 raise forms.ValidationError(_('Files of type %(type)s are not supported.') % {'type': content_type_magic})
 
+    def validate_size(self, size):
         if self.max_upload_size:
-            if file._size > self.max_upload_size:
+            if size > self.max_upload_size:
                 raise forms.ValidationError(_('Files of size greater than %(max_size)s are not allowed. Your file is %(current_size)s') %
                                             {'max_size': filesizeformat(self.max_upload_size),
-                                             'current_size': filesizeformat(file._size)})
-
-        return data
+                                             'current_size': filesizeformat(size)})
 
 
 class ApplicationPermit(models.Model):
@@ -132,8 +257,10 @@ class ApplicationPermit(models.Model):
 
     application = models.OneToOneField(Application, unique=True, verbose_name=_('application'))
     # we use custom filefield with mime-time validation
+    # Files are stored by content under kurs/application_permits, see kurs/storage.py
     file = ValidatedFileField(verbose_name=_('file'),
-                              upload_to = "kurs/application_permits/%Y/%m/%d",
+                              upload_to = "kurs/application_permits",
+                              storage = permit_storage,
                               max_upload_size = 5242880,
                               content_types = ['application/msword',
                                                'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
@@ -158,6 +285,39 @@ class ApplicationPermit(models.Model):
 # Users not being able to accepted to their first application
 # are given a couple of choices to automaticly apply to another
 # course in the same event
+class ApplicationChoicesManager(models.Manager):
+    # Replace the choices of the person in the event with the given ranked
+    # list of course ids. Only the rows that differ are deleted and created
+    # again, unchanged choices keep their last_update. Everything happens in
+    # one transaction with a fixed number of queries.
+    # Returns the (deleted, created) lists of choices.
+    def replace(self, person, event_id, course_ids):
+        with write_transaction():
+            previous = dict((choice.choice_number, choice)
+                            for choice in self.filter(person=person, event=event_id))
+            wanted = dict((number + 1, course_id) for number, course_id in enumerate(course_ids))
+
+            deleted = [choice for number, choice in sorted(previous.items())
+                       if wanted.get(number) != choice.choice_id]
+            # Rows are deleted before the new ones are created, a course can
+            # move to another choice number without breaking the unique
+            # constraints
+            if deleted:
+                self.filter(id__in=[choice.id for choice in deleted]).delete()
+
+            now = tz_aware_now()
+            created = [self.model(person=person, event_id=event_id, choice_number=number,
+                                  choice_id=course_id, last_update=now)
+                       for number, course_id in sorted(wanted.items())
+                       if number not in previous or previous[number].choice_id != course_id]
+            if created:
+                self.bulk_create(created)
+
+        # bulk_create does not send post_save
+        if created:
+            bump_user_versions([person.pk])
+        return deleted, created
+
 class ApplicationChoices(models.Model):
     class Meta:
         verbose_name = _('choice')
@@ -172,6 +332,8 @@ class ApplicationChoices(models.Model):
     choice_number = models.IntegerField(verbose_name=_('choice #'))
     choice = models.ForeignKey(Course, verbose_name=_('choice'))
 
+    objects = ApplicationChoicesManager()
+
     def __unicode__(self):
         return "%s -> %s -> %s - %s" %(self.person.username, self.event,
                                        self.choice_number, self.choice)
@@ -190,6 +352,105 @@ class UserComment(models.Model):
     def __unicode__(self):
         return "%s - %s - %s" %(self.user.username, self.comment, self.date)
 
+class OutgoingEmailManager(models.Manager):
+    # Add messages to the outbox in a single bulk insert.
+    # messages is an iterable of (subject, body, from_email, to) tuples
+    def enqueue(self, messages):
+        now = tz_aware_now()
+        self.bulk_create([OutgoingEmail(subject=subject, body=body, from_email=from_email,
+                                        to=to, created=now, next_attempt=now)
+                          for subject, body, from_email, to in messages])
+
+    # Messages waiting to be sent whose retry time has come
+    def due(self, max_attempts):
+        return self.filter(sent_date__isnull=True, attempts__lt=max_attempts,
+                           next_attempt__lte=tz_aware_now()).order_by('next_attempt', 'id')
+
+    # Claim up to limit due messages for a sender: their next attempt is
+    # moved lease seconds ahead, other senders do not see them as due until
+    # then. Rows are read and moved in one write transaction, concurrent
+    # senders claim different messages.
+    def claim(self, max_attempts, limit, lease):
+        with write_transaction():
+            batch = list(self.due(max_attempts).select_for_update()[:limit])
+            if batch:
+                self.filter(id__in=[message.id for message in batch]) \
+                    .update(next_attempt=tz_aware_now() + timedelta(seconds=lease))
+        return batch
+
+# E-mails are not sent from the request thread, they are stored here and
+# sent in batches by the send_outbox management command
+class OutgoingEmail(models.Model):
+    class Meta:
+        verbose_name = _('outgoing email')
+        verbose_name_plural = _('outgoing emails')
+        index_together = (("sent_date", "next_attempt"),)
+
+    subject = models.CharField(verbose_name=_('subject'), max_length=255)
+    body = models.TextField(verbose_name=_('body'))
+    from_email = models.CharField(verbose_name=_('from'), max_length=254)
+    to = models.CharField(verbose_name=_('to'), max_length=254)
+    created = models.DateTimeField(verbose_name=_('created'))
+    next_attempt = models.DateTimeField(verbose_name=_('next attempt'))
+    attempts = models.PositiveIntegerField(verbose_name=_('attempts'), default=0)
+    sent_date = models.DateTimeField(verbose_name=_('sent date'), blank=True, null=True)
+    last_error = models.TextField(verbose_name=_('last error'), blank=True)
+
+    objects = OutgoingEmailManager()
+
+    def __unicode__(self):
+        return "%s -> %s" % (self.subject, self.to)
+
+class AuditBatchManager(models.Manager):
+    # Record a bulk admin action on the objects of queryset. The batch is one
+    # row and its entries, one per object, are inserted with a single
+    # INSERT ... SELECT from the queryset, so the trail takes two statements
+    # whatever the number of objects. Call it before changing the objects,
+    # the queryset may not match them afterwards.
+    def record(self, user, action, queryset, change_message=""):
+        model = queryset.model
+        batch = self.create(user=user, action=action,
+                            content_type=ContentType.objects.get_for_model(model),
+                            action_time=tz_aware_now(), change_message=change_message)
+        qn = connection.ops.quote_name
+        select, params = queryset.values_list('pk').query.sql_with_params()
+        sql = ("INSERT INTO %(entry)s (batch_id, object_id) "
+               "SELECT %%s, %(pk)s FROM %(table)s WHERE %(pk)s IN (%(select)s)") % {
+            'entry': qn(AuditEntry._meta.db_table), 'table': qn(model._meta.db_table),
+            'pk': qn(model._meta.pk.column), 'select': select}
+        connection.cursor().execute(sql, (batch.id,) + tuple(params))
+        return batch
+
+# Bulk admin actions change objects with queryset.update(), which does not
+# go through LoggingModelAdmin. They are recorded here as a batch with the
+# ids of the objects it changed.
+class AuditBatch(models.Model):
+    class Meta:
+        verbose_name = _('audit batch')
+        verbose_name_plural = _('audit batches')
+
+    user = models.ForeignKey(User, verbose_name=_('user'), blank=True, null=True)
+    action = models.CharField(verbose_name=_('action'), max_length=50)
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    action_time = models.DateTimeField(verbose_name=_('action time'), db_index=True)
+    change_message = models.TextField(verbose_name=_('change message'), blank=True)
+
+    objects = AuditBatchManager()
+
+    def __unicode__(self):
+        return u"%s %s" % (self.action, self.content_type)
+
+class AuditEntry(models.Model):
+    class Meta:
+        verbose_name = _('audit entry')
+        verbose_name_plural = _('audit entries')
+
+    batch = models.ForeignKey(AuditBatch, verbose_name=_('audit batch'), related_name='entries')
+    object_id = models.IntegerField(verbose_name=_('object id'), db_index=True)
+
+    def __unicode__(self):
+        return u"%s #%d" % (self.batch, self.object_id)
+
 # Custom user profile in order to extend the standart User object that
 # django.contrib.auth uses
 class UserProfile(UserenaBaseProfile):
@@ -198,3 +459,61 @@ class UserProfile(UserenaBaseProfile):
     contact_address = models.TextField(verbose_name=_('contact address'))
     mobile = models.CharField(verbose_name=_('mobile'), max_length=10, help_text=_('ie. 2165554433'))
     phone = models.CharField(verbose_name=_('phone'), max_length=10, help_text=_('ie. 2165554433'))
+
+# Cached pages of a user are invalidated whenever the applications,
+# permits or choices of the user change
+@receiver(post_save, sender=Application, dispatch_uid="application_saved")
+@receiver(post_delete, sender=Application, dispatch_uid="application_deleted")
+@receiver(post_save, sender=ApplicationChoices, dispatch_uid="applicationchoices_saved")
+@receiver(post_delete, sender=ApplicationChoices, dispatch_uid="applicationchoices_deleted")
+def invalidate_user_cache(sender, **kwargs):
+    bump_user_versions([kwargs['instance'].person_id])
+
+@receiver(post_save, sender=ApplicationPermit, dispatch_uid="applicationpermit_saved")
+@receiver(pre_delete, sender=ApplicationPermit, dispatch_uid="applicationpermit_deleted")
+def invalidate_permit_owner_cache(sender, **kwargs):
+    try:
+        bump_user_versions([kwargs['instance'].application.person_id])
+    except Application.DoesNotExist:
+        pass
+
+# Permit files are shared by all permits with the same content. They are
+# not deleted with a permit or when it is replaced: the transaction may still
+# be rolled back, and an identical upload may be saving the same file. The
+# collect_permit_files command deletes files no permit refers to.
+
+# Cached catalog data of an event is invalidated whenever the event or one
+# of its courses change, see kurs/catalog.py
+@receiver(post_save, sender=Event, dispatch_uid="event_saved")
+@receiver(post_delete, sender=Event, dispatch_uid="event_deleted")
+def invalidate_event_cache(sender, **kwargs):
+    bump_event_versions([kwargs['instance'].pk])
+
+# A course moved to another event must be removed from the old one too
+@receiver(pre_save, sender=Course, dispatch_uid="course_saving")
+def remember_course_event(sender, **kwargs):
+    instance = kwargs['instance']
+    if instance.pk:
+        instance._previous_event_id = Course.objects.filter(pk=instance.pk) \
+            .values_list('event_id', flat=True).first()
+
+@receiver(post_save, sender=Course, dispatch_uid="course_saved")
+def invalidate_course_cache(sender, **kwargs):
+    instance = kwargs['instance']
+    set_course_event(instance.pk, instance.event_id)
+    previous_event_id = getattr(instance, '_previous_event_id', None)
+    if previous_event_id is not None and previous_event_id != instance.event_id:
+        # update() does not call Application.save
+        applications = Application.objects.filter(course=instance)
+        applications.update(event=instance.event_id)
+        bump_user_versions(applications.values_list('person_id', flat=True))
+    event_ids = [instance.event_id, previous_event_id]
+    Event.objects.touch(event_ids)
+    bump_event_versions(event_ids)
+
+@receiver(post_delete, sender=Course, dispatch_uid="course_deleted")
+def invalidate_deleted_course_cache(sender, **kwargs):
+    instance = kwargs['instance']
+    set_course_event(instance.pk, None)
+    Event.objects.touch([instance.event_id])
+    bump_event_versions([instance.event_id])
@@ -0,0 +1,32 @@
+# coding=utf-8
+
+from django.conf import settings
+from django.template import Context
+from django.template.loader import get_template
+from kurs.models import OutgoingEmail
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Queue an e-mail for every application in the queryset telling the user
+# that the application is approved/rejected. Templates are loaded once and
+# all messages are stored with a single insert, they are sent later by the
+# send_outbox command.
+def queue_approval_emails(applications, status_string, site_name):
+    subject_template = get_template("admin/approval_email_subject.txt")
+    body_template = get_template("admin/approval_email.txt")
+
+    msg = []
+    for application in applications.select_related('person', 'course__event'):
+        # Prepeare email subject and body
+        context = Context({'application': application.course,
+                           'approval_date': application.approve_date,
+                           'site': site_name,
+                           'status_string': status_string})
+        subject = subject_template.render(context).strip()
+        body = body_template.render(context)
+
+        msg.append((subject, body, settings.DEFAULT_FROM_EMAIL, application.person.email))
+
+    OutgoingEmail.objects.enqueue(msg)
+    return len(msg)
@@ -0,0 +1,142 @@
+# coding=utf-8
+
+# SQL query instrumentation.
+#
+# QueryStatsMiddleware records the number of queries, total database time
+# and repeated queries of every request. Views declare how many queries they
+# are allowed to issue with the query_budget decorator (see kurs/urls.py);
+# requests going over the budget are logged, and QueryBudgetMixin lets the
+# test suite fail on them.
+
+import re
+import logging
+
+from django.conf import settings
+from django.core.urlresolvers import resolve
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+logger = logging.getLogger(__name__)
+
+_literal_re = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_in_list_re = re.compile(r"\(\?(?:, \?)*\)")
+# The SQLite backend records queries as "QUERY = u'...' - PARAMS = (...)"
+_sqlite_re = re.compile(r"^QUERY = u?(['\"])(.*)\1 - PARAMS = .*$", re.DOTALL)
+
+# Replace literals in the query so that queries differing only in their
+# parameters get the same fingerprint
+def fingerprint(sql):
+    match = _sqlite_re.match(sql)
+    if match:
+        sql = match.group(2)
+    return _in_list_re.sub("(...)", _literal_re.sub("?", sql))
+
+# Mark a view with the maximum number of queries it may issue, including
+# the session and user lookups of the request. Views writing on POST declare
+# the budget of their POST requests separately.
+def query_budget(max_queries, post=None):
+    def decorator(view):
+        view.query_budget = max_queries
+        if post is not None:
+            view.query_budget_post = post
+        return view
+    return decorator
+
+# Budget declared on the view for the request method, None if there is none
+def get_query_budget(view, method):
+    budget = getattr(view, 'query_budget', None)
+    if method.upper() == 'POST':
+        return getattr(view, 'query_budget_post', budget)
+    return budget
+
+class QueryStats(object):
+    # queries is a list of {'sql': ..., 'time': ...} dicts as found in
+    # connection.queries
+    def __init__(self, queries):
+        self.queries = list(queries)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    # Total time spent in the database in seconds
+    @property
+    def time(self):
+        return sum(float(query['time']) for query in self.queries)
+
+    # Fingerprints of the queries issued more than once, with their counts.
+    # This is where N+1 patterns show up.
+    @property
+    def duplicates(self):
+        counts = {}
+        for query in self.queries:
+            key = fingerprint(query['sql'])
+            counts[key] = counts.get(key, 0) + 1
+        return dict((key, count) for key, count in counts.items() if count > 1)
+
+    def report(self):
+        lines = ["%d queries in %.1f ms" % (self.count, self.time * 1000)]
+        for key, count in sorted(self.duplicates.items(), key=lambda item: -item[1]):
+            lines.append("  %dx %s" % (count, key))
+        return "\n".join(lines)
+
+class QueryStatsMiddleware(object):
+    def enabled(self):
+        return getattr(settings, 'KURS_QUERY_STATS', settings.DEBUG)
+
+    def process_request(self, request):
+        if not self.enabled():
+            return
+        # Queries are only recorded on debug cursors
+        request._query_stats_start = {}
+        for connection in connections.all():
+            request._query_stats_start[connection.alias] = (len(connection.queries),
+                                                            connection.use_debug_cursor)
+            connection.use_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func, request.method)
+
+    def process_response(self, request, response):
+        start = getattr(request, '_query_stats_start', None)
+        if start is None:
+            return response
+
+        queries = []
+        for connection in connections.all():
+            if connection.alias not in start:
+                continue
+            offset, use_debug_cursor = start[connection.alias]
+            queries.extend(connection.queries[offset:])
+            connection.use_debug_cursor = use_debug_cursor
+        stats = request.query_stats = QueryStats(queries)
+
+        response['X-Query-Count'] = str(stats.count)
+        response['X-Query-Time'] = "%.1f" % (stats.time * 1000)
+
+        budget = getattr(request, 'query_budget', None)
+        if budget is not None and stats.count > budget:
+            logger.warning("Query budget exceeded: %s %s , budget=%d\n%s" %
+                           (request.method, request.path, budget, stats.report()))
+        elif stats.duplicates and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Repeated queries: %s %s\n%s" %
+                         (request.method, request.path, stats.report()))
+        return response
+
+# TestCase mixin to check views against their declared query budget
+class QueryBudgetMixin(object):
+    # Request the path with the test client and fail if the view issues more
+    # queries than its budget. The budget declared on the view for the method
+    # is used unless one is given. Returns the response.
+    def assertWithinQueryBudget(self, path, budget=None, method='get', **kwargs):
+        if budget is None:
+            budget = get_query_budget(resolve(path).func, method)
+        if budget is None:
+            self.fail("%s has no query budget" % path)
+        with CaptureQueriesContext(connections['default']) as context:
+            response = getattr(self.client, method)(path, **kwargs)
+        stats = QueryStats(context.captured_queries)
+        if stats.count > budget:
+            self.fail("%s issued more queries than its budget of %d: %s" %
+                      (path, budget, stats.report()))
+        return response
@@ -0,0 +1,85 @@
+# coding=utf-8
+
+# Read-only traffic on a replica database.
+#
+# Reads go to the replica alias (KURS_REPLICA_DATABASE, "replica" by
+# default) only when they are explicitly allowed, everything else uses the
+# primary ("default"). ReplicaRoutingMiddleware allows them for GET and
+# HEAD requests, unless the view is marked with use_primary or the client
+# wrote something in the last KURS_REPLICA_PIN_SECONDS seconds: a request
+# that writes sets a short-lived cookie that keeps the following requests
+# of the client on the primary, so users see their own changes while the
+# replica catches up. Code outside requests, exports for example, uses
+# replica_reads() or queryset.using(replica_alias()).
+#
+# Reads inside a transaction on the primary always stay on the primary.
+# Without a replica alias in DATABASES the router does nothing.
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_COOKIE = 'kurs_primary'
+
+def replica_alias():
+    alias = getattr(settings, 'KURS_REPLICA_DATABASE', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+# Allow reads on the replica in the block
+@contextmanager
+def replica_reads(enabled=True):
+    previous = getattr(_state, 'replica', False)
+    _state.replica = enabled
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+# Mark a view that writes even on GET, or that must read from the primary
+def use_primary(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return view(*args, **kwargs)
+    wrapper.use_primary = True
+    return wrapper
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', False) and \
+                not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    # The replica is a copy of the primary, see the sync_replica command
+    def allow_syncdb(self, db, model):
+        return db != replica_alias()
+
+class ReplicaRoutingMiddleware(object):
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._kurs_writes = request.method not in SAFE_METHODS or \
+            getattr(view_func, 'use_primary', False)
+        _state.replica = replica_alias() is not None and not request._kurs_writes and \
+            PIN_COOKIE not in request.COOKIES
+
+    def process_response(self, request, response):
+        _state.replica = False
+        if getattr(request, '_kurs_writes', False) and replica_alias() is not None:
+            response.set_cookie(PIN_COOKIE, '1',
+                                max_age=getattr(settings, 'KURS_REPLICA_PIN_SECONDS', 5),
+                                httponly=True)
+        return response
+
+    def process_exception(self, request, exception):
+        _state.replica = False
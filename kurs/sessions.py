@@ -0,0 +1,119 @@
+# coding=utf-8
+
+# Sessions kept in the cache and written to the database behind it.
+#
+# Requests read the session from the cache, the database is only read when
+# the cache lost it. Changes go to the cache at once and to the database at
+# most every KURS_SESSION_WRITE_INTERVAL seconds, or right away when the
+# session is new or its user changes (login, logout). When the cache is
+# cleared a session loses at most the changes of the last interval, never
+# its user.
+#
+# Every process must see the same cache (memcached for example). With a
+# cache per process, as locmem, a logout in one process is not seen by the
+# others until their copy expires.
+#
+# The expiry date of the database row is only moved with the writes, the
+# cache copy is kept no longer than the row: clearsessions does not delete
+# the row of a session still served from the cache.
+#
+#     SESSION_ENGINE = 'kurs.sessions'
+
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+
+KEY_PREFIX = "kurs:session:"
+
+class SessionStore(DBStore):
+    def __init__(self, session_key=None):
+        super(SessionStore, self).__init__(session_key)
+        # (time, user id) of the database copy, None while there is none
+        self._stored = None
+
+    @property
+    def cache_key(self):
+        return KEY_PREFIX + self._get_or_create_session_key()
+
+    def load(self):
+        try:
+            record = cache.get(self.cache_key)
+        except Exception:
+            # memcached rejects invalid keys, start a new session then
+            record = None
+        if record is not None:
+            data, self._stored = record
+            return data
+
+        session_key = self.session_key
+        data = super(SessionStore, self).load()
+        # A new session is created when the key is not in the database either
+        if self.session_key == session_key:
+            self._stored = (time.time(), data.get(SESSION_KEY))
+            cache.set(self.cache_key, (data, self._stored),
+                      self.get_expiry_age(expiry=data.get('_session_expiry')))
+        return data
+
+    def exists(self, session_key):
+        if (KEY_PREFIX + session_key) in cache:
+            return True
+        return super(SessionStore, self).exists(session_key)
+
+    # The new key is reserved in the cache, the database copy is written
+    # when the session is saved at the end of the request
+    def create(self):
+        while True:
+            self._session_key = self._get_new_session_key()
+            if cache.add(self.cache_key, ({}, None), self.get_expiry_age(expiry=None)):
+                break
+        self._stored = None
+        self.modified = True
+        self._session_cache = {}
+
+    def save(self, must_create=False):
+        data = self._get_session(no_load=must_create)
+        user = data.get(SESSION_KEY)
+        now = time.time()
+        if self._stored is None:
+            # Empty new sessions (after a logout for example) stay in the
+            # cache, a process that does not find them starts an empty one
+            stale = bool(data)
+        else:
+            stale = self._stored[1] != user or \
+                now - self._stored[0] >= getattr(settings, 'KURS_SESSION_WRITE_INTERVAL', 60)
+        if must_create or stale:
+            try:
+                super(SessionStore, self).save(must_create=must_create or self._stored is None)
+            except CreateError:
+                if must_create:
+                    raise
+                # A concurrent request wrote the first database copy
+                super(SessionStore, self).save()
+            self._stored = (now, user)
+        timeout = self.get_expiry_age()
+        if self._stored is not None:
+            # The database row expires timeout seconds after it was written
+            timeout -= int(now - self._stored[0])
+        cache.set(self.cache_key, (data, self._stored), max(timeout, 1))
+
+    # Logging in without a session does not delete the new one
+    def cycle_key(self):
+        data = self._session
+        key = self.session_key
+        self.create()
+        self._session_cache = data
+        if key is not None:
+            self.delete(key)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        cache.delete(KEY_PREFIX + session_key)
+        Session.objects.filter(session_key=session_key).delete()
@@ -0,0 +1,51 @@
+# coding=utf-8
+
+# Warm up of a worker before it serves requests.
+#
+# Django imports the URLconf, the views and the admin, loads the middleware
+# and the translations with the first request, which then takes much longer
+# than the others. warm_up does this work when the WSGI application is
+# created instead (KURS_WARM_UP, see lkd/wsgi.py). With a server that loads
+# the application before forking its workers, the workers share the warmed
+# modules and templates:
+#
+#     gunicorn --preload --workers 4 lkd.wsgi:application
+#
+# Nothing that must not be shared between processes is kept: database
+# connections are closed, the log writer threads and libmagic are started
+# by every process when first used.
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import get_resolver
+from django.db import connections
+from django.template.loader import get_template
+from django.utils import translation
+from kurs.log import log_event
+
+logger = logging.getLogger(__name__)
+
+# Templates of the pages most requests go to
+TEMPLATES = ('base.html', 'kurs/index.html', 'kurs/event_list.html',
+             'kurs/list_courses.html', 'kurs/course_detail.html')
+
+def warm_up(application=None):
+    started = time.time()
+    # Imports the URLconf and with it the views, forms and the admin
+    get_resolver(None).reverse_dict
+    if application is not None and application._request_middleware is None:
+        application.load_middleware()
+
+    translation.activate(settings.LANGUAGE_CODE)
+    try:
+        for name in TEMPLATES:
+            get_template(name)
+    finally:
+        translation.deactivate()
+
+    for connection in connections.all():
+        connection.close()
+    log_event(logger, 'warm_up', u"Uygulama hazırlandı",
+              seconds=round(time.time() - started, 3))
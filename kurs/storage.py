@@ -0,0 +1,60 @@
+# coding=utf-8
+
+# Content-addressed storage for permit files.
+#
+# Files are stored under the SHA-256 of their content, so identical uploads
+# share a single file and are written only once. A file is referenced by the
+# ApplicationPermit rows holding its name. Files no row refers to are left
+# on disk and deleted by the collect_permit_files command, run from cron,
+# once they have not been modified for --min-age seconds. Reusing a file
+# touches it, so the collector leaves it alone while the row is saved.
+
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+class ContentAddressedStorage(FileSystemStorage):
+    # prefix is the directory of the files relative to the storage location
+    def __init__(self, prefix, *args, **kwargs):
+        self.prefix = prefix
+        super(ContentAddressedStorage, self).__init__(*args, **kwargs)
+
+    # Files received through PermitUploadHandler are hashed already
+    def content_hash(self, content):
+        digest = getattr(content, 'sha256', None) or \
+                 getattr(getattr(content, 'file', None), 'sha256', None)
+        if digest:
+            return digest
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        content.seek(0)
+        return sha256.hexdigest()
+
+    # The name given by the field only contributes its extension
+    def address(self, digest, name):
+        extension = os.path.splitext(name)[1].lower()
+        return "%s/%s/%s/%s%s" % (self.prefix, digest[:2], digest[2:4], digest, extension)
+
+    def save(self, name, content):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content)
+        name = self.address(self.content_hash(content), name)
+        if self.exists(name):
+            try:
+                os.utime(self.path(name), None)
+                return name
+            except OSError:
+                # Deleted in between, it is written again
+                pass
+        # Written under a temporary name and renamed, concurrent uploads of
+        # the same content can not leave a partial file behind
+        partial = super(ContentAddressedStorage, self).save(name + ".part", content)
+        os.rename(self.path(partial), self.path(name))
+        return name
+
+permit_storage = ContentAddressedStorage("kurs/application_permits")
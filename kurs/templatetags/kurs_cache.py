@@ -0,0 +1,62 @@
+# coding=utf-8
+
+# Fragment caching for catalog pages.
+#
+#     {% load kurs_cache %}
+#     {% catalogcache event_list %} ... {% endcatalogcache %}
+#     {% eventcache course_list event_id [var ...] %} ... {% endeventcache %}
+#
+# The fragments are cached under the version of the catalog or of the event
+# (see kurs/cache.py), the active language and the values of the optional
+# variables, so they change as soon as an event or a course changes. Views
+# do not have to put the versions in the context.
+
+import hashlib
+
+from django import template
+from django.core.cache import cache
+from django.utils import translation
+from kurs.cache import get_catalog_version, get_event_version
+from kurs.catalog import CATALOG_CACHE_TIMEOUT
+
+register = template.Library()
+
+class CatalogCacheNode(template.Node):
+    def __init__(self, nodelist, name, event_id, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.event_id = event_id
+        self.vary_on = vary_on
+
+    def render(self, context):
+        if self.event_id is None:
+            version = get_catalog_version()
+        else:
+            version = get_event_version(self.event_id.resolve(context))
+        values = u":".join(unicode(var.resolve(context)) for var in self.vary_on)
+        key = "kurs:fragment:%s:%s:%s:%s" % (self.name, version, translation.get_language(),
+                                            hashlib.md5(values.encode('utf-8')).hexdigest())
+        value = cache.get(key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(key, value, CATALOG_CACHE_TIMEOUT)
+        return value
+
+def _parse(parser, token, with_event):
+    bits = token.split_contents()
+    end = 'end' + bits[0]
+    if len(bits) < (3 if with_event else 2):
+        raise template.TemplateSyntaxError("'%s' tag requires more arguments" % bits[0])
+    nodelist = parser.parse((end,))
+    parser.delete_first_token()
+    event_id = parser.compile_filter(bits[2]) if with_event else None
+    vary_on = [parser.compile_filter(bit) for bit in bits[3 if with_event else 2:]]
+    return CatalogCacheNode(nodelist, bits[1], event_id, vary_on)
+
+@register.tag
+def catalogcache(parser, token):
+    return _parse(parser, token, False)
+
+@register.tag
+def eventcache(parser, token):
+    return _parse(parser, token, True)
@@ -1,16 +1,1447 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.conf import settings
+from django.http import HttpResponse
+from django.template import Template, Context
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from StringIO import StringIO
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+import codecs
+import json
+import logging
+import threading
+import time
+from xml.etree import ElementTree
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction, IntegrityError
+from django.utils.timezone import now as tz_aware_now
+from kurs.models import Event, Course, Application, CourseFull, AlreadyApplied
+from kurs.models import OutgoingEmail, ApplicationChoices
+from kurs.models import ApplicationPermit, UserProfile, AuditBatch
+from kurs.allocation import allocate_event
+from kurs.querystats import QueryBudgetMixin, QueryStats, fingerprint
+from kurs.uploadhandlers import PermitUploadHandler
+from kurs.storage import permit_storage
+from kurs.zipstream import stream_zip, ZIP_DEFLATED, ZIP_STORED
+from kurs.export import application_rows, export_applications, BATCH_SIZE
+from kurs.log import QueueHandler, QueueRotatingFileHandler, JSONFormatter, log_event
+from kurs import routers
+from kurs.enrollment import get_user_enrollments
+from kurs.cache import bump_user_versions, bump_event_versions, get_user_version
+from kurs.admission import waiting_room, WaitingRoom, ADMITTED, QUEUED, THROTTLED, \
+    admission_control, TICKET_COOKIE
+from django.contrib.auth.models import AnonymousUser
+from kurs.sessions import SessionStore
+from django.contrib.sessions.models import Session
+from kurs.routers import ReplicaRouter, ReplicaRoutingMiddleware, PIN_COOKIE, replica_reads, \
+    use_primary
+from kurs.importtime import ImportProfiler
+from kurs.db import write_transaction
+from kurs.backends.sqlite3 import base as backend
+from django.db import connections
+import sqlite3
+from kurs.startup import warm_up
+from django.core.handlers.wsgi import WSGIHandler
+import sys
 
-Replace this with more appropriate tests for your application.
-"""
 
-from django.test import TestCase
 
+def create_course(event, capacity=0, **kwargs):
+    now = tz_aware_now()
+    defaults = dict(event=event, display_name="course", description="", agreement="",
+                    is_open=True, change_allowed_date=now + timedelta(days=1),
+                    start_date=now.date(), end_date=now.date(), capacity=capacity)
+    defaults.update(kwargs)
+    return Course.objects.create(**defaults)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+
+class SeatReservationTest(TestCase):
+    def setUp(self):
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.users = [User.objects.create(username="user%d" % i) for i in range(3)]
+
+    def test_apply_reserves_seat(self):
+        course = create_course(self.event, capacity=2)
+        Application.objects.apply(self.users[0], course)
+        self.assertEqual(Course.objects.get(pk=course.pk).seats_taken, 1)
+
+    def test_full_course_rejects(self):
+        course = create_course(self.event, capacity=1)
+        Application.objects.apply(self.users[0], course)
+        self.assertRaises(CourseFull, Application.objects.apply, self.users[1], course)
+        self.assertEqual(Application.objects.filter(course=course).count(), 1)
+
+    def test_unlimited_capacity(self):
+        course = create_course(self.event)
+        for user in self.users:
+            Application.objects.apply(user, course)
+        self.assertEqual(Course.objects.get(pk=course.pk).seats_taken, 3)
+
+    def test_closed_course_rejects(self):
+        course = create_course(self.event, is_open=False)
+        self.assertRaises(CourseFull, Application.objects.apply, self.users[0], course)
+
+    def test_second_course_in_event_rejected_and_seat_released(self):
+        first = create_course(self.event, capacity=5)
+        second = create_course(self.event, capacity=5)
+        Application.objects.apply(self.users[0], first)
+        self.assertRaises(AlreadyApplied, Application.objects.apply, self.users[0], second)
+        self.assertEqual(Course.objects.get(pk=second.pk).seats_taken, 0)
+
+    def test_event_is_unique_per_user_in_database(self):
+        first = create_course(self.event)
+        second = create_course(self.event)
+        application = Application.objects.create(person=self.users[0], course=first,
+                                                 application_date=tz_aware_now())
+        self.assertEqual(application.event_id, self.event.id)
+        with transaction.atomic():
+            self.assertRaises(IntegrityError, Application.objects.create, person=self.users[0],
+                              course=second, application_date=tz_aware_now())
+
+    def test_course_moved_to_another_event(self):
+        course = create_course(self.event)
+        application = Application.objects.apply(self.users[0], course)
+        other = Event.objects.create(display_name="other", venue="venue")
+        course.event = other
+        course.save()
+        self.assertEqual(Application.objects.get(pk=application.pk).event_id, other.id)
+
+    def test_backfill(self):
+        application = Application.objects.apply(self.users[0], create_course(self.event))
+        Application.objects.filter(pk=application.pk).update(
+            event=Event.objects.create(display_name="other", venue="venue"))
+        stdout = StringIO()
+        call_command('backfill_application_events', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), "1 application(s) updated\n")
+        self.assertEqual(Application.objects.get(pk=application.pk).event_id, self.event.id)
+
+    def test_delete_releases_seat(self):
+        course = create_course(self.event, capacity=1)
+        Application.objects.apply(self.users[0], course).delete()
+        self.assertEqual(Course.objects.get(pk=course.pk).seats_taken, 0)
+        Application.objects.apply(self.users[1], course)
+
+    def test_recount_seats(self):
+        course = create_course(self.event)
+        Application.objects.create(person=self.users[0], course=course,
+                                   application_date=tz_aware_now())
+        Course.objects.recount_seats([course.pk])
+        self.assertEqual(Course.objects.get(pk=course.pk).seats_taken, 1)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    def send_messages(self, messages):
+        raise IOError("SMTP server is down")
+
+
+class OutboxTest(TestCase):
+    def setUp(self):
+        OutgoingEmail.objects.enqueue([("subject %d" % i, "body", "from@example.com",
+                                        "to%d@example.com" % i) for i in range(3)])
+
+    def test_send_outbox(self):
+        call_command('send_outbox', batch_size=2, stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertFalse(OutgoingEmail.objects.filter(sent_date__isnull=True).exists())
+        # Sent messages are not sent again
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 3)
+
+    def test_claimed_messages_are_not_sent_by_other_runs(self):
+        claimed = OutgoingEmail.objects.claim(max_attempts=5, limit=2, lease=600)
+        self.assertEqual(len(claimed), 2)
+        call_command('send_outbox', stdout=StringIO())
+        self.assertEqual([message.to[0] for message in mail.outbox],
+                         [message.to for message in OutgoingEmail.objects.exclude(
+                             id__in=[message.id for message in claimed])])
+        self.assertEqual(OutgoingEmail.objects.claim(max_attempts=5, limit=10, lease=600), [])
+
+    @override_settings(EMAIL_BACKEND='kurs.tests.FailingEmailBackend')
+    def test_failed_message_is_retried_later(self):
+        call_command('send_outbox', backoff=60, stdout=StringIO())
+        for message in OutgoingEmail.objects.all():
+            self.assertEqual(message.attempts, 1)
+            self.assertIsNone(message.sent_date)
+            self.assertTrue(message.next_attempt > tz_aware_now() + timedelta(seconds=50))
+        self.assertFalse(OutgoingEmail.objects.due(max_attempts=5).exists())
+
+
+class AllocationTest(TestCase):
+    def setUp(self):
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.popular = create_course(self.event, capacity=1)
+        self.second = create_course(self.event, capacity=1)
+        self.third = create_course(self.event, capacity=0)
+        now = tz_aware_now()
+        self.applications = []
+        for i in range(3):
+            user = User.objects.create(username="user%d" % i)
+            self.applications.append(Application.objects.create(
+                person=user, course=self.popular,
+                application_date=now + timedelta(minutes=i)))
+            ApplicationChoices.objects.create(person=user, event=self.event,
+                                              choice_number=1, choice=self.second)
+        # The last applicant can also go to an unlimited course
+        ApplicationChoices.objects.create(person=self.applications[2].person, event=self.event,
+                                          choice_number=2, choice=self.third)
+
+    def test_first_come_first_served(self):
+        allocation = allocate_event(self.event, None)
+        self.assertEqual((allocation.placed, allocation.moved, allocation.unplaced), (3, 2, 0))
+        courses = [Application.objects.get(pk=a.pk).course_id for a in self.applications]
+        self.assertEqual(courses, [self.popular.pk, self.second.pk, self.third.pk])
+        self.assertTrue(all(Application.objects.get(pk=a.pk).approved for a in self.applications))
+        self.assertEqual(Course.objects.get(pk=self.popular.pk).seats_taken, 1)
+        self.assertEqual(Course.objects.get(pk=self.third.pk).seats_taken, 1)
+
+    def test_approved_applications_keep_their_seats(self):
+        Application.objects.filter(pk=self.applications[1].pk).update(approved=True)
+        allocation = allocate_event(self.event, None, dry_run=True)
+        self.assertEqual(allocation.placements(),
+                         {self.second.pk: [self.applications[0].pk],
+                          self.third.pk: [self.applications[2].pk]})
+        # Dry run does not change anything
+        self.assertEqual(Application.objects.filter(course=self.popular).count(), 3)
+
+
+class QueryStatsTest(TestCase):
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id = 12 AND name = 'a''b'"),
+                         "SELECT * FROM t WHERE id = ? AND name = ?")
+        self.assertEqual(fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3)"),
+                         "SELECT * FROM t WHERE id IN (...)")
+
+    def test_duplicates(self):
+        stats = QueryStats([{'sql': "SELECT 1 FROM t WHERE id = %d" % i, 'time': '0.001'}
+                            for i in range(3)] + [{'sql': "SELECT 2", 'time': '0.002'}])
+        self.assertEqual(stats.count, 4)
+        self.assertEqual(stats.duplicates, {"SELECT ? FROM t WHERE id = ?": 3})
+
+
+# Every view in kurs/urls.py must stay within its query budget for a user
+# with many applications
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    APPLICATIONS = 50
+
+    def setUp(self):
+        # Requests of earlier tests must not count against the rate limits
+        waiting_room.reset()
+        self.user = User.objects.create_user("budget", "budget@example.com", "secret")
+        now = tz_aware_now()
+        self.applications = []
+        for i in range(self.APPLICATIONS):
+            event = Event.objects.create(display_name="event %d" % i, venue="venue",
+                                         allowed_choice_num=3)
+            courses = [create_course(event, display_name="course %d-%d" % (i, j), capacity=100)
+                       for j in range(4)]
+            application = Application.objects.create(person=self.user, course=courses[0],
+                                                     application_date=now)
+            ApplicationPermit.objects.create(application=application, file="kurs/permit.pdf")
+            for number, course in enumerate(courses[1:]):
+                ApplicationChoices.objects.create(person=self.user, event=event,
+                                                  choice_number=number + 1, choice=course)
+            self.applications.append(application)
+        self.event = self.applications[0].course.event
+        self.course = self.applications[0].course
+        self.open_course = create_course(Event.objects.create(display_name="new", venue="venue"))
+        self.client.login(username="budget", password="secret")
+        cache.clear()
+
+    def test_index(self):
+        self.assertWithinQueryBudget("/kurs/")
+
+    def test_event_list(self):
+        self.assertWithinQueryBudget("/kurs/etkinlik/")
+
+    def test_course_list(self):
+        self.assertWithinQueryBudget("/kurs/etkinlik/%d/" % self.event.id)
+
+    def test_choices_list(self):
+        self.assertWithinQueryBudget("/kurs/etkinlik/%d/tercihler/" % self.event.id)
+
+    def test_edit_choices(self):
+        self.assertWithinQueryBudget("/kurs/etkinlik/%d/tercihler/edit/" % self.event.id)
+
+    def test_edit_choices_post(self):
+        courses = self.event.course_set.exclude(pk=self.course.pk)
+        data = {'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 0, 'form-MAX_NUM_FORMS': 3}
+        for i, course in enumerate(reversed(courses)):
+            data['form-%d-choice' % i] = course.id
+        response = self.assertWithinQueryBudget(
+            "/kurs/etkinlik/%d/tercihler/edit/" % self.event.id, method='post', data=data)
+        self.assertRedirects(response, "/kurs/etkinlik/%d/tercihler/" % self.event.id)
+
+    def test_course_detail(self):
+        self.assertWithinQueryBudget("/kurs/kurs/%d/" % self.course.id)
+
+    def test_apply(self):
+        self.assertWithinQueryBudget("/kurs/kurs/%d/basvur/" % self.open_course.id)
+
+    def test_apply_post(self):
+        response = self.assertWithinQueryBudget("/kurs/kurs/%d/basvur/" % self.open_course.id,
+                                                method='post')
+        self.assertRedirects(response, "/kurs/etkinlik/%d/tercihler/" % self.open_course.event_id)
+
+    def test_cancel_application(self):
+        self.assertWithinQueryBudget("/kurs/basvurular/%d/iptal/" % self.applications[0].id)
+
+    def test_upload_permit(self):
+        self.assertWithinQueryBudget("/kurs/basvurular/%d/izin/" % self.applications[0].id)
+
+    def test_application_list(self):
+        self.assertWithinQueryBudget("/kurs/basvurular/")
+
+    def test_application_list_cache(self):
+        self.client.get("/kurs/basvurular/")
+        # Served from the cache, only session and user are read
+        with self.assertNumQueries(2):
+            self.client.get("/kurs/basvurular/")
+        # Changes of the user's applications invalidate the cache
+        ApplicationPermit.objects.filter(application=self.applications[0]).delete()
+        response = self.client.get("/kurs/basvurular/")
+        self.assertContains(response, "/kurs/basvurular/%d/izin/" % self.applications[0].id)
+        self.assertNotContains(response, "/kurs/basvurular/%d/izin/\">Upload new" % self.applications[0].id)
+
+
+class EditChoicesTest(TestCase):
+    def setUp(self):
+        waiting_room.reset()
+        self.user = User.objects.create_user("user", "user@example.com", "secret")
+        self.event = Event.objects.create(display_name="event", venue="venue",
+                                          allowed_choice_num=3)
+        self.courses = [create_course(self.event, display_name="course %d" % i)
+                        for i in range(5)]
+        Application.objects.apply(self.user, self.courses[0])
+        self.path = "/kurs/etkinlik/%d/tercihler/edit/" % self.event.id
+        self.client.login(username="user", password="secret")
+
+    def post_choices(self, *courses):
+        data = {'form-TOTAL_FORMS': len(courses), 'form-INITIAL_FORMS': 0,
+                'form-MAX_NUM_FORMS': 3}
+        for i, course in enumerate(courses):
+            data['form-%d-choice' % i] = course.id
+        return self.client.post(self.path, data)
+
+    def current_choices(self):
+        return list(ApplicationChoices.objects.filter(person=self.user)
+                    .order_by('choice_number').values_list('choice_id', flat=True))
+
+    def test_only_changed_choices_are_written(self):
+        self.post_choices(*self.courses[1:4])
+        first = ApplicationChoices.objects.get(person=self.user, choice_number=1)
+        response = self.post_choices(self.courses[1], self.courses[3], self.courses[4])
+        self.assertRedirects(response, "/kurs/etkinlik/%d/tercihler/" % self.event.id)
+        self.assertEqual(self.current_choices(),
+                         [self.courses[1].id, self.courses[3].id, self.courses[4].id])
+        unchanged = ApplicationChoices.objects.get(person=self.user, choice_number=1)
+        self.assertEqual((unchanged.id, unchanged.last_update), (first.id, first.last_update))
+
+    def test_query_count_does_not_depend_on_choices(self):
+        self.post_choices(*self.courses[1:4])
+        self.client.get(self.path)
+        # session, user, previous choices, delete (select and delete), insert
+        # and the two statements of the transaction. The application comes
+        # from the enrollment index cached by the previous request.
+        with self.assertNumQueries(8):
+            self.post_choices(self.courses[4], self.courses[3], self.courses[2])
+        self.assertEqual(self.current_choices(),
+                         [self.courses[4].id, self.courses[3].id, self.courses[2].id])
+
+    def test_duplicate_choices_are_rejected(self):
+        response = self.post_choices(self.courses[1], self.courses[1], self.courses[2])
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Each course can be chosen only once.")
+        self.assertEqual(self.current_choices(), [])
+
+    def test_applied_course_is_not_a_choice(self):
+        response = self.client.get(self.path)
+        self.assertNotContains(response, "course 0")
+        self.assertContains(response, "course 4")
+
+
+# Permit files are written to a temporary directory
+class PermitStorageTestCase(TestCase):
+    PDF = "%PDF-1.4\n" + "0" * 4000 + "\n%%EOF\n"
+
+    def setUp(self):
+        self.storage_location = permit_storage.location
+        permit_storage.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(permit_storage.location)
+        permit_storage.location = self.storage_location
+
+    def stored_files(self):
+        return sorted(os.path.relpath(os.path.join(directory, filename), permit_storage.location)
+                      for directory, _, files in os.walk(permit_storage.location)
+                      for filename in files)
+
+class PermitUploadTest(QueryBudgetMixin, PermitStorageTestCase):
+    def setUp(self):
+        super(PermitUploadTest, self).setUp()
+        waiting_room.reset()
+        self.user = User.objects.create_user("user", "user@example.com", "secret")
+        self.application = Application.objects.apply(self.user, create_course(
+            Event.objects.create(display_name="event", venue="venue")))
+        self.path = "/kurs/basvurular/%d/izin/" % self.application.id
+        self.field = ApplicationPermit._meta.get_field('file')
+        self.client.login(username="user", password="secret")
+
+    # The test client sends the content type guessed from the file name
+    def upload(self, content, name="permit.pdf"):
+        return self.client.post(self.path, {'file': SimpleUploadedFile(name, content)},
+                                HTTP_ACCEPT_LANGUAGE='en')
+
+    def test_query_budget(self):
+        for content in (self.PDF, self.PDF + "\n"):
+            response = self.assertWithinQueryBudget(
+                self.path, method='post', data={'file': SimpleUploadedFile("permit.pdf", content)})
+            self.assertRedirects(response, "/kurs/basvurular/")
+
+    def test_accepted(self):
+        response = self.upload(self.PDF)
+        self.assertRedirects(response, "/kurs/basvurular/")
+        permit = ApplicationPermit.objects.get(application=self.application)
+        self.assertEqual(permit.file.read(), self.PDF)
+        digest = hashlib.sha256(self.PDF).hexdigest()
+        self.assertEqual(permit.file.name, "kurs/application_permits/%s/%s/%s.pdf" % (
+            digest[:2], digest[2:4], digest))
+
+    def test_wrong_type_is_rejected(self):
+        response = self.upload("just some text\n" * 100)
+        self.assertContains(response, "Files of type text/plain are not supported.")
+        self.assertFalse(ApplicationPermit.objects.exists())
+
+    def test_wrong_type_in_header_is_rejected(self):
+        response = self.upload(self.PDF, name="permit.txt")
+        self.assertContains(response, "Files of type application/pdf are not supported.")
+        self.assertFalse(ApplicationPermit.objects.exists())
+
+    def test_too_large_is_rejected_while_streaming(self):
+        max_upload_size = self.field.max_upload_size
+        self.field.max_upload_size = 1000
+        try:
+            response = self.upload(self.PDF)
+        finally:
+            self.field.max_upload_size = max_upload_size
+        self.assertContains(response, "Files of size greater than")
+        self.assertFalse(ApplicationPermit.objects.exists())
+
+    def test_too_large_request_is_not_read(self):
+        content = self.PDF + "0" * self.field.max_upload_size * 2
+        chunks = []
+        receive_data_chunk = PermitUploadHandler.receive_data_chunk
+        PermitUploadHandler.receive_data_chunk = lambda handler, raw_data, start: chunks.append(start)
+        try:
+            response = self.upload(content)
+        finally:
+            PermitUploadHandler.receive_data_chunk = receive_data_chunk
+        self.assertEqual(chunks, [])
+        self.assertContains(response, "Files of size greater than")
+        self.assertFalse(ApplicationPermit.objects.exists())
+
+
+class PermitStorageTest(PermitStorageTestCase):
+    def setUp(self):
+        super(PermitStorageTest, self).setUp()
+        course = create_course(Event.objects.create(display_name="event", venue="venue"))
+        self.applications = [Application.objects.apply(User.objects.create(username="user%d" % i), course)
+                             for i in range(3)]
+
+    def upload(self, application, content):
+        permit, created = ApplicationPermit.objects.get_or_create(application=application)
+        permit.file = SimpleUploadedFile("Permit.PDF", content)
+        permit.save()
+        return permit
+
+    def test_identical_uploads_are_stored_once(self):
+        names = set(self.upload(application, self.PDF).file.name
+                    for application in self.applications)
+        self.assertEqual(len(names), 1)
+        self.assertEqual(self.stored_files(), list(names))
+
+    def collect(self, **options):
+        output = StringIO()
+        call_command('collect_permit_files', min_age=0, stdout=output, **options)
+        return output.getvalue()
+
+    def test_replaced_file_is_collected_with_its_last_reference(self):
+        self.upload(self.applications[0], self.PDF)
+        shared = self.upload(self.applications[1], self.PDF).file.name
+        self.upload(self.applications[0], self.PDF + "changed")
+        self.collect()
+        self.assertIn(shared, self.stored_files())
+        self.upload(self.applications[1], self.PDF + "changed")
+        self.assertIn(shared, self.stored_files())
+        self.collect()
+        self.assertNotIn(shared, self.stored_files())
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_deleted_application_leaves_its_file_to_collect(self):
+        name = self.upload(self.applications[0], self.PDF).file.name
+        self.applications[0].delete()
+        self.assertEqual(self.stored_files(), [name])
+        self.collect()
+        self.assertEqual(self.stored_files(), [])
+
+    def test_reused_file_is_not_collected(self):
+        name = self.upload(self.applications[0], self.PDF).file.name
+        ApplicationPermit.objects.all().delete()
+        # Unreferenced for a day, then uploaded again
+        day_ago = time.time() - 86400
+        os.utime(permit_storage.path(name), (day_ago, day_ago))
+        self.assertEqual(self.upload(self.applications[1], self.PDF).file.name, name)
+        self.assertTrue(os.path.getmtime(permit_storage.path(name)) > day_ago + 3600)
+        ApplicationPermit.objects.all().delete()
+        call_command('collect_permit_files', min_age=3600, stdout=StringIO())
+        self.assertEqual(self.stored_files(), [name])
+
+    def test_collect_is_quiet_by_default(self):
+        self.upload(self.applications[0], self.PDF)
+        ApplicationPermit.objects.all().delete()
+        self.assertNotIn("deleting", self.collect(verbosity='1'))
+        self.upload(self.applications[0], self.PDF)
+        ApplicationPermit.objects.all().delete()
+        self.assertIn("deleting", self.collect(verbosity='2'))
+
+    def test_collect_permit_files(self):
+        permit = self.upload(self.applications[0], self.PDF)
+        # A file stored before content addressing and an unreferenced file
+        old_name = permit_storage.path("kurs/application_permits/2013/01/01/permit.pdf")
+        os.makedirs(os.path.dirname(old_name))
+        with open(old_name, "wb") as f:
+            f.write(self.PDF + "old")
+        ApplicationPermit.objects.filter(pk=permit.pk).update(
+            file="kurs/application_permits/2013/01/01/permit.pdf")
+        call_command('collect_permit_files', migrate=True, min_age=0, stdout=StringIO())
+        permit = ApplicationPermit.objects.get(pk=permit.pk)
+        self.assertEqual(permit.file.read(), self.PDF + "old")
+        self.assertEqual(self.stored_files(), [permit.file.name])
+
+
+class ZipStreamTest(TestCase):
+    def read(self, entries, **kwargs):
+        return zipfile.ZipFile(StringIO("".join(stream_zip(entries, **kwargs))))
+
+    def test_members(self):
+        date_time = (2013, 9, 1, 12, 30, 10)
+        for compression in (ZIP_DEFLATED, ZIP_STORED):
+            archive = self.read([(u"kurs/\u00e7ay.pdf", iter(["a" * 70000, "", "b"]), date_time),
+                                 ("empty", iter([]), date_time)], compression=compression)
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(archive.namelist(), [u"kurs/\u00e7ay.pdf", u"empty"])
+            self.assertEqual(archive.read(u"kurs/\u00e7ay.pdf"), "a" * 70000 + "b")
+            self.assertEqual(archive.read("empty"), "")
+            self.assertEqual(archive.getinfo("empty").date_time, date_time)
+
+    def test_zip64_directory(self):
+        count = 0x10000 + 1
+        archive = self.read((("%d" % i, iter(["x"]), None) for i in xrange(count)),
+                            compression=ZIP_STORED)
+        self.assertEqual(len(archive.infolist()), count)
+        self.assertEqual(archive.read("%d" % (count - 1)), "x")
+
+
+class PermitArchiveTest(PermitStorageTestCase):
+    def setUp(self):
+        super(PermitArchiveTest, self).setUp()
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        course = create_course(self.event, display_name="a/b")
+        for i in range(3):
+            application = Application.objects.apply(User.objects.create(username="user%d" % i), course)
+            if i < 2:
+                ApplicationPermit.objects.create(application=application,
+                    file=SimpleUploadedFile("permit.pdf", self.PDF + str(i)))
+        self.client.login(username="admin", password="secret")
+
+    def download(self, path, ids):
+        response = self.client.post(path, {'action': 'download_permits',
+                                           '_selected_action': ids})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(StringIO("".join(response.streaming_content)))
+
+    def test_event_permits(self):
+        archive = self.download("/admin/kurs/event/", [self.event.id])
+        self.assertEqual(archive.namelist(), ["event/a_b/user0.pdf", "event/a_b/user1.pdf"])
+        self.assertEqual(archive.read("event/a_b/user1.pdf"), self.PDF + "1")
+
+    def test_application_permits(self):
+        application = Application.objects.get(person__username="user1")
+        archive = self.download("/admin/kurs/application/", [application.id])
+        self.assertEqual(archive.namelist(), ["event/a_b/user1.pdf"])
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.event = Event.objects.create(display_name="event", venue="venue", allowed_choice_num=2)
+        courses = [create_course(self.event, display_name=u"course \u00e7 %d" % i) for i in range(3)]
+        for i in range(5):
+            user = User.objects.create_user("user%d" % i, "user%d@example.com" % i, "secret",
+                                            first_name="First", last_name="Last")
+            UserProfile.objects.create(user=user, company="company, %d" % i, mobile="5321234567")
+            application = Application.objects.apply(user, courses[i % 2])
+            ApplicationChoices.objects.create(person=user, event=self.event, choice_number=1,
+                                              choice=courses[2])
+        ApplicationPermit.objects.create(application=application, file="kurs/permit.pdf")
+
+    def rows(self, batch_size=BATCH_SIZE):
+        return list(application_rows(Application.objects.all(), batch_size))
+
+    def test_rows(self):
+        rows = self.rows()
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(len(rows[0]), 15)
+        self.assertEqual([row[2] for row in rows[1:]], ["user0", "user2", "user4", "user1", "user3"])
+        self.assertEqual(rows[1][6], "company, 0")
+        self.assertEqual(rows[1][13:], [u"course \u00e7 2", None])
+        self.assertEqual([row[12] for row in rows[1:]], [False, False, True, False, False])
+
+    def test_batches(self):
+        self.assertEqual(self.rows(batch_size=2), self.rows())
+        # the aggregate plus two queries per batch and a last empty batch
+        with self.assertNumQueries(1 + 2 * 3 + 1):
+            self.rows(batch_size=2)
+
+    def test_csv(self):
+        chunks, content_type = export_applications(Application.objects.all(), 'csv')
+        lines = "".join(chunks).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith(codecs.BOM_UTF8))
+        self.assertIn('"company, 0"', lines[1])
+        self.assertIn(u"course \u00e7 2".encode('utf-8'), lines[1])
+
+    def test_xlsx(self):
+        chunks, content_type = export_applications(Application.objects.all(), 'xlsx')
+        archive = zipfile.ZipFile(StringIO("".join(chunks)))
+        self.assertEqual(archive.testzip(), None)
+        sheet = ElementTree.fromstring(archive.read("xl/worksheets/sheet1.xml"))
+        namespace = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+        rows = sheet.findall("%ssheetData/%srow" % (namespace, namespace))
+        self.assertEqual(len(rows), 6)
+        cells = rows[1].findall(namespace + "c")
+        self.assertEqual(cells[2].get("r"), "C2")
+        self.assertEqual(cells[2].find("%sis/%st" % (namespace, namespace)).text, "user0")
+
+    def test_command(self):
+        output = StringIO()
+        call_command('export_applications', events=[self.event.id], stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 6)
+        path = tempfile.mktemp(suffix=".csv")
+        try:
+            call_command('export_applications', events=[self.event.id], output=path)
+            with open(path, "rb") as f:
+                self.assertEqual(len(f.read().splitlines()), 6)
+        finally:
+            os.remove(path)
+
+
+# Anonymous catalog pages are served from the cache
+class CatalogCacheTest(TestCase):
+    def setUp(self):
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.course = create_course(self.event, display_name="first course")
+        cache.clear()
+
+    # The course detail page reads the seats of the course
+    def assertCached(self, path, queries=0):
+        self.client.get(path)
+        with self.assertNumQueries(queries):
+            return self.client.get(path)
+
+    def assertCourseCached(self, course):
+        return self.assertCached("/kurs/kurs/%d/" % course.id, queries=1)
+
+    def test_warm_catalog_does_not_query(self):
+        self.assertContains(self.assertCached("/kurs/etkinlik/"), "event")
+        self.assertContains(self.assertCached("/kurs/etkinlik/%d/" % self.event.id), "first course")
+        self.assertContains(self.assertCourseCached(self.course), "first course")
+
+    def test_full_course_is_shown_from_cache(self):
+        self.assertNotContains(self.assertCourseCached(self.course), "This course is full.")
+        Course.objects.filter(pk=self.course.pk).update(capacity=1, seats_taken=1)
+        self.assertContains(self.client.get("/kurs/kurs/%d/" % self.course.id),
+                            "This course is full.")
+
+    def test_missing_objects(self):
+        self.assertCached("/kurs/etkinlik/%d/" % (self.event.id + 1))
+        self.client.get("/kurs/kurs/%d/" % (self.course.id + 1))
+        self.assertEqual(self.client.get("/kurs/kurs/%d/" % (self.course.id + 1)).status_code, 404)
+
+    def test_course_save_invalidates(self):
+        self.assertCached("/kurs/etkinlik/%d/" % self.event.id)
+        self.assertCourseCached(self.course)
+        self.course.display_name = "renamed course"
+        self.course.save()
+        self.assertContains(self.client.get("/kurs/etkinlik/%d/" % self.event.id), "renamed course")
+        self.assertContains(self.client.get("/kurs/kurs/%d/" % self.course.id), "renamed course")
+
+    def test_course_moved_to_another_event(self):
+        other = Event.objects.create(display_name="other", venue="venue")
+        self.assertCached("/kurs/etkinlik/%d/" % self.event.id)
+        self.course.event = other
+        self.course.save()
+        self.assertNotContains(self.client.get("/kurs/etkinlik/%d/" % self.event.id), "first course")
+        self.assertContains(self.client.get("/kurs/etkinlik/%d/" % other.id), "first course")
+
+    def test_event_save_invalidates(self):
+        self.assertCached("/kurs/etkinlik/")
+        Event.objects.create(display_name="second event", venue="venue")
+        self.assertContains(self.client.get("/kurs/etkinlik/"), "second event")
+
+    def test_admin_action_invalidates(self):
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.assertNotContains(self.assertCourseCached(self.course),
+                               "This course is not open for application.")
+        client = self.client_class()
+        client.login(username="admin", password="secret")
+        client.post("/admin/kurs/course/", {'action': 'change_course_is_open', 'post': 'yes',
+                                            'status': 'False', '_selected_action': [self.course.id]})
+        self.assertFalse(Course.objects.get(pk=self.course.pk).is_open)
+        self.assertContains(self.client.get("/kurs/kurs/%d/" % self.course.id),
+                            "This course is not open for application.")
+
+    def test_filtered_admin_action_invalidates(self):
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        Course.objects.filter(pk=self.course.pk).update(is_open=False)
+        before = Event.objects.get(pk=self.event.pk).last_modified
+        self.assertContains(self.assertCourseCached(self.course),
+                            "This course is not open for application.")
+        client = self.client_class()
+        client.login(username="admin", password="secret")
+        # The course no longer matches the filter once it is opened
+        client.post("/admin/kurs/course/?is_open__exact=0",
+                    {'action': 'change_course_is_open', 'post': 'yes',
+                     'status': 'True', '_selected_action': [self.course.id]})
+        self.assertTrue(Course.objects.get(pk=self.course.pk).is_open)
+        self.assertTrue(Event.objects.get(pk=self.event.pk).last_modified > before)
+        self.assertNotContains(self.client.get("/kurs/kurs/%d/" % self.course.id),
+                               "This course is not open for application.")
+
+
+# Unchanged pages are answered with 304 without rendering
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        waiting_room.reset()
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.course = create_course(self.event)
+        self.user = User.objects.create_user("user", "user@example.com", "secret")
+        cache.clear()
+
+    def revalidate(self, path, response):
+        headers = {'HTTP_IF_NONE_MATCH': response['ETag']}
+        if response.has_header('Last-Modified'):
+            headers['HTTP_IF_MODIFIED_SINCE'] = response['Last-Modified']
+        return self.client.get(path, **headers)
+
+    def test_catalog_pages(self):
+        # The course detail page reads the seats of the course
+        for path, queries in [("/kurs/etkinlik/", 0), ("/kurs/etkinlik/%d/" % self.event.id, 0),
+                              ("/kurs/kurs/%d/" % self.course.id, 1)]:
+            response = self.client.get(path)
+            self.assertTrue(response.has_header('Last-Modified'))
+            with self.assertNumQueries(queries):
+                self.assertEqual(self.revalidate(path, response).status_code, 304)
+
+    def test_course_filling_up_changes_course_detail(self):
+        path = "/kurs/kurs/%d/" % self.course.id
+        response = self.client.get(path)
+        Course.objects.filter(pk=self.course.pk).update(capacity=1, seats_taken=1)
+        self.assertEqual(self.revalidate(path, response).status_code, 200)
+
+    def test_course_change_modifies_event(self):
+        path = "/kurs/etkinlik/%d/" % self.event.id
+        response = self.client.get(path)
+        self.course.display_name = "renamed"
+        self.course.save()
+        self.assertTrue(Event.objects.get(pk=self.event.pk).last_modified >= self.course.last_modified)
+        self.assertEqual(self.revalidate(path, response).status_code, 200)
+
+    def test_bulk_update_modifies_course(self):
+        before = Course.objects.get(pk=self.course.pk).last_modified
+        User.objects.create_superuser("admin", "admin@example.com", "secret")
+        client = self.client_class()
+        client.login(username="admin", password="secret")
+        client.post("/admin/kurs/course/", {'action': 'change_course_is_open', 'post': 'yes',
+                                            'status': 'False', '_selected_action': [self.course.id]})
+        self.assertTrue(Course.objects.get(pk=self.course.pk).last_modified > before)
+        self.assertTrue(Event.objects.get(pk=self.event.pk).last_modified > before)
+
+    def test_course_detail_depends_on_user(self):
+        path = "/kurs/kurs/%d/" % self.course.id
+        anonymous = self.client.get(path)
+        self.client.login(username="user", password="secret")
+        response = self.client.get(path)
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertNotEqual(response['ETag'], anonymous['ETag'])
+        self.assertEqual(self.revalidate(path, response).status_code, 304)
+        Application.objects.apply(self.user, self.course)
+        self.assertEqual(self.revalidate(path, response).status_code, 200)
+
+    def test_application_list(self):
+        self.client.login(username="user", password="secret")
+        Application.objects.apply(self.user, self.course)
+        response = self.client.get("/kurs/basvurular/")
+        # Only session and user are read
+        with self.assertNumQueries(2):
+            self.assertEqual(self.revalidate("/kurs/basvurular/", response).status_code, 304)
+        Application.objects.all().delete()
+        self.assertEqual(self.revalidate("/kurs/basvurular/", response).status_code, 200)
+
+    def test_pending_messages_are_rendered(self):
+        self.client.login(username="user", password="secret")
+        response = self.client.get("/kurs/basvurular/")
+        # Applying to a closed course leaves an error message
+        Course.objects.filter(pk=self.course.pk).update(is_open=False)
+        self.client.get("/kurs/kurs/%d/basvur/" % self.course.id)
+        self.assertEqual(self.revalidate("/kurs/basvurular/", response).status_code, 200)
+
+
+# Admin changelists must render in a constant number of queries
+class AdminQueryBudgetTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "secret")
+        event = Event.objects.create(display_name="event", venue="venue")
+        course = create_course(event, capacity=100)
+        now = tz_aware_now()
+        for i in range(50):
+            user = User.objects.create_user("user%d" % i, "user%d@example.com" % i, "secret")
+            UserProfile.objects.create(user=user, company="company %d" % i)
+            application = Application.objects.create(person=user, course=course,
+                                                     application_date=now, approved_by=self.admin)
+            if i % 2:
+                ApplicationPermit.objects.create(application=application, file="kurs/permit.pdf")
+        self.client.login(username="admin", password="secret")
+
+    def test_application_changelist(self):
+        self.assertWithinQueryBudget("/admin/kurs/application/", budget=10)
+
+    def test_applicationpermit_changelist(self):
+        self.assertWithinQueryBudget("/admin/kurs/applicationpermit/", budget=10)
+
+    def test_user_changelist(self):
+        self.assertWithinQueryBudget("/admin/auth/user/", budget=10)
+
+    def test_event_changelist(self):
+        response = self.assertWithinQueryBudget("/admin/kurs/event/", budget=10)
+        self.assertContains(response, "<td>venue</td><td>2</td><td>50</td>")
+
+    def test_sort_by_computed_column(self):
+        # Columns are numbered from 1, the checkbox column comes first
+        self.assertWithinQueryBudget("/admin/kurs/applicationpermit/?o=1", budget=10)
+        self.assertWithinQueryBudget("/admin/kurs/application/?o=-4", budget=10)
+        self.assertWithinQueryBudget("/admin/auth/user/?o=7", budget=10)
+
+
+class StructuredLoggingTest(TestCase):
+    def setUp(self):
+        waiting_room.reset()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "kurs.log")
+        self.handler = QueueRotatingFileHandler(self.filename)
+        self.handler.setFormatter(JSONFormatter())
+        self.logger = logging.getLogger("kurs.tests.logging")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+        shutil.rmtree(self.directory)
+
+    def written(self):
+        self.handler.flush()
+        with codecs.open(self.filename, encoding='utf-8') as log:
+            return [json.loads(line) for line in log]
+
+    def test_event_fields(self):
+        user = User.objects.create_user("logger", "logger@example.com", "secret")
+        event = Event.objects.create(display_name="event", venue="venue")
+        request = RequestFactory().post("/", REMOTE_ADDR="10.0.0.1")
+        request.user = user
+        log_event(self.logger, 'apply', u"Ba\u015fvuru yap\u0131ld\u0131", request, event=event, choices=[1, 2])
+
+        record, = self.written()
+        self.assertEqual(record['message'], u"Ba\u015fvuru yap\u0131ld\u0131")
+        self.assertEqual(record['level'], "INFO")
+        self.assertEqual((record['action'], record['user'], record['ip'], record['event'],
+                          record['choices']), ('apply', "logger", "10.0.0.1", event.pk, [1, 2]))
+
+    def test_exception(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception("hata")
+        record, = self.written()
+        self.assertIn("ZeroDivisionError", record['exception'])
+
+    def test_full_queue_drops_records(self):
+        handler = QueueHandler(logging.NullHandler(), queue_size=1)
+        writing = threading.Event()
+        release = threading.Event()
+        handler.handler.handle = lambda record: (writing.set(), release.wait())
+        record = self.logger.makeRecord(self.logger.name, logging.INFO, "", 0, "x", (), None)
+        handler.emit(record)
+        writing.wait(5)
+        handler.emit(record)
+        handler.emit(record)
+        self.assertEqual(handler.dropped, 1)
+        release.set()
+        handler.close()
+
+    @override_settings(KURS_LOG_STATS=True)
+    def test_stats_headers(self):
+        User.objects.create_user("logger", "logger@example.com", "secret")
+        course = create_course(Event.objects.create(display_name="event", venue="venue"),
+                               capacity=10)
+        self.client.login(username="logger", password="secret")
+        response = self.client.get("/kurs/kurs/%d/basvur/" % course.id)
+        self.assertEqual(response['X-Log-Records'], "1")
+        self.assertIn('X-Log-Time', response)
+
+
+class AuditTrailTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser("admin", "admin@example.com", "secret")
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.course = create_course(self.event, capacity=100)
+        now = tz_aware_now()
+        self.applications = []
+        for i in range(30):
+            user = User.objects.create_user("user%d" % i, "user%d@example.com" % i, "secret")
+            self.applications.append(Application.objects.create(person=user, course=self.course,
+                                                                application_date=now))
+        self.client.login(username="admin", password="secret")
+
+    def test_record_takes_two_statements(self):
+        ContentType.objects.get_for_model(Application)
+        with self.assertNumQueries(2):
+            batch = AuditBatch.objects.record(self.admin, 'approve', Application.objects.all())
+        self.assertEqual(sorted(batch.entries.values_list('object_id', flat=True)),
+                         sorted(application.id for application in self.applications))
+
+    def test_approval_is_recorded(self):
+        # The changelist filter no longer matches the applications once
+        # they are approved
+        selected = [application.id for application in self.applications[:20]]
+        self.client.post("/admin/kurs/application/?approved__exact=0",
+                         {'action': 'change_application_approved', 'post': 'yes',
+                          'status': 'True', '_selected_action': selected})
+        batch = AuditBatch.objects.get()
+        self.assertEqual((batch.user, batch.action, batch.content_type.model_class()),
+                         (self.admin, 'approve', Application))
+        self.assertEqual(sorted(batch.entries.values_list('object_id', flat=True)), selected)
+        self.assertEqual(Application.objects.filter(approved=True).count(), 20)
+
+    def test_filtered_approval_notifies_and_invalidates(self):
+        application = self.applications[0]
+        version = get_user_version(application.person_id)
+        self.assertEqual(get_user_enrollments(application.person_id),
+                         {self.event.id: (self.course.id, False)})
+        self.client.post("/admin/kurs/application/?approved__exact=0",
+                         {'action': 'change_application_approved', 'post': 'yes',
+                          'status': 'True', '_selected_action': [application.id]})
+        self.assertEqual(list(OutgoingEmail.objects.values_list('to', flat=True)),
+                         [application.person.email])
+        self.assertNotEqual(get_user_version(application.person_id), version)
+        self.assertEqual(get_user_enrollments(application.person_id),
+                         {self.event.id: (self.course.id, True)})
+
+    def test_course_status_is_recorded(self):
+        self.client.post("/admin/kurs/course/", {'action': 'change_course_is_open', 'post': 'yes',
+                                                 'status': 'False',
+                                                 '_selected_action': [self.course.id]})
+        batch = AuditBatch.objects.get()
+        self.assertEqual((batch.action, batch.change_message), ('close', "is_open=False"))
+        self.assertEqual(list(batch.entries.values_list('object_id', flat=True)), [self.course.id])
+        self.assertContains(self.client.get("/admin/kurs/auditbatch/"), "<td>1</td>")
+
+class GenerateDatasetTest(PermitStorageTestCase):
+    def generate(self, prefix, seed):
+        output = StringIO()
+        call_command('generate_dataset', users=200, events=3, courses=5, prefix=prefix,
+                     seed=seed, stdout=output)
+        return output.getvalue().splitlines()[0]
+
+    # Checksum of the generated rows, without the prefix and the ids
+    def checksum(self, prefix):
+        rows = [list(User.objects.filter(username__startswith=prefix + "_").order_by('username')
+                     .values_list('username', 'first_name', 'last_name', 'my_profile__company',
+                                  'my_profile__mobile')),
+                [(person, course, approved, permit is not None) for person, course, approved, permit
+                 in Application.objects.filter(event__display_name__startswith=prefix)
+                 .order_by('person__username', 'event__display_name')
+                 .values_list('person__username', 'course__display_name', 'approved',
+                              'applicationpermit__id')],
+                list(ApplicationChoices.objects.filter(event__display_name__startswith=prefix)
+                     .order_by('person__username', 'event__display_name', 'choice_number')
+                     .values_list('person__username', 'choice_number', 'choice__display_name')),
+                list(Course.objects.filter(event__display_name__startswith=prefix)
+                     .order_by('display_name').values_list('display_name', 'capacity', 'seats_taken'))]
+        return hashlib.sha1(repr(rows).replace(prefix, "")).hexdigest()
+
+    def test_same_seed_generates_same_data(self):
+        counts = self.generate("first", seed=7)
+        self.assertEqual(self.generate("second", seed=7), counts)
+        self.assertEqual(self.checksum("second"), self.checksum("first"))
+        self.generate("third", seed=8)
+        self.assertNotEqual(self.checksum("third"), self.checksum("first"))
+
+# The client threads of loadtest open their own connections, the in-memory
+# test database is copied to a file they can reach
+class LoadTestCommandTest(TransactionTestCase):
+    def setUp(self):
+        waiting_room.reset()
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "loadtest.db")
+        connections['default'].cursor().execute("VACUUM INTO %s", [path])
+        self.memory_database = connections.databases['default']
+        self.memory_connection = connections['default']
+        connections.databases['default'] = dict(self.memory_database, NAME=path)
+        del connections._connections.default
+
+    def tearDown(self):
+        connections['default'].close()
+        connections.databases['default'] = self.memory_database
+        connections['default'] = self.memory_connection
+        shutil.rmtree(self.directory)
+        waiting_room.reset()
+
+    def test_invariants_hold_and_data_is_deleted(self):
+        output = os.path.join(self.directory, "results.json")
+        call_command('loadtest', users=2, workers=1, courses=2, output=output,
+                     stdout=StringIO(), stderr=StringIO())
+        with open(output) as results_file:
+            results = json.load(results_file)
+        self.assertEqual(results['invariants'], {'applicants': 2, 'overbooked_courses': 0,
+                                                 'duplicate_applications': 0,
+                                                 'duplicate_application_rate': 0.0,
+                                                 'duplicate_choices': 0})
+        self.assertEqual(sum(endpoint['errors'] for endpoint in results['endpoints'].values()), 0)
+        self.assertFalse(User.objects.filter(username__startswith="loadtest_").exists())
+        self.assertFalse(Event.objects.filter(display_name__startswith="loadtest_").exists())
+        self.assertFalse(Course.objects.exists())
+        self.assertFalse(Application.objects.exists())
+
+
+class SQLiteBackendTest(TestCase):
+    # A file database of its own, the test database is in memory and can
+    # not be opened by a second connection
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.db")
+        connections.databases['sqlite_test'] = dict(connections.databases['default'],
+                                                    NAME=self.path, OPTIONS={'timeout': 5})
+        self.connection = connections['sqlite_test']
+        self.connection.cursor().execute("CREATE TABLE t (x integer)")
+        # Statements are recorded to see how transactions begin
+        self.connection.use_debug_cursor = True
+
+    def tearDown(self):
+        self.connection.close()
+        del connections._connections.sqlite_test
+        del connections.databases['sqlite_test']
+        shutil.rmtree(self.directory)
+
+    def pragma(self, name):
+        return self.connection.cursor().execute("PRAGMA %s" % name).fetchone()[0]
+
+    # Second connection that gives up on a lock at once
+    def other_connection(self):
+        return sqlite3.connect(self.path, timeout=0, isolation_level=None)
+
+    def rows(self):
+        return [x for x, in self.other_connection().execute("SELECT x FROM t ORDER BY x")]
+
+    def test_pragmas(self):
+        self.assertEqual(self.pragma("journal_mode"), "wal")
+        self.assertEqual(self.pragma("synchronous"), 1)
+        self.assertEqual(self.pragma("busy_timeout"), 5000)
+
+    def test_pragmas_can_be_overridden(self):
+        self.connection.close()
+        self.connection.settings_dict['OPTIONS'] = {'pragmas': {'synchronous': 'FULL'}}
+        self.assertEqual(self.pragma("synchronous"), 2)
+        self.assertEqual(self.pragma("busy_timeout"), backend.DEFAULT_TIMEOUT * 1000)
+
+    def test_write_transaction_holds_the_write_lock(self):
+        other = self.other_connection()
+        with write_transaction(using='sqlite_test'):
+            self.assertEqual(fingerprint(self.connection.queries[-1]['sql']), "BEGIN IMMEDIATE")
+            # Before anything is written, readers go on
+            self.assertRaises(sqlite3.OperationalError, other.execute, "BEGIN IMMEDIATE")
+            self.assertEqual(self.rows(), [])
+            self.connection.cursor().execute("INSERT INTO t VALUES (1)")
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("ROLLBACK")
+        self.assertEqual(self.rows(), [1])
+
+    def test_atomic_takes_no_lock_up_front(self):
+        other = self.other_connection()
+        with transaction.atomic(using='sqlite_test'):
+            self.assertEqual(fingerprint(self.connection.queries[-1]['sql']), "BEGIN")
+            other.execute("BEGIN IMMEDIATE")
+            other.execute("ROLLBACK")
+
+    def test_rollback(self):
+        try:
+            with write_transaction(using='sqlite_test'):
+                self.connection.cursor().execute("INSERT INTO t VALUES (1)")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.rows(), [])
+        self.assertFalse(self.connection.begin_immediate)
+        # The lock is released
+        other = self.other_connection()
+        other.execute("BEGIN IMMEDIATE")
+        other.execute("ROLLBACK")
+
+    def test_nested_write_transaction_is_a_savepoint(self):
+        with write_transaction(using='sqlite_test'):
+            self.connection.cursor().execute("INSERT INTO t VALUES (1)")
+            try:
+                with write_transaction(using='sqlite_test'):
+                    self.assertFalse(self.connection.begin_immediate)
+                    self.connection.cursor().execute("INSERT INTO t VALUES (2)")
+                    raise ValueError
+            except ValueError:
+                pass
+            self.connection.cursor().execute("INSERT INTO t VALUES (3)")
+        self.assertEqual(self.rows(), [1, 3])
+
+
+class ReplicaRoutingTest(TestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.middleware = ReplicaRoutingMiddleware()
+        self.factory = RequestFactory()
+        self.databases = dict(settings.DATABASES, replica=dict(settings.DATABASES['default']))
+
+    def route(self, request, view=lambda request: None):
+        self.middleware.process_view(request, view, (), {})
+        # The test case runs in a transaction, which keeps reads on the
+        # primary, so the flag is checked instead of db_for_read
+        routed = getattr(routers._state, 'replica', False)
+        response = self.middleware.process_response(request, HttpResponse())
+        return routed, response
+
+    def test_no_replica(self):
+        routed, response = self.route(self.factory.get("/kurs/etkinlik/"))
+        self.assertFalse(routed)
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        with replica_reads():
+            self.assertEqual(self.router.db_for_read(Event), None)
+
+    def test_reads_go_to_replica(self):
+        with override_settings(DATABASES=self.databases):
+            self.assertEqual(self.route(self.factory.get("/kurs/etkinlik/"))[0], True)
+            self.assertEqual(self.router.db_for_write(Event), 'default')
+            self.assertFalse(self.router.allow_syncdb('replica', Event))
+            self.assertEqual(self.router.db_for_read(Event), None)
+
+    def test_writes_pin_client_to_primary(self):
+        with override_settings(DATABASES=self.databases, KURS_REPLICA_PIN_SECONDS=7):
+            routed, response = self.route(self.factory.post("/kurs/basvurular/"))
+            self.assertFalse(routed)
+            self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 7)
+            routed, response = self.route(self.factory.get("/kurs/etkinlik/"),
+                                          use_primary(lambda request: None))
+            self.assertFalse(routed)
+            self.assertIn(PIN_COOKIE, response.cookies)
+
+            request = self.factory.get("/kurs/etkinlik/")
+            request.COOKIES[PIN_COOKIE] = '1'
+            routed, response = self.route(request)
+            self.assertFalse(routed)
+            self.assertNotIn(PIN_COOKIE, response.cookies)
+
+# The catalog and the user tables are cached under versions changed on the
+# primary, a replica that lags behind must not fill them with old rows
+class StaleReplicaTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        waiting_room.reset()
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.course = create_course(self.event, display_name="first course", is_open=False)
+        self.user = User.objects.create_user("replica", "replica@example.com", "secret")
+        self.client.login(username="replica", password="secret")
+
+        # The replica is a copy taken now, changes after this are not on it
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "replica.db")
+        connections['default'].cursor().execute("VACUUM INTO %s", [path])
+        self.databases = dict(settings.DATABASES, replica=dict(settings.DATABASES['default'], NAME=path))
+        connections.databases['replica'] = self.databases['replica']
+
+    def tearDown(self):
+        connections['replica'].close()
+        del connections._connections.replica
+        del connections.databases['replica']
+        shutil.rmtree(self.directory)
+        cache.clear()
+
+    def test_catalog_is_read_from_primary(self):
+        path = "/kurs/kurs/%d/" % self.course.id
+        with override_settings(DATABASES=self.databases):
+            self.assertContains(self.client.get(path), "This course is not open for application.")
+            self.course.is_open = True
+            self.course.save()
+            self.assertNotContains(self.client.get(path), "This course is not open for application.")
+            Course.objects.create(event=self.event, display_name="second course", description="",
+                                  agreement="", is_open=True, change_allowed_date=tz_aware_now(),
+                                  start_date=tz_aware_now().date(), end_date=tz_aware_now().date())
+            self.assertContains(self.client.get("/kurs/etkinlik/%d/" % self.event.id), "second course")
+
+    def test_user_tables_are_read_from_primary(self):
+        with override_settings(DATABASES=self.databases):
+            self.assertNotContains(self.client.get("/kurs/basvurular/"), "first course")
+            Course.objects.filter(pk=self.course.pk).update(is_open=True)
+            Application.objects.apply(self.user, self.course)
+            self.assertContains(self.client.get("/kurs/basvurular/"), "first course")
+            with replica_reads():
+                self.assertEqual(get_user_enrollments(self.user.id),
+                                 {self.event.id: (self.course.id, False)})
+
+
+class CachedSessionTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("sessions", "sessions@example.com", "secret")
+
+    def stored(self, session):
+        return Session.objects.get(session_key=session.session_key).get_decoded()
+
+    def test_changes_are_written_behind(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        self.assertEqual(self.stored(session), {'step': 1})
+
+        session = SessionStore(session.session_key)
+        session['step'] = 2
+        with self.assertNumQueries(0):
+            session.save()
+        self.assertEqual(SessionStore(session.session_key)['step'], 2)
+        self.assertEqual(self.stored(session), {'step': 1})
+
+        # Without the cache the last written copy is read
+        cache.clear()
+        self.assertEqual(SessionStore(session.session_key)['step'], 1)
+
+    @override_settings(KURS_SESSION_WRITE_INTERVAL=0)
+    def test_interval(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        session['step'] = 2
+        session.save()
+        self.assertEqual(self.stored(session), {'step': 2})
+
+    @override_settings(SESSION_ENGINE='kurs.sessions')
+    def test_login_is_written_at_once(self):
+        self.assertTrue(self.client.login(username="sessions", password="secret"))
+        key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertEqual(Session.objects.get(session_key=key).get_decoded()['_auth_user_id'],
+                         self.user.id)
+        with self.assertNumQueries(2):
+            # The session comes from the cache, user and application list
+            # from the database
+            self.client.get("/kurs/basvurular/")
+
+        self.client.logout()
+        self.assertFalse(Session.objects.filter(session_key=key).exists())
+        self.assertEqual(self.client.get("/kurs/basvurular/").status_code, 302)
+
+    def test_empty_session_is_not_written(self):
+        session = SessionStore()
+        session.create()
+        session.save()
+        self.assertFalse(Session.objects.exists())
+
+    def test_concurrent_first_writes(self):
+        first = SessionStore()
+        first.create()
+        # A second request with the new session key before the first saved
+        second = SessionStore(first.session_key)
+        self.assertIsNone(second.get('step'))
+        first['step'] = 1
+        first.save()
+        second['step'] = 2
+        second.save()
+        self.assertEqual(self.stored(first), {'step': 2})
+
+    def test_cache_copy_does_not_outlive_the_row(self):
+        session = SessionStore()
+        session['step'] = 1
+        session.save()
+        # The row was written half a minute ago, the copy expires with it
+        session._stored = (session._stored[0] - 30, session._stored[1])
+        session['step'] = 2
+        cache_set = cache.set
+        timeouts = []
+        try:
+            cache.set = lambda key, value, timeout: timeouts.append(timeout)
+            session.save()
+        finally:
+            cache.set = cache_set
+        self.assertEqual(timeouts, [session.get_expiry_age() - 30])
+
+@override_settings(KURS_ADMISSION_RATE=1, KURS_ADMISSION_BURST=1, KURS_ADMISSION_USER_RATE=1,
+                   KURS_ADMISSION_USER_BURST=2)
+class AdmissionTest(TestCase):
+    def setUp(self):
+        waiting_room.reset()
+        self.room = WaitingRoom()
+
+    def test_waiting_room_is_fifo(self):
+        self.assertEqual(self.room.admit('a', False, 0), (ADMITTED, None, None))
+        self.assertEqual(self.room.admit('b', False, 0), (QUEUED, 1, 1))
+        self.assertEqual(self.room.admit('c', False, 0)[:2], (QUEUED, 2))
+        # The next token goes to b, even if c asks first
+        self.assertEqual(self.room.admit('c', False, 1)[:2], (QUEUED, 2))
+        self.assertEqual(self.room.admit('b', False, 1)[0], ADMITTED)
+        self.assertEqual(self.room.admit('c', False, 1.5)[:2], (QUEUED, 1))
+        self.assertEqual(self.room.admit('c', False, 2)[0], ADMITTED)
+        self.assertEqual(self.room.waiting(), 0)
+
+    def test_users_that_leave_lose_their_place(self):
+        self.room.admit('a', False, 0)
+        self.room.admit('b', False, 0)
+        self.room.admit('c', False, 0)
+        self.assertEqual(self.room.admit('c', False, 40), (ADMITTED, None, None))
+
+    def test_tickets_skip_the_queue_but_not_the_user_limit(self):
+        self.room.admit('a', False, 0)
+        self.room.admit('b', False, 0)
+        self.assertEqual(self.room.admit('a', True, 0)[0], ADMITTED)
+        self.assertEqual(self.room.admit('a', True, 0), (THROTTLED, None, 1))
+
+    def test_apply_view(self):
+        event = Event.objects.create(display_name="event", venue="venue")
+        course = create_course(event, capacity=10)
+        for username in ("first", "second"):
+            User.objects.create_user(username, username + "@example.com", "secret")
+
+        first = Client()
+        first.login(username="first", password="secret")
+        self.assertEqual(first.get("/kurs/kurs/%d/basvur/" % course.id).status_code, 302)
+        second = Client()
+        second.login(username="second", password="secret")
+        response = second.get("/kurs/kurs/%d/basvur/" % course.id)
+        self.assertContains(response, "number 1 in the queue", status_code=503)
+        self.assertEqual(response['Retry-After'], "1")
+        self.assertFalse(Application.objects.filter(person__username="second").exists())
+
+        # The first user holds a ticket now
+        self.assertEqual(first.get("/kurs/etkinlik/%d/tercihler/edit/" % event.id).status_code, 200)
+
+    def test_failed_requests_get_no_ticket(self):
+        request = RequestFactory().get("/")
+        request.user = AnonymousUser()
+        for status, ticket in ((500, False), (404, False), (200, True)):
+            waiting_room.reset()
+            response = admission_control(lambda request: HttpResponse(status=status))(request)
+            self.assertEqual(TICKET_COOKIE in response.cookies, ticket)
+
+class EnrollmentIndexTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        waiting_room.reset()
+        self.user = User.objects.create_user("user", "user@example.com", "secret")
+        self.event = Event.objects.create(display_name="event", venue="venue")
+        self.courses = [create_course(self.event, capacity=10, display_name="course %d" % i)
+                        for i in range(2)]
+        self.client.login(username="user", password="secret")
+
+    def test_index_follows_applications(self):
+        self.assertEqual(get_user_enrollments(self.user.id), {})
+        application = Application.objects.apply(self.user, self.courses[0])
+        self.assertEqual(get_user_enrollments(self.user.id), {self.event.id: (self.courses[0].id, False)})
+        with self.assertNumQueries(0):
+            get_user_enrollments(self.user.id)
+
+        Application.objects.filter(pk=application.pk).update(approved=True)
+        bump_user_versions([self.user.id])
+        self.assertEqual(get_user_enrollments(self.user.id), {self.event.id: (self.courses[0].id, True)})
+
+        other = Event.objects.create(display_name="other", venue="venue")
+        self.courses[0].event = other
+        self.courses[0].save()
+        self.assertEqual(get_user_enrollments(self.user.id), {other.id: (self.courses[0].id, True)})
+
+        application.delete()
+        self.assertEqual(get_user_enrollments(self.user.id), {})
+
+    def test_course_detail_does_not_query_applications(self):
+        Application.objects.apply(self.user, self.courses[0])
+        path = "/kurs/kurs/%d/" % self.courses[1].id
+        self.client.get(path)
+        # session, user and the seats of the course
+        with self.assertNumQueries(3):
+            response = self.client.get(path)
+        self.assertContains(response, "You have already applied to another course in this event.")
+        self.assertContains(self.client.get("/kurs/kurs/%d/" % self.courses[0].id),
+                            "You have applied to this course.")
+
+    def test_repeated_apply_is_rejected_early(self):
+        self.client.get("/kurs/kurs/%d/basvur/" % self.courses[0].id)
+        # session, user, course and the enrollment index, no transaction
+        with self.assertNumQueries(4):
+            response = self.client.get("/kurs/kurs/%d/basvur/" % self.courses[1].id)
+        self.assertTemplateUsed(response, 'kurs/hata.html')
+        self.assertEqual(Course.objects.get(pk=self.courses[1].pk).seats_taken, 0)
+
+class FragmentCacheTest(TestCase):
+    def render(self, source, **context):
+        return Template("{% load kurs_cache %}" + source).render(Context(context))
+
+    def test_event_fragment_follows_event_version(self):
+        source = "{% eventcache test event_id course %}{{ value }}{% endeventcache %}"
+        self.assertEqual(self.render(source, event_id=1, course=1, value="a"), "a")
+        self.assertEqual(self.render(source, event_id=1, course=1, value="b"), "a")
+        self.assertEqual(self.render(source, event_id=1, course=2, value="b"), "b")
+        bump_event_versions([1])
+        self.assertEqual(self.render(source, event_id=1, course=1, value="c"), "c")
+
+    def test_catalog_fragment_follows_catalog_version(self):
+        source = "{% catalogcache test %}{{ value }}{% endcatalogcache %}"
+        self.assertEqual(self.render(source, value="a"), "a")
+        self.assertEqual(self.render(source, value="b"), "a")
+        bump_event_versions([])
+        self.assertEqual(self.render(source, value="c"), "c")
+
+
+class StartupTest(TestCase):
+    def test_import_profiler_times_new_modules(self):
+        module = sys.modules.pop('colorsys', None)
+        profiler = ImportProfiler()
+        profiler.install()
+        try:
+            import colorsys
+            import os
+        finally:
+            profiler.uninstall()
+            if module is not None:
+                sys.modules['colorsys'] = module
+        modules = [name for name, cumulative, own in profiler.report()]
+        self.assertIn('colorsys', modules)
+        self.assertNotIn('os', modules)
+
+    def test_warm_up_loads_middleware(self):
+        application = WSGIHandler()
+        with self.assertNumQueries(0):
+            warm_up(application)
+        self.assertIsNotNone(application._request_middleware)
@@ -0,0 +1,97 @@
+# coding=utf-8
+
+# Upload handler for permit files.
+#
+# ValidatedFileField can only check a file after Django has received all of
+# it. PermitUploadHandler checks the upload while it is streamed: the type is
+# sniffed from the first chunk and the size is counted on every chunk, and the
+# upload is stopped at the first violation without reading the rest of the
+# request body. The content is hashed on the way.
+#
+# The handler must be installed before the request body is read, see
+# kurs.views.upload_permit.
+
+import hashlib
+import threading
+
+from django import forms
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
+
+# libmagic is expensive to load and its handles are not thread safe, a single
+# instance is shared behind a lock. It is loaded with the first upload, not
+# when the worker starts.
+_magic = None
+_magic_lock = threading.Lock()
+
+# Room for the other form fields and the multipart boundaries when comparing
+# the request size to the file size limit
+MULTIPART_OVERHEAD = 64 * 1024
+
+# MIME type of the buffer according to its content
+def sniff_content_type(buffer):
+    global _magic
+    with _magic_lock:
+        if _magic is None:
+            import magic
+            _magic = magic.Magic(mime=True)
+        return _magic.from_buffer(buffer)
+
+class PermitUploadHandler(FileUploadHandler):
+    # field is the ValidatedFileField of the uploaded file
+    def __init__(self, request, field):
+        super(PermitUploadHandler, self).__init__(request)
+        self.field = field
+        self.active = False
+        # Validation message if the upload was stopped
+        self.error = None
+        self.content_type_magic = None
+        self.sha256 = None
+
+    def reject(self, error):
+        self.error = error.messages[0]
+        raise StopUpload(connection_reset=True)
+
+    # Requests too large to hold an acceptable file are not parsed at all
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if self.field.max_upload_size and \
+                content_length > self.field.max_upload_size + MULTIPART_OVERHEAD:
+            try:
+                self.field.validate_size(content_length)
+            except forms.ValidationError as e:
+                self.error = e.messages[0]
+            return QueryDict('', encoding=encoding), MultiValueDict()
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None):
+        self.active = field_name == self.field.name
+        if not self.active:
+            return
+        self.content_type_header = content_type
+        self.hash = hashlib.sha256()
+        if content_length:
+            try:
+                self.field.validate_size(content_length)
+            except forms.ValidationError as e:
+                self.reject(e)
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        try:
+            if start == 0:
+                self.content_type_magic = sniff_content_type(raw_data)
+                self.field.validate_content_type(self.content_type_header,
+                                                 self.content_type_magic)
+            self.field.validate_size(start + len(raw_data))
+        except forms.ValidationError as e:
+            self.reject(e)
+        self.hash.update(raw_data)
+        # The file is stored by the next handler
+        return raw_data
+
+    def file_complete(self, file_size):
+        if self.active:
+            self.sha256 = self.hash.hexdigest()
+            self.active = False
+        return None
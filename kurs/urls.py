@@ -1,18 +1,30 @@
 from django.conf.urls import patterns, url
-from django.views.generic import ListView
-from kurs.models import Event
-from kurs.views import CourseDetailView, ApplicationDeleteView, ApplicationChoicesList, ApplicationList
+from kurs.views import CourseDetailView, ApplicationDeleteView, ApplicationChoicesList, ApplicationList, EventList
+from kurs.views import index, list_courses, edit_choices, apply_for_course, upload_permit
+from kurs.views import event_list_etag, event_list_last_modified, list_courses_etag, \
+    list_courses_last_modified, course_detail_etag, course_detail_last_modified, \
+    application_list_etag, choices_list_etag
+from kurs.querystats import query_budget
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition
 
-urlpatterns = patterns('kurs.views',
-    url(r'^$', 'index'),
-    url(r'^etkinlik/$', ListView.as_view(queryset=Event.objects.order_by('-id'))),
-    url(r'^etkinlik/(?P<event_id>\d+)/$', 'list_courses'),
-    url(r'^etkinlik/(?P<event_id>\d+)/tercihler/$', login_required(ApplicationChoicesList.as_view())),
-    url(r'^etkinlik/(?P<event_id>\d+)/tercihler/edit/$', 'edit_choices'),
-    url(r'^kurs/(?P<pk>\d+)/$', CourseDetailView.as_view()),
-    url(r'^kurs/(?P<course_id>\d+)/basvur/$', 'apply_for_course'),
-    url(r'^basvurular/(?P<pk>\d+)/iptal/$', login_required(ApplicationDeleteView.as_view())),
-    url(r'^basvurular/(?P<application_id>\d+)/izin/$', 'upload_permit'),
-    url(r'^basvurular/$', login_required(ApplicationList.as_view())),
+# Every view declares the maximum number of SQL queries it may issue,
+# including the session and user lookups of an authenticated request.
+# The budgets must not depend on the amount of data, they are checked by
+# the test suite with a user having many applications. Views saving a form
+# on POST declare a separate budget for it.
+#
+# Catalog and list pages answer conditional GETs, their validators are
+# computed from the cache (see kurs/conditional.py).
+urlpatterns = patterns('',
+    url(r'^$', query_budget(2)(index)),
+    url(r'^etkinlik/$', query_budget(3)(condition(event_list_etag, event_list_last_modified)(EventList.as_view()))),
+    url(r'^etkinlik/(?P<event_id>\d+)/$', query_budget(4)(condition(list_courses_etag, list_courses_last_modified)(list_courses))),
+    url(r'^etkinlik/(?P<event_id>\d+)/tercihler/$', query_budget(3)(login_required(condition(choices_list_etag)(ApplicationChoicesList.as_view())))),
+    url(r'^etkinlik/(?P<event_id>\d+)/tercihler/edit/$', query_budget(9, post=11)(edit_choices)),
+    url(r'^kurs/(?P<pk>\d+)/$', query_budget(6)(condition(course_detail_etag, course_detail_last_modified)(CourseDetailView.as_view()))),
+    url(r'^kurs/(?P<course_id>\d+)/basvur/$', query_budget(9)(apply_for_course)),
+    url(r'^basvurular/(?P<pk>\d+)/iptal/$', query_budget(6)(login_required(ApplicationDeleteView.as_view()))),
+    url(r'^basvurular/(?P<application_id>\d+)/izin/$', query_budget(2, post=8)(upload_permit)),
+    url(r'^basvurular/$', query_budget(3)(login_required(condition(application_list_etag)(ApplicationList.as_view())))),
 )
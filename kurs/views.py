@@ -1,18 +1,30 @@
 # coding=utf-8
 
 from django.shortcuts import render_to_response
-from django.http import HttpResponseRedirect
+from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.timezone import now as tz_aware_now
+from django.http import HttpResponseRedirect, Http404
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.template import RequestContext
 from kurs.models import Event, Course, Application, ApplicationChoices
-from kurs.models import ApplicationPermit
-from kurs.forms import ApplicationChoiceForm, ApplicationPermitForm
-from django.utils import timezone
+from kurs.models import ApplicationPermit, CourseFull, AlreadyApplied
+from kurs.forms import ApplicationPermitForm, get_choice_formset
+from kurs.cache import user_cache_key, USER_CACHE_TIMEOUT, get_catalog_version, get_event_version, \
+    get_user_version
+from kurs.conditional import page_etag, page_last_modified
+from kurs.catalog import get_event_list, get_event, get_courses, get_course
+from kurs.enrollment import applied_course
+from kurs.uploadhandlers import PermitUploadHandler
+from kurs.log import log_event
+from kurs.db import write_transaction
+from kurs.routers import use_primary
+from kurs.admission import admission_control
 from django.views.generic import DetailView
 from django.views.generic.list import ListView
 from django.views.generic.edit import DeleteView
-from django.forms.formsets import formset_factory
-from django.utils.functional import curry
 from django.contrib import messages
 from django.utils.translation import ugettext as _
 import logging
@@ -24,28 +36,50 @@ def index(request):
                               {},
                               context_instance=RequestContext(request))
 
+# List all events, served from the catalog cache
+class EventList(ListView):
+    context_object_name = "event_list"
+    template_name = "kurs/event_list.html"
+
+    def get_queryset(self):
+        return get_event_list()
+
+def event_list_etag(request):
+    return page_etag(request, get_catalog_version())
+
+def event_list_last_modified(request):
+    return page_last_modified(request, *[event.last_modified for event in get_event_list()])
+
+# Saving a course marks its event as modified too
+def list_courses_etag(request, event_id):
+    return page_etag(request, event_id, get_event_version(event_id))
+
+def list_courses_last_modified(request, event_id):
+    try:
+        event = get_event(event_id)
+    except Event.DoesNotExist:
+        return None
+    return page_last_modified(request, event.last_modified)
+
 # List all courses of an event
 def list_courses(request, event_id):
     try:
-        event = Event.objects.get(pk=event_id)
+        event = get_event(event_id)
     except Event.DoesNotExist:
         messages.error(request, _('No such event!'))
         return render_to_response('kurs/hata.html',
             context_instance=RequestContext(request))
-    try:
-        course_list = Course.objects.filter(event=event_id)
-    except Course.DoesNotExist:
-        messages.error(request, _('Error occured while fetching course objects!'))
-        return render_to_response('kurs/hata.html',
-            context_instance=RequestContext(request))
-    
+
     return render_to_response('kurs/list_courses.html',
                               {'event': event.display_name,
-                               'course_list': course_list,},
+                               'event_id': event.id,
+                               'course_list': get_courses(event.id),},
                               context_instance=RequestContext(request))
 
 # User applied for a course
 @login_required
+@use_primary
+@admission_control
 def apply_for_course(request, course_id):
     try:
         course = Course.objects.get(pk=course_id)
@@ -57,48 +91,164 @@ def apply_for_course(request, course_id):
     # FIXME: Check course start and end dates in order to allow
     # applying to more than one course in the same event
 
-    # Check if user has previously applied to another course
-    # in the same event
-    previous_applications = Application.objects.filter(person = request.user).filter(course__event=course.event).count()
-    if previous_applications == 0:
-        # FIXME: use tz-aware now
-        application = Application(person = request.user, course = course,
-                                  application_date = timezone.now())
-        application.save()
-
-        if logger.isEnabledFor(logging.DEBUG):
-            logger.debug("Başvuru yapıldı: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                     (application, request.user, request.META["REMOTE_ADDR"]))
-
-        messages.info(request, _('Your application is saved'))
-        # Redirect after successful application
-        return HttpResponseRedirect('/kurs/etkinlik/' + str(course.event.id) + '/tercihler/')
-    else:
+    if not course.can_be_applied:
+        messages.error(request, _('This course is not open for application.'))
+        return render_to_response('kurs/hata.html',
+                              context_instance=RequestContext(request))
+
+    # Repeated clicks are rejected without a write transaction
+    if applied_course(request, course.event_id) is not None:
         messages.error(request, _('You can only apply to one course in this event!'))
         return render_to_response('kurs/hata.html',
                               context_instance=RequestContext(request))
 
+    # Reserve a seat and save the application atomically, rejects the
+    # application if the course is full or if user has previously applied
+    # to another course in the same event
+    try:
+        application = Application.objects.apply(request.user, course)
+    except CourseFull:
+        messages.error(request, _('This course is full!'))
+        return render_to_response('kurs/hata.html',
+                              context_instance=RequestContext(request))
+    except AlreadyApplied:
+        messages.error(request, _('You can only apply to one course in this event!'))
+        return render_to_response('kurs/hata.html',
+                              context_instance=RequestContext(request))
+
+    log_event(logger, 'apply', u"Başvuru yapıldı", request,
+              application=application, course=course)
+
+    messages.info(request, _('Your application is saved'))
+    # Redirect after successful application
+    return HttpResponseRedirect('/kurs/etkinlik/' + str(course.event_id) + '/tercihler/')
+
+# The page changes without the course being modified when the application
+# deadline passes or the course fills up
+def course_detail_etag(request, pk):
+    try:
+        course = get_course(pk)
+    except Course.DoesNotExist:
+        return None
+    parts = [pk, get_event_version(course.event_id), course.can_be_applied,
+             course_is_full(request, pk)]
+    if request.user.is_authenticated():
+        parts.append(get_user_version(request.user.id))
+    return page_etag(request, *parts)
+
+def course_detail_last_modified(request, pk):
+    try:
+        course = get_course(pk)
+    except Course.DoesNotExist:
+        return None
+    deadline = course.change_allowed_date
+    return page_last_modified(request, course.last_modified,
+                              deadline if deadline < tz_aware_now() else None)
+
+# Whether the course is full. seats_taken of the cached course changes with
+# every application, it is read from the database. Kept on the request, the
+# ETag function and the view both need it.
+def course_is_full(request, pk):
+    if not hasattr(request, '_course_full'):
+        seats = Course.objects.filter(pk=pk).values_list('seats_taken', 'capacity').first()
+        request._course_full = seats is not None and seats[1] > 0 and seats[0] >= seats[1]
+    return request._course_full
+
 class CourseDetailView(DetailView):
     context_object_name = "course"
     model = Course
 
+    # Courses are read from the catalog cache
+    def get_object(self, queryset=None):
+        try:
+            return get_course(self.kwargs['pk'])
+        except Course.DoesNotExist:
+            raise Http404(_('No such course!'))
+
     # We need extra context data in template in order to show informational
     # messages to user about why he can not apply for a selected course
     def get_context_data(self, **kwargs):
         context = super(CourseDetailView, self).get_context_data(**kwargs)
+        context['is_full'] = course_is_full(self.request, self.object.id)
         if self.request.user.is_authenticated():
-            # Check if user has applied to another course in the same event
-            context['previous_applications'] = Application.objects.filter(person = self.request.user).filter(course__event = self.object.event).count()
+            applied_course_id = applied_course(self.request, self.object.event_id)
+            # Check if user has applied to a course in the same event
+            context['previous_applications'] = 0 if applied_course_id is None else 1
             # Check if user has applied to this course already
-            context['has_applied'] = Application.objects.filter(course = self.object, person = self.request.user).count()
+            context['has_applied'] = 1 if applied_course_id == self.object.id else 0
         return context
 
+# Rendered application table of the user. It is read from the cache as
+# long as the user's data does not change, applications are only queried on
+# a cache miss, on the primary database where the version was changed. The
+# table is kept on the request, it is needed by both the ETag function and
+# the view.
+def get_application_table(request):
+    if not hasattr(request, '_application_table'):
+        key = user_cache_key(request.user.id, "applications")
+        table = cache.get(key)
+        if table is None:
+            applications = list(Application.objects.using(DEFAULT_DB_ALIAS).filter(person = request.user) \
+                .select_related('course__event', 'applicationpermit') \
+                .order_by('-application_date', 'event'))
+            now = tz_aware_now()
+            for application in applications:
+                # Whether the application can still be cancelled and its
+                # choices changed, checked once for all rows
+                application.can_change = not application.approved and \
+                    application.course.can_be_applied_at(now)
+            table = render_to_string("kurs/application_table.html",
+                                     {'application_list': applications})
+            cache.set(key, table, _application_table_timeout(applications, now))
+        request._application_table = table
+    return request._application_table
+
+# Cancel/Choices links disappear when the application deadline of the
+# course passes, the cached table must not outlive the first deadline
+def _application_table_timeout(applications, now):
+    timeout = USER_CACHE_TIMEOUT
+    for application in applications:
+        if application.course.can_be_applied_at(now):
+            remaining = application.course.change_allowed_date - now
+            timeout = min(timeout, int(remaining.total_seconds()) + 1)
+    return timeout
+
+def application_list_etag(request):
+    return page_etag(request, get_application_table(request))
+
 # List all previous applications of a user
 class ApplicationList(ListView):
     template_name = "kurs/application_list.html"
 
     def get_queryset(self):
-        return Application.objects.filter(person = self.request.user).order_by('-application_date', 'course__event')
+        return Application.objects.filter(person = self.request.user) \
+            .select_related('course__event', 'applicationpermit') \
+            .order_by('-application_date', 'event')
+
+    # The table is rendered by get_application_table, the queryset is not
+    # evaluated here
+    def get_context_data(self, **kwargs):
+        context = super(ApplicationList, self).get_context_data(**kwargs)
+        context['application_table'] = get_application_table(self.request)
+        return context
+
+# Rendered table of the user's choices for the event, see get_application_table
+def get_choices_table(request, event_id):
+    if not hasattr(request, '_choices_table'):
+        key = user_cache_key(request.user.id, "choices:%s" % event_id)
+        table = cache.get(key)
+        if table is None:
+            choices = list(ApplicationChoices.objects.using(DEFAULT_DB_ALIAS).filter(person = request.user) \
+                .filter(event = event_id) \
+                .select_related('choice__event').order_by("choice_number"))
+            table = render_to_string("kurs/applicationchoices_table.html",
+                                     {'object_list': choices})
+            cache.set(key, table, USER_CACHE_TIMEOUT)
+        request._choices_table = table
+    return request._choices_table
+
+def choices_list_etag(request, event_id):
+    return page_etag(request, event_id, get_choices_table(request, event_id))
 
 # List all ApplicationChoice objects of user for this event
 class ApplicationChoicesList(ListView):
@@ -109,88 +259,71 @@ class ApplicationChoicesList(ListView):
     def get_context_data(self, **kwargs):
         context = super(ApplicationChoicesList, self).get_context_data(**kwargs)
         context["event_id"] = self.kwargs['event_id']
+        context["choices_table"] = get_choices_table(self.request, self.kwargs['event_id'])
         return context
 
     # Limit application choices to be displayed to only the current event
     def get_queryset(self):
-        return ApplicationChoices.objects.filter(person = self.request.user).filter(event = self.kwargs['event_id']).order_by("choice_number")
+        return ApplicationChoices.objects.filter(person = self.request.user) \
+            .filter(event = self.kwargs['event_id']) \
+            .select_related('choice__event').order_by("choice_number")
 
 # Edit ApplicationChoice objects of user for this event
 @login_required
+@admission_control
 def edit_choices(request, event_id):
-
-    event = Event.objects.get(id = event_id)
-    # Get all previously made choices for this event
-    previous_choices = ApplicationChoices.objects.filter(person = request.user, event = event_id).order_by("choice_number")
-
-    max_num = event.allowed_choice_num
-    extra = event.allowed_choice_num - previous_choices.count()
-
-    # example: initial = [{"choice": "1"}, {"choice": "2"}]
-    initial = []
-    # Previous choices of the user must come pre-selected in edit form
-    for choice in previous_choices:
-        initial.append({"choice": str(choice.choice.id)})
-
-    # example: choices = [("1","1"), ("2","2")]
-    choices = []
+    try:
+        event = get_event(event_id)
+    except Event.DoesNotExist:
+        messages.error(request, _('No such event!'))
+        return render_to_response('kurs/hata.html',
+            context_instance=RequestContext(request))
 
     # Remove applied course from possible choices for this event
-    try:
-        applied_course = Application.objects.get(person = request.user, course__event = event_id)
-    except Application.DoesNotExist:
+    applied_course_id = applied_course(request, event_id)
+    if applied_course_id is None:
         messages.error(request, _('You did not apply to any course in this event!'))
         return render_to_response('kurs/hata.html',
                     context_instance=RequestContext(request))
 
+    # example: choices = [(1, u"course 1"), (2, u"course 2")]
     # FIXME: use only courses that are open for application
-    courses = Course.objects.filter(event = event_id).exclude(id = applied_course.course.id)
-    for course in courses:
-        choices.append((course.id, course.display_name))
+    choices = [(course.id, course.display_name) for course in get_courses(event.id)
+               if course.id != applied_course_id]
 
-    # initialize form according to allowed_choice_num for the event
     # the reason we use formset here instead of a regular form is
     # we do now know in advance how many allowed_choice_num there will be
     # for a given event. Since the number is dynamic (coming from model/DB)
     # we have to use formset and generate necessary number of choice drop-down
-    formset = formset_factory(ApplicationChoiceForm, max_num = max_num, extra = extra)
-    formset.form = staticmethod(curry(ApplicationChoiceForm, choices=choices))
+    formset = get_choice_formset(event.allowed_choice_num, choices)
 
     if request.method == 'POST':
         EditChoicesFormSet = formset(request.POST, request.FILES)
         if EditChoicesFormSet.is_valid():
-            # Delete all choices made previously in order to overwrite
-            if not previous_choices.count() == 0:
-                for prev_choices in previous_choices:
-
-                    if logger.isEnabledFor(logging.DEBUG):
-                        logger.debug("Tercih silindi: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                     (prev_choices, request.user, request.META["REMOTE_ADDR"]))
+            course_ids = [int(form["choice"]) for form in EditChoicesFormSet.cleaned_data if form]
+            # Only the changed choices are written
+            deleted, created = ApplicationChoices.objects.replace(request.user, event.id, course_ids)
 
-                previous_choices.delete()
-
-            # save all applicationchoices of user to the DB
-            choice_number = 1
-            for choices in EditChoicesFormSet.cleaned_data:
-                record = ApplicationChoices(person = request.user,
-                                            event = Event.objects.get(id = event_id),
-                                            choice_number = choice_number,
-                                            choice = Course.objects.get(id = choices["choice"]))
-                record.save()
-
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("Tercih yapıldı: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                 (record, request.user, request.META["REMOTE_ADDR"]))
-
-                choice_number += 1
+            for choice in deleted:
+                log_event(logger, 'choice_delete', u"Tercih silindi", request,
+                          event=event, choice_number=choice.choice_number, course=choice.choice_id)
+            for choice in created:
+                log_event(logger, 'choice_create', u"Tercih yapıldı", request,
+                          event=event, choice_number=choice.choice_number, course=choice.choice_id)
 
             messages.info(request, _('Your choices are saved'))
             # redirect to his applicationchoice list for this event
             return HttpResponseRedirect("/kurs/etkinlik/" + event_id + "/tercihler/")
-
     else:
-        return render_to_response('kurs/applicationchoices_edit.html',
-                              {'formset': formset(initial=initial)},
+        # Previous choices of the user must come pre-selected in edit form
+        # example: initial = [{"choice": "1"}, {"choice": "2"}]
+        initial = [{"choice": str(choice_id)} for choice_id in ApplicationChoices.objects \
+            .filter(person = request.user, event = event_id) \
+            .order_by("choice_number").values_list('choice_id', flat=True)]
+        EditChoicesFormSet = formset(initial=initial)
+
+    return render_to_response('kurs/applicationchoices_edit.html',
+                              {'formset': EditChoicesFormSet},
                               context_instance=RequestContext(request))
 
 # Delete a selected previous application
@@ -207,6 +340,10 @@ class ApplicationDeleteView(DeleteView):
         return Application.objects.filter(person = self.request.user).filter(id = self.kwargs['pk'])
 
     def delete(self, request, *args, **kwargs):
+        with write_transaction():
+            return self._delete(request, *args, **kwargs)
+
+    def _delete(self, request, *args, **kwargs):
         application = Application.objects.get(person = self.request.user, id = self.kwargs['pk'])
 
         # We do not want the user to delete an application already approved
@@ -216,9 +353,9 @@ class ApplicationDeleteView(DeleteView):
             try:
                 applicationpermit = ApplicationPermit.objects.get(application = application)
 
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("İzin yazısı silindi: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                 (applicationpermit, request.user, request.META["REMOTE_ADDR"]))
+                log_event(logger, 'permit_delete', u"İzin yazısı silindi", request,
+                          permit=applicationpermit, application=application,
+                          file=applicationpermit.file.name)
 
                 applicationpermit.delete()
                 messages.info(request, _('Your previously uploaded permit is deleted'))
@@ -228,9 +365,8 @@ class ApplicationDeleteView(DeleteView):
             messages.info(request, _('Your application is deleted'))
             messages.info(request, _('Your previous choices for this event are deleted'))
 
-            if logger.isEnabledFor(logging.DEBUG):
-                logger.debug("Başvuru silindi: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                             (application, request.user, request.META["REMOTE_ADDR"]))
+            log_event(logger, 'application_delete', u"Başvuru silindi", request,
+                      application=application, course=application.course_id)
 
             return DeleteView.delete(self, request, *args, **kwargs)
 
@@ -241,30 +377,59 @@ class ApplicationDeleteView(DeleteView):
 
 # Allow user to upload a permit file for an application
 # application_id is coming from url
+#
+# The file is checked by PermitUploadHandler while it is being uploaded.
+# Upload handlers can not be changed once the request body is read, and
+# CsrfViewMiddleware reads it before calling the view, so the CSRF check is
+# done by _upload_permit instead.
+@admission_control
+@csrf_exempt
 def upload_permit(request, application_id):
+    if request.method == 'POST':
+        handler = PermitUploadHandler(request, ApplicationPermit._meta.get_field('file'))
+        request.upload_handlers.insert(0, handler)
+        # Parse the request body
+        request.POST
+
+        if handler.error is not None:
+            # Nothing is saved, there is no need for a CSRF check to show
+            # the form again
+            log_event(logger, 'permit_reject', u"İzin yazısı reddedildi", request,
+                      logging.WARNING, application=application_id, error=handler.error)
+            return render_to_response('kurs/applicationpermit_form.html',
+                                      {'form': ApplicationPermitForm(),
+                                       'upload_error': handler.error},
+                                      context_instance=RequestContext(request))
+
+        if 'file' in request.FILES:
+            request.FILES['file'].content_type_magic = handler.content_type_magic
+            request.FILES['file'].sha256 = handler.sha256
+
+    return _upload_permit(request, application_id)
+
+@csrf_protect
+def _upload_permit(request, application_id):
 
     if request.method == 'POST':
         form = ApplicationPermitForm(request.POST, request.FILES)
         if form.is_valid():
             # FIXME: Check if this user is the owner of the application
             application = Application.objects.get(id = application_id)
-            try:
-                applicationpermit = ApplicationPermit.objects.get(application__id = application_id)
-                applicationpermit.file = request.FILES["file"]
-                applicationpermit.save()
-
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("İzin yazısı yüklendi: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                 (applicationpermit, request.user, request.META["REMOTE_ADDR"]))
-
-            except ApplicationPermit.DoesNotExist:
-                applicationpermit = ApplicationPermit(application = application,
-                                                      file = request.FILES['file'])
+            # The file is stored before the transaction, the database is
+            # locked for the row only
+            uploaded = ApplicationPermit(application = application)
+            uploaded.file.save(request.FILES['file'].name, request.FILES['file'], save=False)
+            with write_transaction():
+                try:
+                    applicationpermit = ApplicationPermit.objects.get(application__id = application_id)
+                except ApplicationPermit.DoesNotExist:
+                    applicationpermit = uploaded
+                applicationpermit.file = uploaded.file.name
                 applicationpermit.save()
 
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug("İzin yazısı yüklendi: %s , request.user='%s' , request.META['REMOTE_ADDR']='%s'" %
-                                 (applicationpermit, request.user, request.META["REMOTE_ADDR"]))
+            log_event(logger, 'permit_upload', u"İzin yazısı yüklendi", request,
+                      permit=applicationpermit, application=application,
+                      file=applicationpermit.file.name)
 
             messages.info(request, _('Permit file is saved'))
             return HttpResponseRedirect('/kurs/basvurular/')
@@ -0,0 +1,129 @@
+# coding=utf-8
+
+# ZIP archives written as a stream of byte strings.
+#
+# zipfile needs a seekable file to go back and fill in the sizes and CRC of
+# every member. Here the sizes are written after the data in a data
+# descriptor (general purpose flag bit 3) instead, so an archive can be sent
+# to the client while it is being generated, one chunk at a time, without a
+# temporary file. Archives larger than 4 GB get ZIP64 records in the central
+# directory. Single members must stay below 4 GB.
+#
+#     response = StreamingHttpResponse(stream_zip(entries),
+#                                      content_type='application/zip')
+
+import struct
+import time
+import zlib
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_COUNT_LIMIT = 0xFFFF
+
+# Bit 3: sizes and CRC follow the data, bit 11: names are UTF-8
+FLAGS = 0x08 | 0x800
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_OFFSET_EXTRA = struct.Struct("<HHQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+def dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return (((year - 1980) << 9) | (month << 5) | day,
+            (hour << 11) | (minute << 5) | (second // 2))
+
+class ZipStream(object):
+    def __init__(self, compression=ZIP_DEFLATED):
+        self.compression = compression
+        self.offset = 0
+        self.members = []
+
+    def _write(self, data):
+        self.offset += len(data)
+        return data
+
+    # Yields the member named arcname with the content from the chunks
+    # iterable. date_time is a time tuple, the current time by default.
+    def add(self, arcname, chunks, date_time=None):
+        if isinstance(arcname, unicode):
+            arcname = arcname.encode('utf-8')
+        dos_date, dos_time = dos_date_time(date_time or time.localtime())
+        header_offset = self.offset
+
+        yield self._write(LOCAL_HEADER.pack(0x04034b50, 20, FLAGS, self.compression,
+                                            dos_time, dos_date, 0, 0, 0,
+                                            len(arcname), 0) + arcname)
+
+        crc = size = compressed_size = 0
+        if self.compression == ZIP_DEFLATED:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if self.compression == ZIP_DEFLATED:
+                chunk = compressor.compress(chunk)
+                if not chunk:
+                    continue
+            compressed_size += len(chunk)
+            yield self._write(chunk)
+        if self.compression == ZIP_DEFLATED:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield self._write(chunk)
+
+        if size > ZIP32_LIMIT or compressed_size > ZIP32_LIMIT:
+            raise ValueError("%s is too large for a ZIP member" % arcname)
+        crc &= 0xFFFFFFFF
+        yield self._write(DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, size))
+        self.members.append((arcname, dos_date, dos_time, crc, compressed_size, size,
+                             header_offset))
+
+    # Yields the central directory, the archive is complete afterwards
+    def close(self):
+        directory_offset = self.offset
+        for arcname, dos_date, dos_time, crc, compressed_size, size, header_offset in self.members:
+            extra = ""
+            version = 20
+            if header_offset > ZIP32_LIMIT:
+                extra = ZIP64_OFFSET_EXTRA.pack(0x0001, 8, header_offset)
+                header_offset = ZIP32_LIMIT
+                version = 45
+            yield self._write(CENTRAL_HEADER.pack(0x02014b50, (3 << 8) | version, version,
+                                                  FLAGS, self.compression, dos_time, dos_date,
+                                                  crc, compressed_size, size, len(arcname),
+                                                  len(extra), 0, 0, 0, 0644 << 16,
+                                                  header_offset) + arcname + extra)
+        directory_size = self.offset - directory_offset
+        count = len(self.members)
+
+        if count > ZIP32_COUNT_LIMIT or directory_offset > ZIP32_LIMIT or \
+                directory_size > ZIP32_LIMIT:
+            zip64_end_offset = self.offset
+            yield self._write(ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, 45, 45, 0, 0,
+                                             count, count, directory_size, directory_offset))
+            yield self._write(ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+            count = min(count, ZIP32_COUNT_LIMIT)
+            directory_size = min(directory_size, ZIP32_LIMIT)
+            directory_offset = min(directory_offset, ZIP32_LIMIT)
+        yield self._write(END.pack(0x06054b50, 0, 0, count, count, directory_size,
+                                   directory_offset, 0))
+
+# Yields a complete archive of the (arcname, chunks, date_time) entries.
+# chunks of every entry are only iterated when the entry is written.
+def stream_zip(entries, compression=ZIP_DEFLATED):
+    archive = ZipStream(compression)
+    for arcname, chunks, date_time in entries:
+        for data in archive.add(arcname, chunks, date_time):
+            yield data
+    for data in archive.close():
+        yield data
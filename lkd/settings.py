@@ -12,15 +12,32 @@ MANAGERS = ADMINS
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
+        'ENGINE': 'kurs.backends.sqlite3', # Add 'postgresql_psycopg2', 'mysql', 'sqlite3' or 'oracle'.
         'NAME': '/root/lkd-kurs/sqlite.db', # Or path to database file if using sqlite3.
         'USER': '',                      # Not used with sqlite3.
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
-    }
+        # kurs.backends.sqlite3 uses WAL journaling and waits for locks up to
+        # 'timeout' seconds, see kurs/backends/sqlite3/base.py
+        'OPTIONS': {'timeout': 20},
+    },
+    # Read-only requests and exports can be served from a replica, see
+    # kurs/routers.py. Locally a copy kept up to date by the sync_replica
+    # command stands in for it:
+    # 'replica': {
+    #     'ENGINE': 'kurs.backends.sqlite3',
+    #     'NAME': '/root/lkd-kurs/sqlite-replica.db',
+    #     'OPTIONS': {'pragmas': {'journal_mode': 'DELETE', 'query_only': 1}},
+    # },
 }
 
+DATABASE_ROUTERS = ['kurs.routers.ReplicaRouter']
+
+# Seconds the requests of a client stay on the primary database after it
+# wrote something, the replica must catch up within this time
+KURS_REPLICA_PIN_SECONDS = 5
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
@@ -90,6 +107,39 @@ STATICFILES_FINDERS = (
 # Make this unique, and don't share it with anybody.
 SECRET_KEY = '+b983)^-ewxz(d=_&amp;*jn-ualou3wi%yngg4)h*wd%1a#_tnz65'
 
+# Rendered user pages and their version tokens are kept in the cache (see
+# kurs/cache.py). With more than one process use a shared backend such as
+# memcached, otherwise invalidations do not reach the other processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Sessions read from the cache and written to the database behind it, at
+# most every KURS_SESSION_WRITE_INTERVAL seconds unless the user changes
+# (see kurs/sessions.py). Only with a cache shared by all processes:
+# SESSION_ENGINE = 'kurs.sessions'
+KURS_SESSION_WRITE_INTERVAL = 60
+
+# Requests to the registration views are let in at this rate, per second,
+# the others wait in a queue (see kurs/admission.py). None turns it off.
+KURS_ADMISSION_RATE = 20
+KURS_ADMISSION_BURST = 40
+KURS_ADMISSION_USER_RATE = 1
+KURS_ADMISSION_USER_BURST = 10
+# Seconds an admitted user goes through the registration without waiting
+KURS_ADMISSION_TICKET_SECONDS = 300
+
+# Import the views and the admin, load the middleware and the templates when
+# lkd.wsgi is imported instead of with the first request. Run gunicorn with
+# --preload for the workers to share them (see kurs/startup.py).
+KURS_WARM_UP = True
+
+# Messages are kept in a cookie, the session is only written when they do
+# not fit in it
+MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
+
 # List of callables that know how to import templates from various sources.
 TEMPLATE_LOADERS = (
     'django.template.loaders.filesystem.Loader',
@@ -97,6 +147,11 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+# Compiled templates are kept in memory unless templates are being edited,
+# changed template files are then only seen after a restart
+if not DEBUG:
+    TEMPLATE_LOADERS = (('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),)
+
 MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -104,10 +159,21 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'kurs.routers.ReplicaRoutingMiddleware',
+    'kurs.querystats.QueryStatsMiddleware',
+    'kurs.log.LogStatsMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# Record query count, database time and repeated queries of every request,
+# see kurs/querystats.py. Defaults to DEBUG.
+KURS_QUERY_STATS = DEBUG
+
+# Report the number of log records and the time spent logging them of every
+# request, see kurs/log.py. Defaults to DEBUG.
+KURS_LOG_STATS = DEBUG
+
 ROOT_URLCONF = 'lkd.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.
@@ -150,7 +216,13 @@ LOGGING = {
             'format' : "[%(asctime)s] %(levelname)s [%(name)s:%(lineno)s] %(message)s",
             'datefmt' : "%d/%b/%Y %H:%M:%S"
         },
+        # One JSON object per line, see kurs/log.py
+        'json': {
+            '()': 'kurs.log.JSONFormatter',
+        },
     },
+    # File handlers write from a background thread, request threads only
+    # queue the records
     'handlers': {
         'null': {
             'level':'DEBUG',
@@ -163,7 +235,7 @@ LOGGING = {
         },
         'django_filehandler': {
                 'level':'DEBUG',
-                'class':'logging.handlers.RotatingFileHandler',
+                'class':'kurs.log.QueueRotatingFileHandler',
                 'filename': MEDIA_ROOT + 'kurs/logs/django.log',
                 'maxBytes': 1024*1024*5, # 5 MB
                 'backupCount': 5,
@@ -171,19 +243,19 @@ LOGGING = {
         },
         'admin_filehandler': {
             'level':'DEBUG',
-            'class':'logging.handlers.RotatingFileHandler',
+            'class':'kurs.log.QueueRotatingFileHandler',
             'filename': MEDIA_ROOT + 'kurs/logs/admin.log',
             'maxBytes': 1024*1024*5, # 5 MB,
             'backupCount': 5,
-            'formatter': 'standard',
+            'formatter': 'json',
         },
         'kurs_filehandler': {
             'level':'DEBUG',
-            'class':'logging.handlers.RotatingFileHandler',
+            'class':'kurs.log.QueueRotatingFileHandler',
             'filename': MEDIA_ROOT + 'kurs/logs/kurs.log',
             'maxBytes': 1024*1024*5, # 5 MB,
             'backupCount': 5,
-            'formatter': 'standard',
+            'formatter': 'json',
         },
     },
     'loggers': {
@@ -23,6 +23,13 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "lkd.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Do the work of the first request now, before the server forks its workers
+# (see kurs/startup.py)
+from django.conf import settings
+if getattr(settings, 'KURS_WARM_UP', False):
+    from kurs.startup import warm_up
+    warm_up(application)
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)